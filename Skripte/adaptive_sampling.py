@@ -0,0 +1,134 @@
+import json
+import logging
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+import pandas as pd
+
+from analysis import CHUNK_SIZE, ResultAggregator, project_result
+from call_metrics import MetricsRecorder
+from context_store import get_shared_context
+from vote_shares import REPLICATES
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def default_trajectory_path(output_path: Path) -> Path:
+    # pipeline_results.jsonl -> pipeline_results.adaptive.json
+    return output_path.with_name(f"{output_path.stem}.adaptive.json")
+
+
+class ResultFeed:
+    # One aggregator over the results of the drawn personas. Each call
+    # reads only what was appended to the results file since the last
+    # one, so a run reads every record once instead of once per batch.
+    def __init__(self, output_path: Path, replicates: int, seed: Optional[int]):
+        self.output_path = output_path
+        self.aggregator = ResultAggregator(list(get_shared_context().parties), replicates, seed)
+        self.offset = 0
+
+    def update(self, ids: Set[str], chunk_size: int = CHUNK_SIZE) -> None:
+        if not self.output_path.exists():
+            return
+        rows = []
+        with open(self.output_path, "rb") as f:
+            f.seek(self.offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # Still being written, read again next time
+                    break
+                self.offset += len(line)
+                try:
+                    row = project_result(json.loads(line))
+                except (ValueError, AttributeError):
+                    logger.warning(f"Skipping unreadable line in {self.output_path}")
+                    continue
+                if str(row["id"]) in ids:
+                    rows.append(row)
+                if len(rows) >= chunk_size:
+                    self.aggregator.update(pd.DataFrame(rows))
+                    rows = []
+        if rows:
+            self.aggregator.update(pd.DataFrame(rows))
+
+    def intervals(self) -> Tuple[int, Dict[str, Dict[str, float]]]:
+        # Shares and intervals over the results of the drawn personas only
+        if not self.aggregator.vote_share_rows:
+            return 0, {}
+        return self.aggregator.vote_share_rows, self.aggregator.vote_share_intervals()
+
+
+def run_adaptive(
+    personas: List[Tuple[str, Dict]],
+    run_batch: Callable[[List[Tuple[str, Dict]]], None],
+    output_path: Path,
+    target_half_width: float = 1.0,
+    batch_size: int = 50,
+    min_personas: int = 100,
+    max_personas: Optional[int] = None,
+    max_cost_usd: Optional[float] = None,
+    metrics: Optional[MetricsRecorder] = None,
+    replicates: int = REPLICATES,
+    seed: Optional[int] = None,
+    done_ids: Optional[Set[str]] = None,
+) -> Dict[str, Any]:
+    # Draws personas in random order, batch by batch, and stops as soon as
+    # every party's interval half-width (in pp) is below the target or a
+    # budget is used up. Parties that nobody voted for have zero-width
+    # intervals, hence no stop before min_personas results.
+    order = np.random.default_rng(seed).permutation(len(personas))
+    ids = set(done_ids or ())
+    trajectory = []
+    limit = len(personas) if max_personas is None else min(max_personas, len(personas))
+    reason = "stichprobe_erschoepft" if limit == len(personas) else "personen_budget"
+    drawn = 0
+    feed = ResultFeed(output_path, replicates, seed)
+    while drawn < limit:
+        batch = [personas[i] for i in order[drawn : min(drawn + batch_size, limit)]]
+        drawn += len(batch)
+        run_batch(batch)
+        ids.update(id for id, _ in batch)
+
+        feed.update(ids)
+        rows, intervals = feed.intervals()
+        half_width = max(
+            ((i["ci_oben"] - i["ci_unten"]) / 2 for i in intervals.values()), default=np.inf
+        )
+        cost = metrics.summary()["total"]["cost_usd"] if metrics is not None else None
+        step = {
+            "gezogen": drawn,
+            "ergebnisse": rows,
+            "max_halbbreite": round(float(half_width), 3),
+            "kosten_usd": cost,
+            "stimmenanteile": {
+                party: round(interval["anteil"], 2) for party, interval in intervals.items()
+            },
+        }
+        trajectory.append(step)
+        logger.info(
+            f"Adaptive: {rows} results, max CI half-width {half_width:.2f} pp "
+            f"(target {target_half_width}), shares {step['stimmenanteile']}"
+        )
+
+        if rows >= min_personas and half_width <= target_half_width:
+            reason = "ziel_erreicht"
+            break
+        if max_cost_usd is not None and cost is not None and cost >= max_cost_usd:
+            reason = "kosten_budget"
+            break
+
+    summary = {
+        "abbruchgrund": reason,
+        "ziel_halbbreite": target_half_width,
+        "gezogen": drawn,
+        "verfuegbar": len(personas),
+        "verlauf": trajectory,
+    }
+    path = default_trajectory_path(output_path)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    logger.info(f"Adaptive run stopped ({reason}) after {drawn} personas, trajectory in {path}")
+    return summary
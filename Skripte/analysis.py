@@ -1,103 +1,362 @@
 import json
 import logging
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, Iterator, List, Optional, Tuple
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 
+from context_store import get_shared_context
+from results_store import default_store_dir, is_current, iter_analysis_chunks
+from vote_shares import CONFIDENCE, REPLICATES, StreamingBootstrap
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def load_results(results_path: Path) -> List[Dict]:
-    results = []
-    try:
-        with open(results_path, "r", encoding="utf-8") as f:
-            for line in f:
-                results.append(json.loads(line))
-        logger.info(f"Loaded {len(results)} results from {results_path}")
-        return results
-    except Exception as e:
-        logger.error(f"Failed to load results: {e}")
-        return []
+# Records parsed per chunk; only the projected fields are kept
+CHUNK_SIZE = 50000
+
+# Integer-valued columns are aggregated as histograms over this range,
+# which gives exact quantiles and box plots in constant memory
+VALUE_RANGES = {"alter": 151, "sicherheit": 101}
+
+# Column prefix of a persona's sampled vote share per party (step 4 with
+# several votes); the plain party columns hold the judge matches
+SHARE_PREFIX = "anteil_"
+
+
+def project_result(result: Dict) -> Dict:
+    # The fields the analysis needs, the free texts are dropped right away
+    persona = result.get("persona") or {}
+    final = result.get("finale_entscheidung") or {}
+    judge = result.get("judge_distribution") or {}
+    shares = final.get("verteilung") or {}
+    return {
+        "id": result.get("id"),
+        "name": persona.get("name"),
+        "alter": persona.get("alter"),
+        "beruf": persona.get("beruf"),
+        "wohnort": persona.get("wohnort"),
+        "partei_wahl": final.get("partei_wahl"),
+        "sicherheit": final.get("sicherheit"),
+        "gewicht": result.get("gewicht"),
+        **judge.get("matches", {}),  # Changed from "partei_match" to "matches"
+        **{SHARE_PREFIX + party: share for party, share in shares.items()},
+    }
+
 
-def prepare_dataframe(results: List[Dict]) -> pd.DataFrame:
+def iter_result_chunks(
+    results_path: Path, chunk_size: int = CHUNK_SIZE
+) -> Iterator[pd.DataFrame]:
+    # Streams the JSONL file; at most one chunk of projected rows is held
     rows = []
-    for result in results:
-        # Extract basic info
-        persona = result.get("persona", {})
-        final = result.get("finale_entscheidung", {})
-        judge = result.get("judge_distribution", {})
-        
-        # Create row with relevant fields
-        row = {
-            "id": result.get("id"),
-            "name": persona.get("name"),
-            "alter": persona.get("alter"),
-            "beruf": persona.get("beruf"),
-            "wohnort": persona.get("wohnort"),
-            "partei_wahl": final.get("partei_wahl"),
-            "sicherheit": final.get("sicherheit"),
-            **judge.get("matches", {})  # Changed from "partei_match" to "matches"
+    skipped = 0
+    with open(results_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                rows.append(project_result(json.loads(line)))
+            except (ValueError, AttributeError):
+                skipped += 1
+                continue
+            if len(rows) >= chunk_size:
+                yield pd.DataFrame(rows)
+                rows = []
+    if rows:
+        yield pd.DataFrame(rows)
+    if skipped:
+        logger.warning(f"Skipped {skipped} unreadable lines in {results_path}")
+
+
+class ResultAggregator:
+    # Running totals over result chunks: choice counts, per-party
+    # histograms of the integer columns and the first and second moments
+    # of the match matrix. Memory does not depend on the number of rows.
+    def __init__(
+        self, parties: List[str], replicates: int = REPLICATES, seed: Optional[int] = None
+    ):
+        self.parties = list(parties)
+        self._party_index = {party: i for i, party in enumerate(self.parties)}
+        self.rows = 0
+        self.choice_counts: Dict[str, int] = {}
+        self.histograms: Dict[str, Dict[str, np.ndarray]] = {
+            column: {} for column in VALUE_RANGES
         }
-        rows.append(row)
-    
-    return pd.DataFrame(rows)
+        # (count, mean, sum of squared deviations) per column
+        self.moments = {column: (0, 0.0, 0.0) for column in VALUE_RANGES}
+        self.extremes = {column: [np.inf, -np.inf] for column in VALUE_RANGES}
+
+        k = len(self.parties)
+        self.match_moments = (0, np.zeros(k), np.zeros((k, k)))
+        self.choice_match_sum = 0.0
+        self.choice_match_rows = 0
+        self.top_match_hits = 0
+        # Expected votes per party and the rows behind them
+        self.vote_share_sum = np.zeros(k)
+        self.vote_share_rows = 0
+        self.distribution_rows = 0
+        # Bootstrap replicates updated per chunk, never the rows themselves
+        self.replicates = replicates
+        self.bootstrap = StreamingBootstrap(k, replicates, seed)
+        self.weighted = False
+
+    def update(self, df: pd.DataFrame) -> None:
+        self.rows += len(df)
+        choices = df["partei_wahl"]
+
+        # Value counts in order of first appearance, like value_counts
+        for party, count in choices.value_counts(sort=False).items():
+            self.choice_counts[party] = self.choice_counts.get(party, 0) + int(count)
+
+        for column, size in VALUE_RANGES.items():
+            values = pd.to_numeric(df[column], errors="coerce").to_numpy(dtype=float)
+            valid = ~np.isnan(values)
+            v = values[valid]
+            if len(v):
+                deviation = v - v.mean()
+                self.moments[column] = _combine_moments(
+                    self.moments[column], (len(v), v.mean(), deviation @ deviation)
+                )
+                self.extremes[column][0] = min(self.extremes[column][0], v.min())
+                self.extremes[column][1] = max(self.extremes[column][1], v.max())
+            bins = np.clip(np.rint(values), 0, size - 1)
+            for party in choices[valid].unique():
+                mask = valid & (choices == party).to_numpy()
+                histogram = np.bincount(bins[mask].astype(int), minlength=size)
+                target = self.histograms[column]
+                target[party] = target.get(party, 0) + histogram
+
+        # Match matrix (rows x parties), missing parties as NaN
+        matches = (
+            df.reindex(columns=self.parties)
+            .apply(pd.to_numeric, errors="coerce")
+            .to_numpy(dtype=float)
+        )
+        complete = ~np.isnan(matches).any(axis=1)
+        m = matches[complete]
+        if len(m):
+            deviation = m - m.mean(axis=0)
+            self.match_moments = _combine_moments(
+                self.match_moments, (len(m), m.mean(axis=0), deviation.T @ deviation)
+            )
+
+        # Chosen party's match by fancy indexing, top match by argmax
+        choice_index = (
+            choices.astype(str).str.replace("/", "_")  # Handle CDU/CSU
+            .map(self._party_index)
+            .to_numpy(dtype=float)
+        )
+        known = ~np.isnan(choice_index)
+        rows = np.flatnonzero(known)
+        columns = choice_index[known].astype(int)
+        chosen = matches[rows, columns]
+        chosen_valid = ~np.isnan(chosen)
+        self.choice_match_sum += chosen[chosen_valid].sum()
+        self.choice_match_rows += int(chosen_valid.sum())
+
+        top = np.argmax(np.where(np.isnan(matches), -np.inf, matches), axis=1)
+        self.top_match_hits += int((top[rows] == columns).sum())
+
+        # Sampled distributions where step 4 drew several votes, the single
+        # choice as a one-hot vote otherwise
+        shares = (
+            df.reindex(columns=[SHARE_PREFIX + party for party in self.parties])
+            .apply(pd.to_numeric, errors="coerce")
+            .to_numpy(dtype=float)
+        )
+        sampled = ~np.isnan(shares).all(axis=1)
+        self.vote_share_sum += np.nansum(shares[sampled], axis=0)
+        single = ~sampled[rows]
+        np.add.at(self.vote_share_sum, columns[single], 1.0)
+        self.distribution_rows += int(sampled.sum())
+        self.vote_share_rows += int(sampled.sum()) + int(single.sum())
+
+        votes = np.where(sampled[:, None], np.nan_to_num(shares), 0.0)
+        votes[rows[single], columns[single]] = 1.0
+        counted = sampled.copy()
+        counted[rows[single]] = True
+        weights = (
+            pd.to_numeric(df["gewicht"], errors="coerce").to_numpy(dtype=float)
+            if "gewicht" in df
+            else np.full(len(df), np.nan)
+        )
+        self.weighted |= bool((~np.isnan(weights)).any())
+        self.bootstrap.add(votes[counted], np.nan_to_num(weights[counted], nan=1.0))
+
+    def party_distribution(self) -> pd.Series:
+        counts = pd.Series(self.choice_counts, dtype=int)
+        return counts.sort_values(ascending=False, kind="stable")
+
+    def expected_vote_shares(self) -> pd.Series:
+        # Mean of the per-persona distributions in percent
+        shares = pd.Series(
+            self.vote_share_sum / max(self.vote_share_rows, 1) * 100, index=self.parties
+        )
+        return shares.sort_values(ascending=False, kind="stable")
+
+    def vote_share_intervals(self) -> Dict[str, Dict[str, float]]:
+        # Weighted shares with Poisson bootstrap intervals, largest first
+        intervals = self.bootstrap.intervals(self.parties)
+        return dict(sorted(intervals.items(), key=lambda item: -item[1]["anteil"]))
+
+    def histogram(self, column: str, party: Optional[str] = None) -> np.ndarray:
+        histograms = self.histograms[column]
+        if party is not None:
+            return histograms.get(party, np.zeros(VALUE_RANGES[column], dtype=int))
+        return sum(histograms.values(), np.zeros(VALUE_RANGES[column], dtype=int))
+
+    def describe(self, column: str) -> Dict[str, float]:
+        # Same keys and values as pandas' Series.describe()
+        count, mean, squares = self.moments[column]
+        mean = mean if count else np.nan
+        var = squares / (count - 1) if count > 1 else np.nan
+        histogram = self.histogram(column)
+        stats = {
+            "count": float(count),
+            "mean": float(mean),
+            "std": float(np.sqrt(max(var, 0.0))) if count > 1 else np.nan,
+            "min": float(self.extremes[column][0]) if count else np.nan,
+        }
+        for q, key in ((0.25, "25%"), (0.5, "50%"), (0.75, "75%")):
+            stats[key] = _histogram_quantile(histogram, q)
+        stats["max"] = float(self.extremes[column][1]) if count else np.nan
+        return stats
+
+    def match_statistics(self) -> Tuple[pd.Series, pd.Series, pd.DataFrame]:
+        # Mean, sample std and correlation of the match columns
+        n, mean, comoments = self.match_moments
+        mean = mean if n else np.full(len(self.parties), np.nan)
+        covariance = (
+            comoments / (n - 1)
+            if n > 1
+            else np.full((len(self.parties),) * 2, np.nan)
+        )
+        std = np.sqrt(np.clip(np.diag(covariance), 0.0, None))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            correlation = covariance / np.outer(std, std)
+        return (
+            pd.Series(mean, index=self.parties),
+            pd.Series(std, index=self.parties),
+            pd.DataFrame(correlation, index=self.parties, columns=self.parties),
+        )
+
+
+def _combine_moments(a: Tuple, b: Tuple) -> Tuple:
+    # Merges (count, mean, squared deviations) of two chunks without the
+    # cancellation of the sum-of-squares formula; works for vectors too,
+    # the deviations then being the co-moment matrix
+    n_a, mean_a, m2_a = a
+    n_b, mean_b, m2_b = b
+    n = n_a + n_b
+    if n_a == 0:
+        return b
+    delta = mean_b - mean_a
+    mean = mean_a + delta * n_b / n
+    m2 = m2_a + m2_b + np.multiply.outer(delta, delta) * n_a * n_b / n
+    return n, mean, m2
+
+
+def _histogram_quantile(histogram: np.ndarray, q: float) -> float:
+    # Linear interpolation between order statistics, like pandas
+    n = int(histogram.sum())
+    if n == 0:
+        return np.nan
+    cumulative = np.cumsum(histogram)
+    position = (n - 1) * q
+    lower = int(np.floor(position))
+    upper = int(np.ceil(position))
+    value_lower = int(np.searchsorted(cumulative, lower, side="right"))
+    value_upper = int(np.searchsorted(cumulative, upper, side="right"))
+    return float(value_lower + (value_upper - value_lower) * (position - lower))
+
+
+def _box_stats(histogram: np.ndarray, label: str) -> Dict:
+    # Input for Axes.bxp, matching seaborn's default 1.5 IQR whiskers
+    values = np.flatnonzero(histogram)
+    q1 = _histogram_quantile(histogram, 0.25)
+    q3 = _histogram_quantile(histogram, 0.75)
+    low, high = q1 - 1.5 * (q3 - q1), q3 + 1.5 * (q3 - q1)
+    inside = values[(values >= low) & (values <= high)]
+    return {
+        "label": label,
+        "med": _histogram_quantile(histogram, 0.5),
+        "q1": q1,
+        "q3": q3,
+        "whislo": float(inside.min()) if len(inside) else q1,
+        "whishi": float(inside.max()) if len(inside) else q3,
+        "fliers": values[(values < low) | (values > high)].astype(float),
+    }
+
 
-def analyze_results(df: pd.DataFrame, output_dir: Path) -> None:
-    
+def _boxplot(aggregator: ResultAggregator, column: str, order: List[str], path: Path, title: str) -> None:
+    plt.figure(figsize=(12, 6))
+    ax = plt.gca()
+    stats = [
+        _box_stats(aggregator.histogram(column, party), party)
+        for party in order
+        if aggregator.histogram(column, party).sum()
+    ]
+    if stats:
+        # Colours as in seaborn's boxplot
+        ax.bxp(
+            stats,
+            widths=0.8,
+            patch_artist=True,
+            boxprops={"facecolor": sns.color_palette()[0], "edgecolor": "#3f3f3f"},
+            medianprops={"color": "#3f3f3f"},
+            whiskerprops={"color": "#3f3f3f"},
+            capprops={"color": "#3f3f3f"},
+        )
+    ax.set_xlabel("partei_wahl")
+    ax.set_ylabel(column)
+    plt.title(title)
+    plt.xticks(rotation=45)
+    plt.tight_layout()
+    plt.savefig(path)
+    plt.close()
+
+
+def write_analysis(aggregator: ResultAggregator, output_dir: Path) -> None:
     # 1. Basic Statistics
-    party_dist = df["partei_wahl"].value_counts()
-    age_stats = df["alter"].describe()
-    certainty_stats = df["sicherheit"].describe()
+    party_dist = aggregator.party_distribution()
 
     # Save statistics to Dictionary
     statistics = {
         "parteienverteilung": party_dist.to_dict(),
-        "altersverteilung": age_stats.to_dict(),
-        "sicherheitsverteilung": certainty_stats.to_dict()
+        "altersverteilung": aggregator.describe("alter"),
+        "sicherheitsverteilung": aggregator.describe("sicherheit")
     }
-    
+
     # 2. Plots
-    
+
     # 2.1 Party Distribution
     plt.figure(figsize=(12, 6))
-    sns.countplot(data=df, x="partei_wahl", order=party_dist.index)
+    sns.barplot(x=list(party_dist.index), y=party_dist.to_numpy())
+    plt.xlabel("partei_wahl")
+    plt.ylabel("count")
     plt.title("Verteilung der Parteiwahl")
     plt.xticks(rotation=45)
     plt.tight_layout()
     plt.savefig(output_dir / "partei_verteilung.png")
     plt.close()
-    
-    # 2.2 Age Distribution by Party
-    plt.figure(figsize=(12, 6))
-    sns.boxplot(data=df, x="partei_wahl", y="alter")
-    plt.title("Altersverteilung nach Parteiwahl")
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-    plt.savefig(output_dir / "alter_nach_partei.png")
-    plt.close()
-    
+
+    # 2.2 Age Distribution by Party, boxes in order of first appearance
+    order = list(aggregator.choice_counts)
+    _boxplot(aggregator, "alter", order, output_dir / "alter_nach_partei.png",
+             "Altersverteilung nach Parteiwahl")
+
     # 2.3 Decision Certainty by Party
-    plt.figure(figsize=(12, 6))
-    sns.boxplot(data=df, x="partei_wahl", y="sicherheit")
-    plt.title("Entscheidungssicherheit nach Parteiwahl")
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-    plt.savefig(output_dir / "sicherheit_nach_partei.png")
-    plt.close()
-    
+    _boxplot(aggregator, "sicherheit", order, output_dir / "sicherheit_nach_partei.png",
+             "Entscheidungssicherheit nach Parteiwahl")
+
     # 2.4 Party Match Heatmap
-    with open('Daten/Basisdaten/parteien.json', 'r', encoding='utf-8') as f:
-        match_columns = json.load(f)
+    match_columns = aggregator.parties
+    match_means, match_stds, match_corr = aggregator.match_statistics()
 
-    # Select all match columns for correlation
-    match_data = df[match_columns]  # This gets all party match columns
-    
     plt.figure(figsize=(10, 8))
     sns.heatmap(
-        match_data.corr(),
+        match_corr,
         annot=True,
         cmap="RdYlBu",
         center=0,
@@ -108,12 +367,9 @@ def analyze_results(df: pd.DataFrame, output_dir: Path) -> None:
     plt.tight_layout()
     plt.savefig(output_dir / "partei_korrelationen.png")
     plt.close()
-    
+
     # 2.5 Match Distribution vs Final Choice
     plt.figure(figsize=(12, 6))
-    match_means = match_data.mean()
-    match_stds = match_data.std()
-    
     x = range(len(match_columns))
     plt.bar(x, match_means, yerr=match_stds, capsize=5)
     plt.xticks(x, match_columns, rotation=45)
@@ -121,45 +377,97 @@ def analyze_results(df: pd.DataFrame, output_dir: Path) -> None:
     plt.tight_layout()
     plt.savefig(output_dir / "match_verteilung.png")
     plt.close()
-    
+
     # 3. Additional Analysis
-    
+
     # 3.1 Match vs Choice Analysis
-    choice_matches = []
-    for _, row in df.iterrows():
-        choice = row["partei_wahl"]
-        match = row[choice.replace("/", "_")]  # Handle CDU/CSU
-        choice_matches.append(match)
-    
-    avg_choice_match = sum(choice_matches) / len(choice_matches)
-    statistics["durchschnittlicher_match_mit_gewählter_partei"] = avg_choice_match
-    
+    statistics["durchschnittlicher_match_mit_gewählter_partei"] = (
+        aggregator.choice_match_sum / aggregator.choice_match_rows
+        if aggregator.choice_match_rows
+        else None
+    )
+
     # 3.2 Top Match vs Choice Analysis
-    correct_top_matches = 0
-    for _, row in df.iterrows():
-        matches = {col: row[col] for col in match_columns}
-        top_match = max(matches, key=matches.get)
-        actual_choice = row["partei_wahl"].replace("/", "_")
-        if top_match == actual_choice:
-            correct_top_matches += 1
-    
-    match_ratio = (correct_top_matches / len(df)) * 100
-    statistics["entscheidungen_entsprechend_hoechstem_match"] = match_ratio
+    statistics["entscheidungen_entsprechend_hoechstem_match"] = (
+        aggregator.top_match_hits / aggregator.rows * 100 if aggregator.rows else None
+    )
+
+    # 3.3 Expected vote shares, only for runs with several votes per persona
+    if aggregator.distribution_rows:
+        statistics["erwartete_stimmenanteile"] = aggregator.expected_vote_shares().to_dict()
+        statistics["personas_mit_verteilung"] = aggregator.distribution_rows
+
+    # 3.4 Survey-weighted vote shares with bootstrap confidence intervals
+    if aggregator.vote_share_rows:
+        intervals = aggregator.vote_share_intervals()
+        statistics["stimmenanteile"] = intervals
+        statistics["bootstrap"] = {
+            "replikationen": aggregator.replicates,
+            "konfidenzniveau": CONFIDENCE,
+            "gewichtet": aggregator.weighted,
+            "personas": aggregator.vote_share_rows,
+        }
+
+        plt.figure(figsize=(12, 6))
+        parties = list(intervals)
+        shares = np.array([intervals[p]["anteil"] for p in parties])
+        errors = np.array([
+            [intervals[p]["anteil"] - intervals[p]["ci_unten"] for p in parties],
+            [intervals[p]["ci_oben"] - intervals[p]["anteil"] for p in parties],
+        ])
+        plt.bar(range(len(parties)), shares, yerr=errors, capsize=5)
+        plt.xticks(range(len(parties)), parties, rotation=45)
+        plt.ylabel("Stimmenanteil (%)")
+        plt.title(f"Stimmenanteile mit {CONFIDENCE:.0%}-Konfidenzintervallen")
+        plt.tight_layout()
+        plt.savefig(output_dir / "stimmenanteile_ci.png")
+        plt.close()
 
     # Save statistics to JSON file
     with open(output_dir / "grundlegende_statistiken.json", 'w', encoding='utf-8') as f:
         json.dump(statistics, f, ensure_ascii=False, indent=2)
 
-def run_analysis(results_path: str, output_dir: str) -> None:
+
+def analyze_results(
+    df: pd.DataFrame,
+    output_dir: Path,
+    replicates: int = REPLICATES,
+    seed: Optional[int] = None,
+) -> None:
+    # In-memory entry point, same output as the streaming run_analysis
+    aggregator = ResultAggregator(list(get_shared_context().parties), replicates, seed)
+    aggregator.update(df)
+    write_analysis(aggregator, output_dir)
+
+
+def run_analysis(
+    results_path: str,
+    output_dir: str,
+    chunk_size: int = CHUNK_SIZE,
+    replicates: int = REPLICATES,
+    seed: Optional[int] = None,
+) -> None:
     results_path = Path(results_path)
     output_dir = Path(output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
-    
-    # Load and prepare data
-    results = load_results(results_path)
 
-    # Prepare dataframe
-    df = prepare_dataframe(results)
-    
+    # Stream the results in chunks into the running totals, from the
+    # columnar store if it is up to date, else from the JSONL file
+    aggregator = ResultAggregator(list(get_shared_context().parties), replicates, seed)
+    store_dir = default_store_dir(results_path)
+    if is_current(store_dir, results_path):
+        chunks = iter_analysis_chunks(store_dir, chunk_size)
+        source = store_dir
+    else:
+        chunks = iter_result_chunks(results_path, chunk_size)
+        source = results_path
+    try:
+        for chunk in chunks:
+            aggregator.update(chunk)
+    except OSError as e:
+        logger.error(f"Failed to load results: {e}")
+        return
+    logger.info(f"Analyzed {aggregator.rows} results from {source}")
+
     # Run analysis
-    analyze_results(df, output_dir)
\ No newline at end of file
+    write_analysis(aggregator, output_dir)
@@ -0,0 +1,399 @@
+import json
+import time
+import logging
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from openai import OpenAI
+from openai.types.chat import ChatCompletion
+
+from llm_client import (
+    build_request_body,
+    parse_choices,
+    parse_completion,
+    resolve_api_key,
+    validate_choices,
+)
+from step4_final_choice import aggregate_votes
+from stages import (
+    STAGES,
+    STAGE_RESPONSE_FORMATS,
+    STAGE_RESPONSE_MODELS,
+    build_stage_prompts,
+    build_stage_repair,
+    build_result,
+)
+from checkpoint_store import CheckpointStore
+from prompt_templates import PERSONA_FIRST
+from wahlomat_matching import DeterministicJudge
+from call_metrics import CallRecord, MetricsRecorder
+from result_writer import ResultWriter
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+
+# Batch API limits per input file, with some headroom on the size
+MAX_REQUESTS_PER_BATCH = 50000
+MAX_BATCH_BYTES = 190 * 1024 * 1024
+
+FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+class OpenAIBatchBackend:
+    # Submit/poll layer on top of the OpenAI Files and Batches endpoints
+    def __init__(self, client: Optional[OpenAI] = None, completion_window: str = "24h"):
+        self.client = client or OpenAI(api_key=resolve_api_key(None))
+        self.completion_window = completion_window
+
+    def submit(self, input_path: Path) -> str:
+        with open(input_path, "rb") as f:
+            input_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window=self.completion_window,
+        )
+        return batch.id
+
+    def status(self, batch_id: str) -> str:
+        return self.client.batches.retrieve(batch_id).status
+
+    def results(self, batch_id: str) -> List[Dict]:
+        batch = self.client.batches.retrieve(batch_id)
+        lines = []
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                content = self.client.files.content(file_id).text
+                lines.extend(json.loads(line) for line in content.splitlines() if line)
+        return lines
+
+
+class LocalBatchBackend:
+    # File-based stand-in for the Batch API. `responder` turns a request
+    # body into a chat completion body; submitted batches are answered on
+    # the first poll and the output is kept next to the input file.
+    def __init__(self, directory: Path, responder: Callable[[Dict], Dict]):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.responder = responder
+        self._count = 0
+
+    def submit(self, input_path: Path) -> str:
+        self._count += 1
+        batch_id = f"local_batch_{self._count}"
+        (self.directory / f"{batch_id}.input.jsonl").write_bytes(
+            Path(input_path).read_bytes()
+        )
+        # Ids restart with every run, an output left by an earlier run
+        # in the same directory must not answer this batch
+        (self.directory / f"{batch_id}.output.jsonl").unlink(missing_ok=True)
+        return batch_id
+
+    def status(self, batch_id: str) -> str:
+        output_path = self.directory / f"{batch_id}.output.jsonl"
+        if not output_path.exists():
+            input_path = self.directory / f"{batch_id}.input.jsonl"
+            with open(input_path, "r", encoding="utf-8") as f_in, open(
+                output_path, "w", encoding="utf-8"
+            ) as f_out:
+                for line in f_in:
+                    request = json.loads(line)
+                    f_out.write(json.dumps(self._answer(request), ensure_ascii=False) + "\n")
+        return "completed"
+
+    def _answer(self, request: Dict) -> Dict:
+        try:
+            body = self.responder(request["body"])
+            response = {"status_code": 200, "body": body}
+            error = None
+        except Exception as e:
+            response = None
+            error = {"code": "local_error", "message": str(e)}
+        return {
+            "id": f"batch_req_{request['custom_id']}",
+            "custom_id": request["custom_id"],
+            "response": response,
+            "error": error,
+        }
+
+    def results(self, batch_id: str) -> List[Dict]:
+        output_path = self.directory / f"{batch_id}.output.jsonl"
+        with open(output_path, "r", encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+
+def write_batch_files(
+    requests: Iterable[Tuple[str, Dict]], work_dir: Path, stage: str
+) -> List[Path]:
+    # One JSONL line per request, split into several files when a stage is
+    # larger than what a single batch accepts
+    paths = []
+    f = None
+    count = 0
+    size = 0
+    try:
+        for custom_id, body in requests:
+            line = json.dumps(
+                {"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": body},
+                ensure_ascii=False,
+            ) + "\n"
+            line_bytes = len(line.encode("utf-8"))
+            if f is None or count >= MAX_REQUESTS_PER_BATCH or size + line_bytes > MAX_BATCH_BYTES:
+                if f is not None:
+                    f.close()
+                path = work_dir / f"{stage}_{len(paths) + 1}.jsonl"
+                paths.append(path)
+                f = open(path, "w", encoding="utf-8")
+                count = 0
+                size = 0
+            f.write(line)
+            count += 1
+            size += line_bytes
+    finally:
+        if f is not None:
+            f.close()
+    return paths
+
+
+def parse_batch_line(
+    line: Dict, n: int = 1, response_model: Optional[Any] = None
+) -> Tuple[Optional[Any], Optional[str]]:
+    # Same (result, error) contract as structured_call; without a
+    # response model the parsed JSON is returned unvalidated
+    if line.get("error"):
+        return None, f"Batch request failed: {line['error']}"
+    response = line.get("response") or {}
+    if response.get("status_code") != 200:
+        return None, f"Batch request failed with status {response.get('status_code')}"
+    try:
+        completion = ChatCompletion.model_validate(response["body"])
+        result = parse_choices(completion) if n > 1 else parse_completion(completion)
+        if response_model is not None:
+            result = validate_choices(result, response_model, n)
+        return result, None
+    except Exception as e:
+        return None, f"Failed to parse batch response: {str(e)}"
+
+
+def batch_line_record(
+    line: Dict, stage: str, id: str, model: str, result: Any, error: Optional[str]
+) -> CallRecord:
+    # Batch lines carry the usage of the completion, but no latency
+    body = (line.get("response") or {}).get("body") or {}
+    usage = body.get("usage") or {}
+    return CallRecord(
+        stage=stage,
+        persona_id=id,
+        model=model,
+        prompt_tokens=usage.get("prompt_tokens", 0),
+        cached_tokens=(usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0,
+        completion_tokens=usage.get("completion_tokens", 0),
+        attempts=1,
+        success=result is not None,
+        failure_reason=error[:300] if error else None,
+        batch=True,
+    )
+
+
+def line_tokens(line: Dict) -> int:
+    usage = ((line.get("response") or {}).get("body") or {}).get("usage") or {}
+    return usage.get("total_tokens", 0)
+
+
+def run_repairs(
+    repairs: Dict[str, Tuple[Any, Any, Tuple[str, str, Dict], Dict]],
+    stage: str,
+    backend,
+    work_dir: Path,
+    model: str,
+    temperature: float,
+    max_tokens: int,
+    poll_interval: float,
+    metrics: Optional[MetricsRecorder] = None,
+) -> Dict[str, Any]:
+    # One extra round for responses that failed validation but can be
+    # repaired: only the small follow-up requests are batched, the answers
+    # are merged into the first responses. {id: (repair, data, request,
+    # line)} -> {id: validated result} for the repaired ones.
+    def requests():
+        for id, (_, _, (system_prompt, user_prompt, response_format), _) in repairs.items():
+            yield id, build_request_body(
+                model, temperature, system_prompt, user_prompt, response_format, max_tokens
+            )
+
+    batch_ids = [
+        backend.submit(path)
+        for path in write_batch_files(requests(), work_dir, f"{stage}_repair")
+    ]
+    logger.info(f"Submitted {len(batch_ids)} repair batches for {len(repairs)} {stage} responses")
+    wait_for_batches(backend, batch_ids, poll_interval)
+
+    repaired = {}
+    fixes = {
+        line["custom_id"]: line for batch_id in batch_ids for line in backend.results(batch_id)
+    }
+    for id, (repair, data, _, line) in repairs.items():
+        fix_line = fixes.get(id)
+        result = error = None
+        if fix_line is None:
+            error = "No repair result"
+        else:
+            fix, error = parse_batch_line(fix_line)
+            if fix is not None:
+                try:
+                    result = validate_choices(repair.merge(data, fix), STAGE_RESPONSE_MODELS[stage])
+                    repaired[id] = result
+                except ValueError as e:
+                    error = f"Repair still invalid: {str(e)}"
+        if metrics is not None:
+            # One record per persona and stage, as for an online call
+            record = batch_line_record(line, stage, id, model, result, error)
+            if fix_line is not None:
+                repair_record = batch_line_record(fix_line, stage, id, model, None, None)
+                record.prompt_tokens += repair_record.prompt_tokens
+                record.cached_tokens += repair_record.cached_tokens
+                record.completion_tokens += repair_record.completion_tokens
+                record.attempts += 1
+            if result is not None:
+                record.repairs = 1
+                record.tokens_saved = max(line_tokens(line) - line_tokens(fix_line), 0)
+            metrics.record(record)
+    logger.info(f"Repaired {len(repaired)} of {len(repairs)} {stage} responses")
+    return repaired
+
+
+def wait_for_batches(backend, batch_ids: List[str], poll_interval: float) -> None:
+    pending = set(batch_ids)
+    while pending:
+        for batch_id in list(pending):
+            status = backend.status(batch_id)
+            if status in FINAL_STATUSES:
+                if status != "completed":
+                    logger.warning(f"Batch {batch_id} ended with status {status}")
+                pending.discard(batch_id)
+        if pending:
+            logger.info(f"Waiting for {len(pending)} batches")
+            time.sleep(poll_interval)
+
+
+def run_batch_pipeline(
+    personas: List[Tuple[str, Dict]],
+    writer: ResultWriter,
+    backend,
+    work_dir: Path,
+    model: str = "gpt-4o",
+    temperature: float = 0.7,
+    max_tokens: int = 4000,
+    layout: str = PERSONA_FIRST,
+    checkpoints: Optional[CheckpointStore] = None,
+    poll_interval: float = 60.0,
+    judge: Optional[DeterministicJudge] = None,
+    metrics: Optional[MetricsRecorder] = None,
+    votes: int = 1,
+) -> int:
+    # Runs the four stages as four rounds of batches; the results of one
+    # round are the inputs of the next one
+    work_dir.mkdir(parents=True, exist_ok=True)
+    gles_by_id = dict(personas)
+    outputs = {
+        id: (checkpoints.get(id, data) if checkpoints else {}) for id, data in personas
+    }
+    failed = set()
+
+    for stage in STAGES:
+        # Step 4 asks for `votes` completions per request
+        n = votes if stage == "final_choice" else 1
+        if stage == "judge" and judge is not None:
+            # Scored locally for all personas at once, no batch needed
+            pending = [
+                id for id, _ in personas if id not in failed and stage not in outputs[id]
+            ]
+            results = judge.score_batch([outputs[id]["wahlomat"] for id in pending])
+            for id, result in zip(pending, results):
+                outputs[id][stage] = result
+                if checkpoints:
+                    checkpoints.save(id, stage, result)
+            continue
+
+        def requests():
+            for id, data in personas:
+                if id in failed or stage in outputs[id]:
+                    continue
+                prompts = build_stage_prompts(stage, data, outputs[id], layout)
+                if prompts is None:
+                    failed.add(id)
+                    continue
+                system_prompt, user_prompt = prompts
+                yield id, build_request_body(
+                    model,
+                    temperature,
+                    system_prompt,
+                    user_prompt,
+                    STAGE_RESPONSE_FORMATS[stage],
+                    max_tokens,
+                    n,
+                )
+
+        paths = write_batch_files(requests(), work_dir, stage)
+        if not paths:
+            continue
+
+        batch_ids = [backend.submit(path) for path in paths]
+        logger.info(f"Submitted {len(batch_ids)} batches for stage {stage}")
+        wait_for_batches(backend, batch_ids, poll_interval)
+
+        repairs = {}
+        for batch_id in batch_ids:
+            for line in backend.results(batch_id):
+                id = line["custom_id"]
+                if id not in gles_by_id or stage in outputs[id]:
+                    continue
+                result, error = parse_batch_line(line, n, STAGE_RESPONSE_MODELS[stage])
+                if result is None and n == 1:
+                    # Invalid but readable: only the invalid part is asked again
+                    data, _ = parse_batch_line(line)
+                    repair = build_stage_repair(stage, outputs[id]) if data is not None else None
+                    request = repair.request(data) if repair is not None else None
+                    if request is not None:
+                        repairs[id] = (repair, data, request, line)
+                        continue
+                if metrics is not None:
+                    metrics.record(batch_line_record(line, stage, id, model, result, error))
+                if result is not None and n > 1:
+                    result = aggregate_votes(result)
+                if result is None:
+                    logger.error(f"{stage} failed for {id}: {error}")
+                    failed.add(id)
+                    continue
+                outputs[id][stage] = result
+                if checkpoints:
+                    checkpoints.save(id, stage, result)
+
+        if repairs:
+            repaired = run_repairs(
+                repairs, stage, backend, work_dir, model, temperature, max_tokens,
+                poll_interval, metrics,
+            )
+            for id, result in repaired.items():
+                outputs[id][stage] = result
+                if checkpoints:
+                    checkpoints.save(id, stage, result)
+
+        # Requests missing from the output (expired batch etc.)
+        for id, _ in personas:
+            if id not in failed and stage not in outputs[id]:
+                logger.error(f"No {stage} result for {id}")
+                failed.add(id)
+
+    written = 0
+    for id, _ in personas:
+        if id in failed:
+            continue
+        writer.write(build_result(id, outputs[id], gles_by_id[id]))
+        written += 1
+
+    logger.info(f"Batch mode finished: {written} written, {len(failed)} failed")
+    return written
@@ -0,0 +1,196 @@
+import os
+import sys
+import csv
+import json
+import time
+import random
+import logging
+import argparse
+import resource
+import tempfile
+import subprocess
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# response_format name -> pipeline stage
+SCHEMA_STAGES = {
+    "persona": "persona",
+    "wahlomat_response": "wahlomat",
+    "judge_response": "judge",
+    "final_choice_response": "final_choice",
+}
+
+
+def write_synthetic_gles(csv_path: Path, rows: int, seed: int = 0) -> None:
+    # A few GLES-like demographic columns are enough for the fake backend
+    rng = random.Random(seed)
+    with open(csv_path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["alter", "geschlecht", "bundesland", "bildung", "parteiidentifikation"])
+        for _ in range(rows):
+            writer.writerow([
+                rng.randint(18, 90),
+                rng.choice(["männlich", "weiblich", "divers"]),
+                rng.choice(["Bayern", "Berlin", "Sachsen", "Hamburg", "Nordrhein-Westfalen"]),
+                rng.choice(["Hauptschule", "Realschule", "Abitur", "Hochschule"]),
+                rng.choice(["CDU", "SPD", "GRÜNE", "FDP", "LINKE", "AFD", "keine"]),
+            ])
+
+
+def run_worker(args: argparse.Namespace) -> None:
+    # Runs pipeline.py in this process against the fake backend and prints
+    # one JSON line with throughput, per-stage latency and peak RSS
+    sys.path.insert(0, str(Path(__file__).parent))
+    import pipeline
+    from llm_client import OpenAIClient, AsyncOpenAIClient
+
+    logging.getLogger().setLevel(logging.WARNING)
+    latencies: Dict[str, List[float]] = {stage: [] for stage in SCHEMA_STAGES.values()}
+
+    def stage_of(kwargs: Dict) -> str:
+        name = kwargs.get("response_format", {}).get("json_schema", {}).get("name")
+        return SCHEMA_STAGES.get(name, "other")
+
+    sync_call = OpenAIClient.structured_call
+    async_call = AsyncOpenAIClient.structured_call
+
+    def timed_call(self, *call_args, **kwargs):
+        start = time.perf_counter()
+        result = sync_call(self, *call_args, **kwargs)
+        latencies.setdefault(stage_of(kwargs), []).append(time.perf_counter() - start)
+        return result
+
+    async def timed_call_async(self, *call_args, **kwargs):
+        start = time.perf_counter()
+        result = await async_call(self, *call_args, **kwargs)
+        latencies.setdefault(stage_of(kwargs), []).append(time.perf_counter() - start)
+        return result
+
+    OpenAIClient.structured_call = timed_call
+    AsyncOpenAIClient.structured_call = timed_call_async
+
+    work_dir = Path(args.work_dir)
+    csv_path = work_dir / "gles.csv"
+    output_path = work_dir / "pipeline_results.jsonl"
+    write_synthetic_gles(csv_path, args.size, args.seed)
+
+    sys.argv = [
+        "pipeline.py",
+        "--run_pipeline",
+        "--backend", "fake",
+        "--csv_path", str(csv_path),
+        "--output_path", str(output_path),
+        "--sample_end", str(args.size),
+        "--concurrency", str(args.concurrency),
+        "--prompt_layout", args.prompt_layout,
+    ]
+    start = time.perf_counter()
+    pipeline.pipeline()
+    elapsed = time.perf_counter() - start
+
+    with open(output_path, "r", encoding="utf-8") as f:
+        written = sum(1 for _ in f)
+
+    report = {
+        "personas": args.size,
+        "written": written,
+        "seconds": round(elapsed, 3),
+        "personas_per_sec": round(written / elapsed, 3) if elapsed else 0.0,
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "stages": {
+            stage: {
+                "calls": len(values),
+                "p50_ms": round(float(np.percentile(values, 50)) * 1000, 2),
+                "p99_ms": round(float(np.percentile(values, 99)) * 1000, 2),
+            }
+            for stage, values in latencies.items()
+            if values
+        },
+    }
+    print(json.dumps(report))
+
+
+def run_benchmark(args: argparse.Namespace) -> List[Dict]:
+    # Every size runs in a fresh subprocess so peak RSS is measured per size
+    reports = []
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as work_dir:
+            env = dict(os.environ)
+            env.update({
+                "FAKE_LLM_LATENCY_MS": str(args.latency_ms),
+                "FAKE_LLM_LATENCY_SIGMA": str(args.latency_sigma),
+                "FAKE_LLM_FAILURE_RATE": str(args.failure_rate),
+                "FAKE_LLM_RATE_LIMIT_RATE": str(args.rate_limit_rate),
+                "FAKE_LLM_MALFORMED_RATE": str(args.malformed_rate),
+                "FAKE_LLM_SEED": str(args.seed),
+            })
+            command = [
+                sys.executable, __file__, "--worker",
+                "--size", str(size),
+                "--concurrency", str(args.concurrency),
+                "--prompt_layout", args.prompt_layout,
+                "--seed", str(args.seed),
+                "--work_dir", work_dir,
+            ]
+            logger.info(f"Benchmarking {size} personas")
+            # Run from the project root, the pipeline uses relative data paths
+            completed = subprocess.run(
+                command,
+                env=env,
+                cwd=Path(__file__).parent.parent,
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            report = json.loads(completed.stdout.strip().splitlines()[-1])
+            reports.append(report)
+            print_report(report)
+    return reports
+
+
+def print_report(report: Dict) -> None:
+    print(
+        f"{report['personas']:>7} personas  {report['personas_per_sec']:>9.2f}/s  "
+        f"{report['seconds']:>9.2f}s  peak RSS {report['peak_rss_mb']:>8.1f} MB"
+    )
+    for stage, stats in report["stages"].items():
+        print(f"    {stage:<13} p50 {stats['p50_ms']:>9.2f} ms  p99 {stats['p99_ms']:>9.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="End-to-end pipeline benchmark against the fake LLM backend"
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 10000])
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--prompt_layout", default="persona_first")
+    parser.add_argument("--latency_ms", type=float, default=0.0)
+    parser.add_argument("--latency_sigma", type=float, default=0.5)
+    parser.add_argument("--failure_rate", type=float, default=0.0)
+    parser.add_argument("--rate_limit_rate", type=float, default=0.0)
+    parser.add_argument("--malformed_rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--report_path", default=None)
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--size", type=int, default=10, help=argparse.SUPPRESS)
+    parser.add_argument("--work_dir", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args)
+        return
+
+    reports = run_benchmark(args)
+    if args.report_path:
+        with open(args.report_path, "w", encoding="utf-8") as f:
+            json.dump(reports, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
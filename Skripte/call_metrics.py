@@ -0,0 +1,239 @@
+import json
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict, field
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# USD per 1M tokens: (input, cached input, output)
+MODEL_PRICES = {
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4.1": (2.00, 0.50, 8.00),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+}
+# The Batch API bills half of the online price
+BATCH_DISCOUNT = 0.5
+
+# response_format name -> stage, for calls made outside a call_context
+SCHEMA_STAGES = {
+    "persona": "persona",
+    "wahlomat_response": "wahlomat",
+    "wahlomat_repair": "wahlomat",
+    "judge_response": "judge",
+    "final_choice_response": "final_choice",
+    "news_digest": "news_digest",
+}
+
+# Stage and persona of the call currently in flight; asyncio tasks get
+# their own copy, so concurrent personas do not see each other's values
+current_stage: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "current_stage", default=None
+)
+current_persona: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "current_persona", default=None
+)
+
+# Rewrite the Prometheus file at most this often
+PROMETHEUS_INTERVAL = 10.0
+
+
+@contextmanager
+def call_context(stage: Optional[str] = None, persona_id: Optional[str] = None) -> Iterator[None]:
+    stage_token = current_stage.set(stage)
+    persona_token = current_persona.set(persona_id)
+    try:
+        yield
+    finally:
+        current_stage.reset(stage_token)
+        current_persona.reset(persona_token)
+
+
+def default_metrics_path(output_path: Path) -> Path:
+    # pipeline_results.jsonl -> pipeline_results.metrics.jsonl
+    return output_path.with_name(f"{output_path.stem}.metrics.jsonl")
+
+
+def stage_of(response_format: Dict) -> str:
+    stage = current_stage.get()
+    if stage:
+        return stage
+    name = (response_format.get("json_schema") or {}).get("name")
+    return SCHEMA_STAGES.get(name, "other")
+
+
+@dataclass
+class CallRecord:
+    stage: str
+    persona_id: Optional[str]
+    model: str
+    prompt_tokens: int = 0
+    cached_tokens: int = 0
+    completion_tokens: int = 0
+    latency_ms: Optional[float] = None
+    attempts: int = 0
+    success: bool = False
+    failure_reason: Optional[str] = None
+    cache_hit: bool = False
+    batch: bool = False
+    # Invalid responses fixed by a follow-up instead of a full retry
+    repairs: int = 0
+    tokens_saved: int = 0
+    cost_usd: float = 0.0
+    timestamp: float = field(default_factory=time.time)
+
+
+def estimate_cost(record: CallRecord) -> float:
+    prices = MODEL_PRICES.get(record.model)
+    if prices is None:
+        return 0.0
+    input_price, cached_price, output_price = prices
+    uncached = record.prompt_tokens - record.cached_tokens
+    cost = (
+        uncached * input_price
+        + record.cached_tokens * cached_price
+        + record.completion_tokens * output_price
+    ) / 1_000_000
+    return cost * BATCH_DISCOUNT if record.batch else cost
+
+
+class _StageTotals:
+    def __init__(self):
+        self.calls = 0
+        self.failures = 0
+        self.cache_hits = 0
+        self.attempts = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.completion_tokens = 0
+        self.latency_seconds = 0.0
+        self.cost_usd = 0.0
+        self.repairs = 0
+        self.tokens_saved = 0
+
+    def add(self, record: CallRecord) -> None:
+        self.calls += 1
+        self.failures += 0 if record.success else 1
+        self.cache_hits += 1 if record.cache_hit else 0
+        self.attempts += record.attempts
+        self.prompt_tokens += record.prompt_tokens
+        self.cached_tokens += record.cached_tokens
+        self.completion_tokens += record.completion_tokens
+        self.latency_seconds += (record.latency_ms or 0.0) / 1000.0
+        self.cost_usd += record.cost_usd
+        self.repairs += record.repairs
+        self.tokens_saved += record.tokens_saved
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "failures": self.failures,
+            "cache_hits": self.cache_hits,
+            "attempts": self.attempts,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_tokens": self.cached_tokens,
+            "completion_tokens": self.completion_tokens,
+            "mean_latency_ms": (
+                round(self.latency_seconds * 1000 / self.calls, 1) if self.calls else 0.0
+            ),
+            "cost_usd": round(self.cost_usd, 4),
+            "repairs": self.repairs,
+            "tokens_saved": self.tokens_saved,
+        }
+
+
+class MetricsRecorder:
+    # Collects one CallRecord per structured_call (or batch line), keeps
+    # running per-stage totals and appends every record to a JSONL file
+    def __init__(
+        self,
+        path: Optional[Path] = None,
+        prometheus_path: Optional[Path] = None,
+    ):
+        self.path = Path(path) if path else None
+        self.prometheus_path = Path(prometheus_path) if prometheus_path else None
+        self.totals: Dict[str, _StageTotals] = {}
+        self._lock = threading.Lock()
+        self._file = None
+        self._last_prometheus = 0.0
+        if self.path is not None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8")
+
+    def record(self, record: CallRecord) -> None:
+        record.cost_usd = estimate_cost(record)
+        with self._lock:
+            self.totals.setdefault(record.stage, _StageTotals()).add(record)
+            if self._file is not None:
+                self._file.write(json.dumps(asdict(record), ensure_ascii=False) + "\n")
+                self._file.flush()
+            write_prometheus = (
+                self.prometheus_path is not None
+                and time.monotonic() - self._last_prometheus >= PROMETHEUS_INTERVAL
+            )
+        if write_prometheus:
+            self.write_prometheus()
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            stages = {stage: totals.as_dict() for stage, totals in self.totals.items()}
+        total = {
+            key: sum(stats[key] for stats in stages.values())
+            for key in (
+                "calls", "failures", "prompt_tokens", "cached_tokens", "completion_tokens",
+                "repairs", "tokens_saved",
+            )
+        }
+        total["cost_usd"] = round(sum(stats["cost_usd"] for stats in stages.values()), 4)
+        return {"stages": stages, "total": total}
+
+    def write_prometheus(self) -> None:
+        # Text exposition format, e.g. for the node_exporter textfile collector
+        with self._lock:
+            self._last_prometheus = time.monotonic()
+            stages = {stage: totals.as_dict() for stage, totals in self.totals.items()}
+            latency = {stage: totals.latency_seconds for stage, totals in self.totals.items()}
+        lines = []
+
+        def metric(name: str, kind: str, help: str, values: Dict[str, Any]) -> None:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in values.items():
+                lines.append(f"{name}{{{labels}}} {value}")
+
+        metric("llm_calls_total", "counter", "LLM calls per stage",
+               {f'stage="{s}"': v["calls"] for s, v in stages.items()})
+        metric("llm_call_failures_total", "counter", "Failed LLM calls per stage",
+               {f'stage="{s}"': v["failures"] for s, v in stages.items()})
+        metric("llm_call_attempts_total", "counter", "API attempts per stage including retries",
+               {f'stage="{s}"': v["attempts"] for s, v in stages.items()})
+        metric("llm_cache_hits_total", "counter", "Calls served from the response cache",
+               {f'stage="{s}"': v["cache_hits"] for s, v in stages.items()})
+        metric("llm_tokens_total", "counter", "Tokens per stage and kind", {
+            f'stage="{s}",kind="{kind}"': v[f"{kind}_tokens"]
+            for s, v in stages.items()
+            for kind in ("prompt", "cached", "completion")
+        })
+        metric("llm_call_latency_seconds_sum", "counter", "Summed call latency per stage",
+               {f'stage="{s}"': round(latency[s], 3) for s in stages})
+        metric("llm_cost_usd_total", "counter", "Estimated cost per stage",
+               {f'stage="{s}"': v["cost_usd"] for s, v in stages.items()})
+
+        tmp_path = self.prometheus_path.with_suffix(".tmp")
+        tmp_path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+        tmp_path.replace(self.prometheus_path)
+
+    def close(self) -> None:
+        if self.prometheus_path is not None:
+            self.write_prometheus()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
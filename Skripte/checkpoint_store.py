@@ -0,0 +1,180 @@
+import os
+import json
+import logging
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Optional, Set
+
+from stages import STAGES
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def default_checkpoint_path(output_path: Path) -> Path:
+    # pipeline_results.jsonl -> pipeline_results.checkpoints.jsonl
+    return output_path.with_name(f"{output_path.stem}.checkpoints.jsonl")
+
+
+def load_completed_ids(output_path: Path) -> Set[str]:
+    # IDs that already have a full record in the results file. A torn last
+    # line from a crash is ignored, that persona is simply redone.
+    completed = set()
+    if not output_path.exists():
+        return completed
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                completed.add(str(json.loads(line)["id"]))
+            except (ValueError, KeyError, TypeError):
+                logger.warning(f"Skipping unreadable line in {output_path}")
+    return completed
+
+
+class CheckpointStore:
+    # Log of every finished stage: one JSON line per (persona id, stage).
+    # The last line for a pair wins on reload. `on_save` sees every saved
+    # output, e.g. to fill the persona library. With a `key_fn` (see
+    # stage_store.stage_key) each line carries the hash of the stage's
+    # inputs, and a checkpoint whose inputs changed since (other GLES row,
+    # templates, context or settings) is dropped with all later stages.
+    def __init__(
+        self,
+        path: Path,
+        on_save: Optional[Callable[[str, str, Any], None]] = None,
+        key_fn: Optional[Callable[[str, Dict, Dict[str, Any]], Optional[str]]] = None,
+    ):
+        self.path = Path(path)
+        self.on_save = on_save
+        self.key_fn = key_fn
+        self.stale = 0
+        self._outputs: Dict[str, Dict[str, Any]] = {}
+        self._keys: Dict[str, Dict[str, Optional[str]]] = {}
+        # Stages preloaded from elsewhere, valid without a key
+        self._preloaded: Dict[str, Set[str]] = {}
+        # GLES rows of the personas in progress, to key their saves
+        self._rows: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+    def load(self, completed: Iterable[str] = ()) -> None:
+        # Checkpoints of personas already in the results are not needed
+        completed = set(completed)
+        if not self.path.exists():
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    id = str(record["id"])
+                    if id in completed:
+                        continue
+                    self._outputs.setdefault(id, {})[record["stage"]] = record["output"]
+                    self._keys.setdefault(id, {})[record["stage"]] = record.get("key")
+                except (ValueError, KeyError, TypeError):
+                    logger.warning(f"Skipping unreadable checkpoint line in {self.path}")
+        logger.info(f"Loaded checkpoints for {len(self._outputs)} personas from {self.path}")
+
+    def reset(self) -> None:
+        # A run without --resume starts a new log
+        if not self.path.exists():
+            return
+        if self.path.stat().st_size:
+            logger.info(f"Starting a new checkpoint log, replacing {self.path}")
+        with self._lock:
+            self.path.write_text("", encoding="utf-8")
+
+    def get(self, id: str, gles_data: Optional[Dict] = None) -> Dict[str, Any]:
+        # Checkpointed stages in stage order, up to the first one whose
+        # inputs no longer match
+        with self._lock:
+            if gles_data is not None:
+                self._rows[id] = gles_data
+            stored = dict(self._outputs.get(id, {}))
+            keys = dict(self._keys.get(id, {}))
+            preloaded = set(self._preloaded.get(id, ()))
+
+        valid: Dict[str, Any] = {}
+        for stage in STAGES:
+            if stage not in stored:
+                break
+            if (
+                self.key_fn is not None
+                and gles_data is not None
+                and stage not in preloaded
+                and keys.get(stage) != self.key_fn(stage, gles_data, valid)
+            ):
+                self.stale += len(stored) - len(valid)
+                logger.info(f"Checkpoints of {id} from {stage} on are outdated, redoing them")
+                break
+            valid[stage] = stored[stage]
+
+        if len(valid) < len(stored):
+            with self._lock:
+                self._outputs[id] = dict(valid)
+                self._keys[id] = {stage: keys.get(stage) for stage in valid}
+        return valid
+
+    def save(self, id: str, stage: str, output: Any) -> None:
+        with self._lock:
+            row = self._rows.get(id)
+            upstream = dict(self._outputs.get(id, {}))
+        upstream.pop(stage, None)
+        key = None
+        if self.key_fn is not None and row is not None:
+            key = self.key_fn(stage, row, upstream)
+        line = json.dumps(
+            {"id": id, "stage": stage, "key": key, "output": output}, ensure_ascii=False
+        )
+        with self._lock:
+            self._outputs.setdefault(id, {})[stage] = output
+            self._keys.setdefault(id, {})[stage] = key
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        if self.on_save is not None:
+            self.on_save(id, stage, output)
+
+    def preload(self, id: str, stage: str, output: Any) -> None:
+        # Output known from elsewhere (persona library); memory only, the
+        # stage is skipped like a checkpointed one but not logged again.
+        # It replaces a checkpoint of the stage, later stages built on a
+        # different output no longer match their keys.
+        with self._lock:
+            self._outputs.setdefault(id, {})[stage] = output
+            self._keys.setdefault(id, {})[stage] = None
+            self._preloaded.setdefault(id, set()).add(stage)
+
+    def complete(self, id: str) -> None:
+        # The full record is in the results file now, free the memory
+        with self._lock:
+            self._outputs.pop(id, None)
+            self._keys.pop(id, None)
+            self._preloaded.pop(id, None)
+            self._rows.pop(id, None)
+
+    def compact(self) -> int:
+        # Rewrites the log with the checkpoints still needed, i.e. of
+        # personas without a flushed record, one line per stage; without
+        # any the log is removed. Returns the number of lines kept.
+        with self._lock:
+            lines = [
+                json.dumps(
+                    {"id": id, "stage": stage, "key": self._keys[id].get(stage), "output": output},
+                    ensure_ascii=False,
+                )
+                for id, outputs in self._outputs.items()
+                for stage, output in outputs.items()
+                if stage not in self._preloaded.get(id, ())
+            ]
+            if not lines:
+                if self.path.exists():
+                    self.path.unlink()
+                return 0
+            temp_path = self.path.with_name(self.path.name + ".tmp")
+            with open(temp_path, "w", encoding="utf-8") as f:
+                f.write("".join(line + "\n" for line in lines))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+        logger.info(f"Compacted {self.path} to {len(lines)} checkpoints")
+        return len(lines)
@@ -0,0 +1,185 @@
+import json
+import hashlib
+import logging
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from program_index import build_program_excerpts
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DATA_DIR = Path("Daten/Basisdaten")
+
+
+@dataclass(frozen=True)
+class SharedContext:
+    # Everything that is identical for all personas, already serialized the
+    # way the prompt templates expect it
+    news: str
+    party_programs: str
+    party_program_texts: Tuple[str, ...]
+    questions: Tuple[Dict, ...]
+    questions_json: str
+    parties: Tuple[str, ...]
+    content_hash: str
+
+
+class ContextStore:
+    # Loads the shared context once per process. A cheap stat() check on
+    # every access notices edited files; the content hash then decides
+    # whether an already built context can be reused.
+    def __init__(
+        self,
+        data_dir: Path = DATA_DIR,
+        news_file: str = "news.txt",
+        questions_file: str = "wahlomat_fragen.json",
+        parties_file: str = "parteien.json",
+        programs_dir: str = "wahlprogramme",
+        program_top_k: Optional[int] = None,
+        program_token_budget: Optional[int] = None,
+        news_digester: Optional[Any] = None,
+    ):
+        self.news_path = Path(data_dir) / news_file
+        self.questions_path = Path(data_dir) / questions_file
+        self.parties_path = Path(data_dir) / parties_file
+        self.programs_dir = Path(data_dir) / programs_dir
+        # With program_top_k set, prompts get the retrieved passages per
+        # thesis instead of the full programmes
+        self.program_top_k = program_top_k
+        self.program_token_budget = program_token_budget
+        # news_digest.NewsDigester, replaces the raw news by a digest
+        self.news_digester = news_digester
+
+        self._lock = threading.Lock()
+        self._fingerprint: Optional[Tuple] = None
+        self._current: Optional[SharedContext] = None
+        self._by_hash: Dict[str, SharedContext] = {}
+
+    def _program_paths(self, parties: List[str]) -> List[Path]:
+        return [self.programs_dir / f"{party}.txt" for party in parties]
+
+    def _fingerprint_files(self, paths: List[Path]) -> Tuple:
+        fingerprint = []
+        for path in paths:
+            try:
+                stat = path.stat()
+                fingerprint.append((str(path), stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                fingerprint.append((str(path), None, None))
+        return tuple(fingerprint)
+
+    def get(self) -> SharedContext:
+        with self._lock:
+            parties_fingerprint = self._fingerprint_files([self.parties_path])[0]
+            if self._current is not None and parties_fingerprint == self._fingerprint[0]:
+                parties = list(self._current.parties)
+            else:
+                parties = _read_json(self.parties_path, default=[])
+            paths = [
+                self.parties_path,
+                self.news_path,
+                self.questions_path,
+                *self._program_paths(parties),
+            ]
+            fingerprint = self._fingerprint_files(paths)
+            if self._current is not None and fingerprint == self._fingerprint:
+                return self._current
+
+            raw = {path: _read_bytes(path) for path in paths}
+            digest = hashlib.sha256()
+            digest.update(f"{self.program_top_k}:{self.program_token_budget}".encode("utf-8"))
+            if self.news_digester is not None:
+                digest.update(self.news_digester.key.encode("utf-8"))
+            for path in paths:
+                digest.update(str(path).encode("utf-8"))
+                digest.update(raw[path] or b"")
+            content_hash = digest.hexdigest()
+
+            context = self._by_hash.get(content_hash)
+            if context is None:
+                context = self._build(parties, raw, content_hash)
+                self._by_hash[content_hash] = context
+                logger.info(f"Loaded shared context {content_hash[:12]}")
+
+            self._fingerprint = fingerprint
+            self._current = context
+            return context
+
+    def _build(
+        self, parties: List[str], raw: Dict[Path, Optional[bytes]], content_hash: str
+    ) -> SharedContext:
+        news = raw[self.news_path]
+        if news is None:
+            logger.warning(f"Could not load news from {self.news_path}")
+        news = news.decode("utf-8") if news is not None else ""
+        if news and self.news_digester is not None:
+            news = self.news_digester.digest(news)
+
+        programs = []
+        program_parties = []
+        for party, path in zip(parties, self._program_paths(parties)):
+            content = raw[path]
+            if content is None:
+                logger.warning(f"Could not load {path.name}")
+                continue
+            programs.append(content.decode("utf-8"))
+            program_parties.append(party)
+
+        questions = []
+        if raw[self.questions_path] is None:
+            logger.error(f"Could not load wahlomat questions from {self.questions_path}")
+        else:
+            questions = json.loads(raw[self.questions_path].decode("utf-8"))
+
+        party_programs = "\n\n".join(programs)
+        if self.program_top_k:
+            party_programs = build_program_excerpts(
+                program_parties,
+                programs,
+                questions,
+                top_k=self.program_top_k,
+                token_budget=self.program_token_budget,
+            )
+
+        return SharedContext(
+            news=news,
+            party_programs=party_programs,
+            party_program_texts=tuple(programs),
+            questions=tuple(questions),
+            questions_json=json.dumps(questions, ensure_ascii=False),
+            parties=tuple(parties),
+            content_hash=content_hash,
+        )
+
+
+def _read_bytes(path: Path) -> Optional[bytes]:
+    try:
+        return path.read_bytes()
+    except OSError:
+        return None
+
+
+def _read_json(path: Path, default):
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError) as e:
+        logger.error(f"Could not load {path}: {e}")
+        return default
+
+
+# Process wide store used by the pipeline steps
+_default_store = ContextStore()
+
+
+def configure_shared_context(**settings) -> None:
+    # Replaces the process wide store, e.g. to enable programme retrieval
+    global _default_store
+    _default_store = ContextStore(**settings)
+
+
+def get_shared_context() -> SharedContext:
+    return _default_store.get()
@@ -0,0 +1,247 @@
+import os
+import json
+import time
+import random
+import asyncio
+import hashlib
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+from rate_limiter import estimate_tokens
+
+# Base URL the OpenAI SDK is pointed at when the fake backend is used;
+# requests never leave the process
+FAKE_BASE_URL = "http://fake-llm.local/v1"
+
+WORDS = (
+    "Wirtschaft Klima Rente Migration Bildung Sicherheit Europa Gerechtigkeit "
+    "Familie Arbeit Wohnen Energie Digitalisierung Gesundheit Steuern Freiheit"
+).split()
+
+
+@dataclass
+class FakeLLMConfig:
+    # Median latency of a call, lognormally distributed with `latency_sigma`
+    latency_ms: float = 0.0
+    latency_sigma: float = 0.5
+    # Extra latency per generated token, makes long answers slower
+    ms_per_output_token: float = 0.0
+    # Probabilities of a 500 error, a 429 and a truncated JSON answer
+    failure_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    malformed_rate: float = 0.0
+    # Probability that a single Wahl-O-Mat answer is left out
+    invalid_answer_rate: float = 0.0
+    retry_after_ms: int = 100
+    seed: int = 0
+
+    @classmethod
+    def from_env(cls) -> "FakeLLMConfig":
+        # FAKE_LLM_LATENCY_MS, FAKE_LLM_FAILURE_RATE, ... override the defaults
+        config = cls()
+        for field in config.__dataclass_fields__:
+            value = os.getenv(f"FAKE_LLM_{field.upper()}")
+            if value is not None:
+                setattr(config, field, type(getattr(config, field))(value))
+        return config
+
+
+class FakeLLM:
+    # Deterministic stand-in for the chat completions endpoint. Answers are
+    # schema-valid for the four pipeline response formats and depend only
+    # on the seed, the request body and how often that body was seen.
+    def __init__(self, config: Optional[FakeLLMConfig] = None):
+        self.config = config or FakeLLMConfig()
+        self.counts = {"requests": 0, "failures": 0, "rate_limits": 0, "malformed": 0}
+        self._seen: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _rng(self, body: Dict) -> random.Random:
+        digest = hashlib.sha256(
+            json.dumps(body, sort_keys=True, ensure_ascii=False).encode("utf-8")
+        ).hexdigest()
+        with self._lock:
+            occurrence = self._seen.get(digest, 0)
+            self._seen[digest] = occurrence + 1
+            self.counts["requests"] += 1
+        return random.Random(f"{self.config.seed}:{digest}:{occurrence}")
+
+    def respond(self, body: Dict) -> Tuple[int, Dict, Dict[str, str], float]:
+        # Returns (status_code, json_body, headers, latency_seconds)
+        config = self.config
+        rng = self._rng(body)
+        latency = config.latency_ms / 1000.0
+        if config.latency_ms and config.latency_sigma:
+            latency *= rng.lognormvariate(0.0, config.latency_sigma)
+
+        roll = rng.random()
+        if roll < config.rate_limit_rate:
+            with self._lock:
+                self.counts["rate_limits"] += 1
+            headers = {"retry-after-ms": str(config.retry_after_ms)}
+            return 429, _error_body("Rate limit reached", "rate_limit_exceeded"), headers, latency
+        if roll < config.rate_limit_rate + config.failure_rate:
+            with self._lock:
+                self.counts["failures"] += 1
+            return 500, _error_body("Injected server error", "server_error"), {}, latency
+
+        choices = []
+        completion_tokens = 0
+        for index in range(body.get("n") or 1):
+            content = json.dumps(
+                generate_content(body.get("response_format") or {}, rng, config),
+                ensure_ascii=False,
+            )
+            if rng.random() < config.malformed_rate:
+                with self._lock:
+                    self.counts["malformed"] += 1
+                content = content[: len(content) // 2]
+            completion_tokens += estimate_tokens(content)
+            choices.append({
+                "index": index,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": content},
+            })
+        latency += completion_tokens * config.ms_per_output_token / 1000.0
+
+        prompt_tokens = sum(
+            estimate_tokens(message.get("content") or "") for message in body.get("messages", [])
+        )
+        completion = {
+            "id": f"fake-{rng.getrandbits(48):012x}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "choices": choices,
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": 0},
+            },
+        }
+        return 200, completion, {}, latency
+
+    def complete(self, body: Dict) -> Dict:
+        # Responder for batch_runner.LocalBatchBackend, no latency applied
+        status, response, _, _ = self.respond(body)
+        if status != 200:
+            raise RuntimeError(response["error"]["message"])
+        return response
+
+
+class FakeLLMTransport(httpx.BaseTransport, httpx.AsyncBaseTransport):
+    # httpx transport so the real OpenAI SDK code path (headers, 429
+    # handling, response parsing) runs against the fake
+    def __init__(self, fake: Optional[FakeLLM] = None):
+        self.fake = fake or FakeLLM(FakeLLMConfig.from_env())
+
+    def _response(self, request: httpx.Request, content: bytes) -> Tuple[httpx.Response, float]:
+        status, body, headers, latency = self.fake.respond(json.loads(content or b"{}"))
+        return httpx.Response(status, json=body, headers=headers, request=request), latency
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        response, latency = self._response(request, request.read())
+        if latency:
+            time.sleep(latency)
+        return response
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        response, latency = self._response(request, await request.aread())
+        if latency:
+            await asyncio.sleep(latency)
+        return response
+
+
+def _error_body(message: str, code: str) -> Dict:
+    return {"error": {"message": message, "type": code, "code": code}}
+
+
+def _text(rng: random.Random, min_chars: int, max_chars: int = 400, min_words: int = 0) -> str:
+    words: List[str] = []
+    while len(" ".join(words)) < min_chars or len(words) < min_words:
+        words.append(rng.choice(WORDS))
+    return " ".join(words)[:max_chars].rstrip()
+
+
+def generate_content(
+    response_format: Dict, rng: random.Random, config: Optional[FakeLLMConfig] = None
+) -> Any:
+    schema_info = response_format.get("json_schema") or {}
+    name = schema_info.get("name")
+    schema = schema_info.get("schema") or {}
+    properties = schema.get("properties", {})
+
+    if name == "persona":
+        return {
+            "name": f"Persona {rng.randint(1, 10**6)}",
+            "alter": rng.randint(18, 90),
+            "beruf": rng.choice(["Lehrerin", "Mechaniker", "Pflegekraft", "Rentner"]),
+            "wohnort": rng.choice(["Kiel", "Leipzig", "München", "Köln"]),
+            "beschreibung": _text(rng, 120),
+            "politische_einstellung": _text(rng, 40),
+            "kernthemen": rng.sample(WORDS, rng.randint(2, 5)),
+            "wahlverhalten": _text(rng, 40),
+            "sorgen": rng.sample(WORDS, rng.randint(1, 4)),
+            "hoffnungen": rng.sample(WORDS, rng.randint(1, 4)),
+        }
+    if name == "wahlomat_response":
+        count = properties.get("antworten", {}).get("maxItems", 35)
+        return {
+            "antworten": [
+                {
+                    "these_id": these_id,
+                    "position": rng.choice([-1, 0, 1]),
+                    "begruendung": _text(rng, 40, 200),
+                }
+                for these_id in range(1, count + 1)
+                if not (config and rng.random() < config.invalid_answer_rate)
+            ]
+        }
+    if name == "wahlomat_repair":
+        answers = properties.get("antworten", {})
+        return {
+            "antworten": [
+                {
+                    "these_id": these_id,
+                    "position": rng.choice([-1, 0, 1]),
+                    "begruendung": _text(rng, 40, 200),
+                }
+                for these_id in answers["items"]["properties"]["these_id"]["enum"]
+            ]
+        }
+    if name == "judge_response":
+        parties = properties.get("matches", {}).get("required", [])
+        return {
+            "matches": {party: round(rng.uniform(0, 100), 2) for party in parties},
+            "analyse": _text(rng, 200, 1500, min_words=30),
+        }
+    if name == "final_choice_response":
+        return {
+            "partei_wahl": rng.choice(properties["partei_wahl"]["enum"]),
+            "begruendung": _text(rng, 80, 800, min_words=15),
+            "sicherheit": rng.randint(50, 100),
+        }
+    return _from_schema(schema, rng)
+
+
+def _from_schema(schema: Dict, rng: random.Random) -> Any:
+    # Generic fallback for response formats the fake does not know by name
+    if "enum" in schema:
+        return rng.choice(schema["enum"])
+    kind = schema.get("type", "object")
+    if kind == "object":
+        return {key: _from_schema(value, rng) for key, value in schema.get("properties", {}).items()}
+    if kind == "array":
+        count = rng.randint(schema.get("minItems", 1), max(schema.get("minItems", 1), min(schema.get("maxItems", 3), 5)))
+        return [_from_schema(schema.get("items", {}), rng) for _ in range(count)]
+    if kind == "integer":
+        return rng.randint(schema.get("minimum", 0), schema.get("maximum", 100))
+    if kind == "number":
+        return round(rng.uniform(schema.get("minimum", 0), schema.get("maximum", 100)), 2)
+    if kind == "boolean":
+        return rng.random() < 0.5
+    return _text(rng, schema.get("minLength", 10), schema.get("maxLength", 400))
@@ -0,0 +1,193 @@
+import logging
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from step1_persona import WEIGHT_KEY
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Rows parsed per chunk; memory is bounded by this, not by the file
+CHUNK_SIZE = 10000
+
+# Column of the sampling key, dropped again before rows are yielded
+KEY_COLUMN = "__stichprobe"
+
+
+def sample_bounds(start: int, end: int) -> Tuple[int, Optional[int]]:
+    # --sample_start/--sample_end: rows start..end, a negative bound means
+    # the whole file
+    if start >= 0 and end >= 0:
+        logger.info(f"Using personas {start} to {end}")
+        return start, end
+    logger.info("Using all personas!")
+    return 0, None
+
+
+def parse_columns(spec: Optional[Sequence[str]]) -> Optional[List[str]]:
+    # Column names, or a single text file with one name per line
+    if not spec:
+        return None
+    if len(spec) == 1 and Path(spec[0]).is_file():
+        lines = Path(spec[0]).read_text(encoding="utf-8").splitlines()
+        return [line.strip() for line in lines if line.strip() and not line.startswith("#")]
+    return list(spec)
+
+
+def parse_strata(spec: Optional[Sequence[str]]) -> List[Tuple[str, Optional[List[float]]]]:
+    # "bundesland", "geschlecht" or "alter:30,45,60" for numeric columns,
+    # which are grouped at the given bin edges
+    strata = []
+    for item in spec or ():
+        name, _, edges = item.partition(":")
+        strata.append((name, sorted(float(edge) for edge in edges.split(",")) if edges else None))
+    return strata
+
+
+def stratum_labels(chunk: pd.DataFrame, strata: List[Tuple[str, Optional[List[float]]]]) -> pd.Series:
+    # One label per row, e.g. "Bayern|w|[45, 60)"; missing values are a
+    # stratum of their own
+    parts = []
+    for name, edges in strata:
+        if edges is None:
+            parts.append(chunk[name].astype(str))
+        else:
+            bins = [-np.inf, *edges, np.inf]
+            values = pd.to_numeric(chunk[name], errors="coerce")
+            parts.append(pd.cut(values, bins, right=False).astype(str))
+    labels = parts[0]
+    for part in parts[1:]:
+        labels = labels + "|" + part
+    return labels
+
+
+def allocate(counts: Dict[str, int], sample_size: int) -> Dict[str, int]:
+    # Proportional allocation by largest remainder, sums to sample_size
+    total = sum(counts.values())
+    quotas = {label: sample_size * count / total for label, count in counts.items()}
+    allocation = {label: int(quota) for label, quota in quotas.items()}
+    remainder = sample_size - sum(allocation.values())
+    for label in sorted(quotas, key=lambda label: quotas[label] - allocation[label], reverse=True)[
+        :remainder
+    ]:
+        allocation[label] += 1
+    return allocation
+
+
+def iter_gles_chunks(
+    csv_path: Path,
+    columns: Optional[List[str]] = None,
+    weight_column: Optional[str] = None,
+    start: int = 0,
+    end: Optional[int] = None,
+    chunk_size: int = CHUNK_SIZE,
+    extra_columns: Sequence[str] = (),
+) -> Iterator[pd.DataFrame]:
+    # Rows start..end of the file in chunks, only the projected columns
+    # parsed. The index is the row's position in the file, so persona ids
+    # (index + 1) are the same whatever bounds or shard a row is read in.
+    usecols = None
+    if columns is not None:
+        usecols = list(dict.fromkeys([*columns, *extra_columns, *([weight_column] if weight_column else [])]))
+    nrows = None if end is None else max(end - start, 0)
+    if nrows == 0:
+        return
+    reader = pd.read_csv(
+        csv_path,
+        usecols=usecols,
+        skiprows=(lambda i: 0 < i <= start) if start > 0 else None,
+        nrows=nrows,
+        chunksize=chunk_size,
+    )
+    offset = start
+    with reader:
+        for chunk in reader:
+            chunk.index = pd.RangeIndex(offset, offset + len(chunk))
+            offset += len(chunk)
+            if weight_column:
+                # Survey weights under a fixed key, kept out of the prompts
+                weights = pd.to_numeric(chunk.pop(weight_column), errors="coerce")
+                missing = int(weights.isna().sum())
+                if missing:
+                    logger.warning(f"{missing} rows without {weight_column}, using weight 1")
+                chunk[WEIGHT_KEY] = weights.fillna(1.0)
+            yield chunk
+    logger.info(f"Read {offset - start} rows from {csv_path}")
+
+
+def sample_rows(
+    chunks: Iterator[pd.DataFrame],
+    sample_size: int,
+    strata: Optional[List[Tuple[str, Optional[List[float]]]]] = None,
+    seed: Optional[int] = None,
+) -> pd.DataFrame:
+    # Seeded random or proportionally stratified sample in one pass. Every
+    # row gets a uniform random key and a sample is the rows with the
+    # smallest keys, so only those candidates are kept between chunks: at
+    # most sample_size overall, or per stratum when stratified, because
+    # the stratum sizes are only known at the end.
+    rng = np.random.default_rng(seed)
+    candidates = None
+    counts: Dict[str, int] = {}
+    for chunk in chunks:
+        chunk[KEY_COLUMN] = rng.random(len(chunk))
+        if strata:
+            labels = stratum_labels(chunk, strata)
+            for label, count in labels.value_counts().items():
+                counts[label] = counts.get(label, 0) + int(count)
+            chunk = chunk.assign(__stratum=labels)
+        candidates = chunk if candidates is None else pd.concat([candidates, chunk])
+        candidates = candidates.sort_values(KEY_COLUMN, kind="stable")
+        if strata:
+            candidates = candidates[candidates.groupby("__stratum").cumcount() < sample_size]
+        else:
+            candidates = candidates.iloc[:sample_size]
+    if candidates is None:
+        return pd.DataFrame()
+
+    if strata:
+        allocation = allocate(counts, min(sample_size, sum(counts.values())))
+        ranks = candidates.groupby("__stratum").cumcount()
+        quota = candidates["__stratum"].map(allocation)
+        candidates = candidates[ranks < quota]
+        logger.info(
+            f"Stratified sample of {len(candidates)} from {sum(counts.values())} rows "
+            f"in {len(counts)} strata"
+        )
+        candidates = candidates.drop(columns="__stratum")
+    else:
+        logger.info(f"Random sample of {len(candidates)} rows")
+    # File order, so ids come out ascending as in an unsampled run
+    return candidates.drop(columns=KEY_COLUMN).sort_index()
+
+
+def iter_personas(
+    csv_path: Path,
+    columns: Optional[List[str]] = None,
+    weight_column: Optional[str] = None,
+    start: int = 0,
+    end: Optional[int] = None,
+    sample_size: Optional[int] = None,
+    strata: Optional[List[Tuple[str, Optional[List[float]]]]] = None,
+    seed: Optional[int] = None,
+    chunk_size: int = CHUNK_SIZE,
+) -> Iterator[Tuple[str, Dict]]:
+    # (id, GLES row) pairs, yielded lazily chunk by chunk. Columns only
+    # needed for the strata are read but not passed on to the prompts.
+    strata = strata or []
+    strata_columns = [name for name, _ in strata]
+    chunks = iter_gles_chunks(
+        csv_path, columns, weight_column, start, end, chunk_size, extra_columns=strata_columns
+    )
+    if sample_size is not None:
+        chunks = iter([sample_rows(chunks, sample_size, strata, seed)])
+    for chunk in chunks:
+        if columns is not None:
+            dropped = [name for name in strata_columns if name not in columns]
+            chunk = chunk.drop(columns=dropped)
+        for index, data in zip(chunk.index, chunk.to_dict("records")):
+            yield f"{index + 1}", data
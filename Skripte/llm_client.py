@@ -1,14 +1,22 @@
 import os
 import time
-from typing import Any, Optional, Tuple, Type
+import asyncio
+from typing import Any, Dict, Generator, List, Optional, Tuple, Type
 import logging
-from pydantic import BaseModel
-from openai import OpenAI
+import threading
+import httpx
+from pydantic import BaseModel, ValidationError
+from openai import OpenAI, AsyncOpenAI, RateLimitError
 from openai.types.chat import ChatCompletion
 from dotenv import load_dotenv
 import json
 from pathlib import Path
 
+from rate_limiter import AdaptiveRateLimiter, estimate_request_tokens
+from response_cache import ResponseCache
+from call_metrics import CallRecord, MetricsRecorder, current_persona, stage_of
+from schemas import validate_response
+
 # Load environment variables from project root
 project_root = Path(__file__).parent.parent
 load_dotenv(project_root / ".env")
@@ -17,64 +25,387 @@ load_dotenv(project_root / ".env")
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-class OpenAIClient:
+DEFAULT_MODEL = "gpt-4o"
+DEFAULT_TEMPERATURE = 0.7
+
+
+def resolve_api_key(api_key: Optional[str]) -> str:
+    # Load environment variables from project root
+    project_root = Path(__file__).parent.parent
+    load_dotenv(project_root / ".env")
+
+    # Get API key from argument or environment
+    api_key = api_key or os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError("OpenAI API key not found in arguments or environment")
+    return api_key
+
+
+def build_request_body(
+    model: str,
+    temperature: float,
+    system_prompt: str,
+    user_prompt: str,
+    response_format: dict,
+    max_tokens: int = 4000,
+    n: int = 1
+) -> Dict[str, Any]:
+    # Chat completion parameters, also used as the body of Batch API lines
+    body = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        "response_format": response_format,
+        "temperature": temperature,
+        "max_tokens": max_tokens
+    }
+    # n completions share one prompt, only the output is billed n times
+    if n > 1:
+        body["n"] = n
+    return body
+
+
+def parse_completion(completion: ChatCompletion) -> Any:
+    # Extract and parse the response
+    response_text = completion.choices[0].message.content
+    if not response_text:
+        raise ValueError("Empty response from API")
+
+    # Parse as JSON, validation follows in validate_choices
+    return json.loads(response_text)
+
+
+def validate_choices(data: Any, response_model: Type[BaseModel], n: int = 1) -> Any:
+    # Pydantic validation with the prebuilt validators; with n > 1 invalid
+    # choices are dropped like unreadable ones
+    if n == 1:
+        return validate_response(response_model, data)
+    valid = []
+    for choice in data:
+        try:
+            valid.append(validate_response(response_model, choice))
+        except ValidationError as e:
+            logger.warning(f"Dropping invalid choice: {e.error_count()} errors")
+    if not valid:
+        raise ValueError(f"None of {len(data)} choices is valid")
+    return valid
+
+
+def completion_tokens_total(completion: ChatCompletion) -> int:
+    return completion.usage.total_tokens if completion.usage else 0
+
+
+def parse_choices(completion: ChatCompletion) -> List[Any]:
+    # All n choices of a completion; unreadable ones are dropped, the call
+    # only fails if none of them parses
+    parsed = []
+    for choice in completion.choices:
+        try:
+            if not choice.message.content:
+                raise ValueError("Empty response from API")
+            parsed.append(json.loads(choice.message.content))
+        except ValueError as e:
+            logger.warning(f"Dropping choice {choice.index}: {str(e)}")
+    if not parsed:
+        raise ValueError(f"None of {len(completion.choices)} choices could be parsed")
+    return parsed
+
+
+# Transport actions the shared call logic yields to the sync/async client
+SEND = "send"
+ACQUIRE = "acquire"
+SLEEP = "sleep"
+
+
+class _BaseClient:
+    # Configuration, request building, validation, repair and caching
+    # shared by the sync and async client. The call logic is written once
+    # as generators that yield transport actions (SEND, ACQUIRE, SLEEP);
+    # each client only runs those actions, blocking or awaited.
+    sdk_class: Type[Any]
+
     def __init__(
         self,
         api_key: Optional[str] = None,
-        model: str = "gpt-4o",
+        model: str = DEFAULT_MODEL,
         max_retries: int = 3,
         retry_delay: float = 1.0,
-        temperature: float = 0.7
+        temperature: float = DEFAULT_TEMPERATURE,
+        rate_limiter: Optional[AdaptiveRateLimiter] = None,
+        cache: Optional[ResponseCache] = None,
+        base_url: Optional[str] = None,
+        http_client: Optional[Any] = None,
+        metrics: Optional[MetricsRecorder] = None
     ):
-    
-        # Load environment variables from project root
-        project_root = Path(__file__).parent.parent
-        load_dotenv(project_root / ".env")
-        
-        # Get API key from argument or environment
-        api_key = api_key or os.getenv("OPENAI_API_KEY")
-        if not api_key:
-            raise ValueError("OpenAI API key not found in arguments or environment")
-            
-        self.client = OpenAI(api_key=api_key)
+        self.rate_limiter = rate_limiter
+        self.cache = cache
+        self.metrics = metrics
+        # With a rate limiter the SDK must not swallow 429s in its own retries
+        self.client = self.sdk_class(
+            api_key=resolve_api_key(api_key),
+            max_retries=0 if rate_limiter is not None else 2,
+            base_url=base_url,
+            http_client=http_client
+        )
         self.model = model
         self.max_retries = max_retries
         self.retry_delay = retry_delay
         self.temperature = temperature
 
-    def structured_call(
+        # Token usage over all calls, cached_tokens shows prefix cache hits
+        self.usage = {
+            "calls": 0,
+            "prompt_tokens": 0,
+            "cached_tokens": 0,
+            "completion_tokens": 0,
+            # Responses failing validation, and how many of them a small
+            # follow-up repaired instead of a full retry
+            "validation_failures": 0,
+            "repairs": 0,
+            "repair_tokens": 0,
+            "tokens_saved": 0,
+        }
+        self._usage_lock = threading.Lock()
+
+    def _request_kwargs(
         self,
         system_prompt: str,
         user_prompt: str,
+        response_format: dict,
+        max_tokens: int,
+        n: int = 1
+    ) -> Dict[str, Any]:
+        return build_request_body(
+            self.model,
+            self.temperature,
+            system_prompt,
+            user_prompt,
+            response_format,
+            max_tokens,
+            n
+        )
+
+    def _cache_key(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        response_format: dict,
+        sample_index: Optional[int],
+        n: int = 1,
+        max_tokens: Optional[int] = None
+    ) -> Optional[str]:
+        if self.cache is None:
+            return None
+        return self.cache.make_key(
+            self.model,
+            self.temperature,
+            system_prompt,
+            user_prompt,
+            response_format,
+            sample_index,
+            n,
+            max_tokens
+        )
+
+    def _cached(
+        self, cache_key: str, response_model: Type[BaseModel], n: int, record: CallRecord
+    ) -> Optional[Any]:
+        # Entries written before validation was enabled may be invalid,
+        # those are fetched again
+        cached = self.cache.get(cache_key)
+        if cached is None:
+            return None
+        try:
+            cached = validate_choices(cached, response_model, n)
+        except ValueError:
+            logger.warning("Ignoring an invalid cached response")
+            return None
+        record.cache_hit = True
+        return cached
+
+    def _repair_request(self, data: Any, repair: Optional[Any]) -> Optional[Tuple[str, str, dict]]:
+        # Follow-up request for the invalid part of a response, if the
+        # caller passed a repair for its response model
+        with self._usage_lock:
+            self.usage["validation_failures"] += 1
+        return repair.request(data) if repair is not None else None
+
+    def _finish_repair(
+        self,
+        data: Any,
+        repair: Any,
         response_model: Type[BaseModel],
-        response_format: dict = {"type": "object"},
-        max_tokens: int = 4000
-    ) -> Tuple[Optional[BaseModel], Optional[str]]:
+        completion: ChatCompletion,
+        fix: ChatCompletion,
+        record: CallRecord,
+    ) -> Any:
+        result = validate_response(response_model, repair.merge(data, parse_completion(fix)))
+        # A full retry would have cost about as much as the first response
+        repair_tokens = completion_tokens_total(fix)
+        saved = max(completion_tokens_total(completion) - repair_tokens, 0)
+        with self._usage_lock:
+            self.usage["repairs"] += 1
+            self.usage["repair_tokens"] += repair_tokens
+            self.usage["tokens_saved"] += saved
+        record.repairs += 1
+        record.tokens_saved += saved
+        return result
+
+    def _record_usage(self, completion: ChatCompletion, record: CallRecord) -> None:
+        usage = completion.usage
+        if usage is None:
+            return
+        details = usage.prompt_tokens_details
+        cached_tokens = (details.cached_tokens or 0) if details else 0
+        with self._usage_lock:
+            self.usage["calls"] += 1
+            self.usage["prompt_tokens"] += usage.prompt_tokens
+            self.usage["cached_tokens"] += cached_tokens
+            self.usage["completion_tokens"] += usage.completion_tokens
+        # Failed attempts count too, their tokens are billed as well
+        record.prompt_tokens += usage.prompt_tokens
+        record.cached_tokens += cached_tokens
+        record.completion_tokens += usage.completion_tokens
+
+    def _start_record(self, response_format: dict) -> CallRecord:
+        # Stage and persona come from call_metrics.call_context
+        return CallRecord(
+            stage=stage_of(response_format),
+            persona_id=current_persona.get(),
+            model=self.model,
+        )
+
+    def _finish_record(
+        self, record: CallRecord, start: float, result: Any, error: Optional[str]
+    ) -> None:
+        if self.metrics is None:
+            return
+        record.latency_ms = round((time.monotonic() - start) * 1000, 2)
+        record.success = result is not None
+        record.failure_reason = error[:300] if error else None
+        self.metrics.record(record)
+
+    def _completion_steps(self, request: Dict[str, Any]) -> Generator:
+        # One completion; SEND is answered with the raw response or raises
+        # the API error at the yield
+        limiter = self.rate_limiter
+        if limiter is None:
+            raw = yield SEND, request
+            return raw.parse()
+
+        estimate = estimate_request_tokens(request)
+        for _ in range(limiter.max_rate_limit_retries + 1):
+            yield ACQUIRE, estimate
+            used_tokens = None
+            try:
+                raw = yield SEND, request
+                completion = raw.parse()
+                used_tokens = completion.usage.total_tokens if completion.usage else None
+            except RateLimitError as e:
+                if e.code == "insufficient_quota":
+                    raise
+                limiter.record_rate_limit(e.response.headers)
+                continue
+            finally:
+                limiter.release(estimate, used_tokens)
+            limiter.record_response(raw.headers)
+            return completion
+        raise RuntimeError("Rate limit retries exhausted")
+
+    def _repair_steps(
+        self,
+        data: Any,
+        error: ValidationError,
+        repair: Optional[Any],
+        response_model: Type[BaseModel],
+        max_tokens: int,
+        completion: ChatCompletion,
+        record: CallRecord
+    ) -> Generator:
+        # Raises the validation error again when a full retry is needed
+        request = self._repair_request(data, repair)
+        if request is None:
+            raise error
+        system_prompt, user_prompt, response_format = request
+        try:
+            fix = yield from self._completion_steps(
+                self._request_kwargs(system_prompt, user_prompt, response_format, max_tokens)
+            )
+            self._record_usage(fix, record)
+            return self._finish_repair(data, repair, response_model, completion, fix, record)
+        except Exception as e:
+            logger.warning(f"Repair failed, repeating the full request: {str(e)}")
+            raise error
+
+    def _call_steps(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        response_model: Type[BaseModel],
+        response_format: dict,
+        max_tokens: int,
+        sample_index: Optional[int],
+        n: int,
+        repair: Optional[Any]
+    ) -> Generator:
+        # Every call, cached or not, ends up as one record in the metrics
+        record = self._start_record(response_format)
+        start = time.monotonic()
+        result, error = yield from self._attempt_steps(
+            system_prompt, user_prompt, response_format, max_tokens, sample_index, n, record,
+            response_model, repair
+        )
+        self._finish_record(record, start, result, error)
+        return result, error
+
+    def _attempt_steps(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        response_format: dict,
+        max_tokens: int,
+        sample_index: Optional[int],
+        n: int,
+        record: CallRecord,
+        response_model: Type[BaseModel],
+        repair: Optional[Any] = None
+    ) -> Generator:
+        # Serve repeated calls from the persistent cache if one is attached
+        cache_key = self._cache_key(
+            system_prompt, user_prompt, response_format, sample_index, n, max_tokens
+        )
+        if cache_key is not None:
+            cached = self._cached(cache_key, response_model, n, record)
+            if cached is not None:
+                return cached, None
+
         for attempt in range(self.max_retries):
+            record.attempts = attempt + 1
             try:
                 # Make the API call
-                completion = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": user_prompt}
-                    ],
-                    response_format=response_format,
-                    temperature=self.temperature,
-                    max_tokens=max_tokens
+                completion = yield from self._completion_steps(
+                    self._request_kwargs(
+                        system_prompt, user_prompt, response_format, max_tokens, n
+                    )
                 )
-                
-                # Extract and parse the response
-                response_text = completion.choices[0].message.content
-                if not response_text:
-                    raise ValueError("Empty response from API")
-                
+                self._record_usage(completion, record)
+
                 # Parse and validate with Pydantic
                 try:
-                    # First try to parse as JSON
-                    response_json = json.loads(response_text)
-                    # Then validate with Pydantic
-                    #parsed_response = response_model.model_validate(response_json)
+                    response_json = (
+                        parse_completion(completion) if n == 1 else parse_choices(completion)
+                    )
+                    try:
+                        response_json = validate_choices(response_json, response_model, n)
+                    except ValidationError as e:
+                        response_json = yield from self._repair_steps(
+                            response_json, e, repair, response_model, max_tokens,
+                            completion, record
+                        )
+                    if cache_key is not None:
+                        self.cache.put(cache_key, response_json)
                     return response_json, None
                 except json.JSONDecodeError as e:
                     logger.warning(f"Failed to parse JSON: {str(e)}")
@@ -90,26 +421,170 @@ class OpenAIClient:
             except Exception as e:
                 error_msg = f"API call failed: {str(e)}"
                 logger.warning(f"Attempt {attempt + 1}/{self.max_retries}: {error_msg}")
-                
+
                 if attempt < self.max_retries - 1:
                     # Exponential backoff
-                    delay = self.retry_delay * (2 ** attempt)
-                    time.sleep(delay)
+                    yield SLEEP, self.retry_delay * (2 ** attempt)
                     continue
                 return None, error_msg
 
         return None, "Max retries exceeded"
 
-def get_default_client() -> OpenAIClient:
+    def usage_stats(self) -> Dict[str, Any]:
+        with self._usage_lock:
+            stats = dict(self.usage)
+        prompt_tokens = stats["prompt_tokens"]
+        stats["full_retries"] = stats["validation_failures"] - stats["repairs"]
+        stats["cache_hit_rate"] = (
+            round(stats["cached_tokens"] / prompt_tokens, 4) if prompt_tokens else 0.0
+        )
+        return stats
+
+
+class OpenAIClient(_BaseClient):
+    sdk_class = OpenAI
+
+    def _run(self, steps: Generator) -> Any:
+        # Runs the shared call logic with blocking transport actions;
+        # errors go back into the generator where the action was yielded
+        value, error = None, None
+        try:
+            while True:
+                try:
+                    action, arg = steps.throw(error) if error is not None else steps.send(value)
+                except StopIteration as stop:
+                    return stop.value
+                value, error = None, None
+                try:
+                    if action == SEND:
+                        value = self.client.chat.completions.with_raw_response.create(**arg)
+                    elif action == ACQUIRE:
+                        self.rate_limiter.acquire(arg)
+                    else:
+                        time.sleep(arg)
+                except Exception as e:
+                    error = e
+        finally:
+            # Releases a held rate limiter slot if the caller gives up
+            steps.close()
+
+    def structured_call(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        response_model: Type[BaseModel],
+        response_format: dict = {"type": "object"},
+        max_tokens: int = 4000,
+        sample_index: Optional[int] = None,
+        n: int = 1,
+        repair: Optional[Any] = None
+    ) -> Tuple[Optional[BaseModel], Optional[str]]:
+        # With n > 1 the result is the list of parsed choices. `repair`
+        # (request/merge, e.g. step2_wahlomat.WahlomatRepair) re-asks only
+        # the invalid part of a response instead of the whole prompt.
+        return self._run(self._call_steps(
+            system_prompt, user_prompt, response_model, response_format, max_tokens,
+            sample_index, n, repair
+        ))
+
+
+class AsyncOpenAIClient(_BaseClient):
+    # Same contract as OpenAIClient, but structured_call is a coroutine so
+    # many personas can wait on the network at the same time
+    sdk_class = AsyncOpenAI
+
+    async def _run(self, steps: Generator) -> Any:
+        # Same as OpenAIClient._run, without blocking the event loop
+        value, error = None, None
+        try:
+            while True:
+                try:
+                    action, arg = steps.throw(error) if error is not None else steps.send(value)
+                except StopIteration as stop:
+                    return stop.value
+                value, error = None, None
+                try:
+                    if action == SEND:
+                        value = await self.client.chat.completions.with_raw_response.create(**arg)
+                    elif action == ACQUIRE:
+                        await self.rate_limiter.acquire_async(arg)
+                    else:
+                        await asyncio.sleep(arg)
+                except Exception as e:
+                    error = e
+        finally:
+            # Releases a held rate limiter slot if the task is cancelled
+            steps.close()
+
+    async def structured_call(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        response_model: Type[BaseModel],
+        response_format: dict = {"type": "object"},
+        max_tokens: int = 4000,
+        sample_index: Optional[int] = None,
+        n: int = 1,
+        repair: Optional[Any] = None
+    ) -> Tuple[Optional[BaseModel], Optional[str]]:
+        return await self._run(self._call_steps(
+            system_prompt, user_prompt, response_model, response_format, max_tokens,
+            sample_index, n, repair
+        ))
+
+
+def _default_client(
+    client_class: Type[_BaseClient],
+    http_client_class: Type[Any],
+    rate_limiter: Optional[AdaptiveRateLimiter],
+    cache: Optional[ResponseCache],
+    backend: Optional[str],
+    metrics: Optional[MetricsRecorder]
+) -> Any:
     # Load environment variables again to ensure they're available
     project_root = Path(__file__).parent.parent
     load_dotenv(project_root / ".env")
-    
+
+    # LLM_BACKEND=fake runs against the in-process fake, no API key needed
+    backend = backend or os.getenv("LLM_BACKEND", "openai")
+    if backend == "fake":
+        from fake_llm import FAKE_BASE_URL, FakeLLMTransport
+        return client_class(
+            api_key="fake",
+            rate_limiter=rate_limiter,
+            cache=cache,
+            metrics=metrics,
+            base_url=FAKE_BASE_URL,
+            http_client=http_client_class(transport=FakeLLMTransport())
+        )
+
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
         raise ValueError(
             "OPENAI_API_KEY environment variable not set. "
             "Please set it in .env file or environment"
         )
-    
-    return OpenAIClient(api_key=api_key)
\ No newline at end of file
+
+    return client_class(
+        api_key=api_key, rate_limiter=rate_limiter, cache=cache, metrics=metrics
+    )
+
+
+def get_default_client(
+    rate_limiter: Optional[AdaptiveRateLimiter] = None,
+    cache: Optional[ResponseCache] = None,
+    backend: Optional[str] = None,
+    metrics: Optional[MetricsRecorder] = None
+) -> OpenAIClient:
+    return _default_client(OpenAIClient, httpx.Client, rate_limiter, cache, backend, metrics)
+
+
+def get_default_async_client(
+    rate_limiter: Optional[AdaptiveRateLimiter] = None,
+    cache: Optional[ResponseCache] = None,
+    backend: Optional[str] = None,
+    metrics: Optional[MetricsRecorder] = None
+) -> AsyncOpenAIClient:
+    return _default_client(
+        AsyncOpenAIClient, httpx.AsyncClient, rate_limiter, cache, backend, metrics
+    )
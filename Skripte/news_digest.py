@@ -0,0 +1,272 @@
+import re
+import json
+import hashlib
+import logging
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from llm_client import OpenAIClient
+from schemas import NewsDigestSchema
+from response_formats import news_digest_response_format
+from rate_limiter import CHARS_PER_TOKEN, estimate_tokens
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DIGEST_DIR = Path("Daten/Cache")
+DIGEST_METHODS = ("extractive", "llm")
+
+# Sections that go into the digest first; the rest only if budget is left
+PRIORITY_SECTIONS = ("Politik", "Wirtschaft", "Gesellschaft")
+
+
+@dataclass(frozen=True)
+class NewsItem:
+    position: int
+    month: str
+    section: str
+    title: str
+    sentences: Tuple[str, ...]
+    tokens: int
+
+
+def _split_sentences(text: str) -> List[str]:
+    # A period after a digit is a date ("am 3.11."), not a sentence end
+    return [s for s in re.split(r"(?<=[^\d\s][.!?])\s+(?=[A-ZÄÖÜ„*])", text.strip()) if s]
+
+
+def _strip_links(text: str) -> str:
+    # Source references "([Titel](url))" cost many tokens and add nothing
+    text = re.sub(r"\s*\(\[[^\]]*\]\([^)]*\)\)", "", text)
+    return re.sub(r"\[([^\]]*)\]\([^)]*\)", r"\1", text)
+
+
+def parse_news_items(text: str) -> List[NewsItem]:
+    # news.txt layout: "## Monat", "### Rubrik", "- **Titel:** Text"
+    items = []
+    month = section = ""
+    for line in text.split("\n"):
+        line = line.strip()
+        if line.startswith("### "):
+            section = line[4:].strip()
+        elif line.startswith("## "):
+            month, section = line[3:].strip(), ""
+        elif line.startswith("- "):
+            body = line[2:].strip()
+            title = ""
+            match = re.match(r"^\*\*(.+?):?\*\*:?\s*", body)
+            if match:
+                title = match.group(1).rstrip(":")
+                body = body[match.end():]
+            items.append(NewsItem(
+                position=len(items),
+                month=month,
+                section=section,
+                title=title,
+                sentences=tuple(_split_sentences(_strip_links(body))),
+                tokens=estimate_tokens(line),
+            ))
+    return items
+
+
+def _priority(item: NewsItem, months: List[str]) -> Tuple[int, int, int]:
+    # Political sections first, newest month first, then document order
+    section = (
+        PRIORITY_SECTIONS.index(item.section)
+        if item.section in PRIORITY_SECTIONS
+        else len(PRIORITY_SECTIONS)
+    )
+    return section, -months.index(item.month), item.position
+
+
+def _render(items: List[NewsItem], kept: Dict[int, int]) -> str:
+    # kept: item position -> number of sentences in the digest
+    lines = []
+    month = section = None
+    for item in items:
+        count = kept.get(item.position, 0)
+        if not count:
+            continue
+        if item.month != month:
+            lines.append(f"## {item.month}")
+            month, section = item.month, None
+        if item.section != section:
+            lines.append(f"### {item.section}")
+            section = item.section
+        text = " ".join(item.sentences[:count])
+        lines.append(f"- **{item.title}:** {text}" if item.title else f"- {text}")
+    return "\n".join(lines)
+
+
+def extractive_digest(
+    items: List[NewsItem], token_budget: int, max_item_tokens: int
+) -> Tuple[str, Dict[int, int]]:
+    # First the lead sentence of as many items as fit, then further
+    # sentences of the same items; no item grows beyond max_item_tokens,
+    # so a single long feed entry cannot take over the budget
+    months = list(dict.fromkeys(item.month for item in items))
+    order = sorted(items, key=lambda item: _priority(item, months))
+    kept: Dict[int, int] = {}
+    used = 0
+    # Headings are small, 10 tokens per item is a safe allowance
+    for item in order:
+        if not item.sentences:
+            continue
+        cost = estimate_tokens(item.title + item.sentences[0]) + 10
+        if cost > max_item_tokens or used + cost > token_budget:
+            continue
+        kept[item.position] = 1
+        used += cost
+
+    for item in order:
+        count = kept.get(item.position)
+        if not count:
+            continue
+        item_tokens = estimate_tokens(item.title + " ".join(item.sentences[:count])) + 10
+        while count < len(item.sentences):
+            cost = estimate_tokens(item.sentences[count]) + 1
+            if item_tokens + cost > max_item_tokens or used + cost > token_budget:
+                break
+            count += 1
+            item_tokens += cost
+            used += cost
+        kept[item.position] = count
+    return _render(items, kept), kept
+
+
+def llm_digest(
+    items: List[NewsItem], token_budget: int, max_item_tokens: int, client: OpenAIClient
+) -> Optional[str]:
+    # One model call over the items, each already capped at max_item_tokens
+    capped = {item.position: len(item.sentences) for item in items}
+    for item in items:
+        while capped[item.position] > 1 and estimate_tokens(
+            item.title + " ".join(item.sentences[: capped[item.position]])
+        ) > max_item_tokens:
+            capped[item.position] -= 1
+
+    system_prompt = (
+        "Du bist ein erfahrener Nachrichtenredakteur. "
+        "Fasse aktuelle Nachrichten neutral und faktenbasiert zusammen."
+    )
+    user_prompt = (
+        f"Fasse die folgenden Nachrichten in höchstens {token_budget * CHARS_PER_TOKEN} "
+        "Zeichen zusammen. Behalte die chronologische Gliederung nach Monaten bei und "
+        "konzentriere dich auf Ereignisse, die für die Bundestagswahl relevant sind.\n\n"
+        f"NACHRICHTEN:\n{_render(items, capped)}"
+    )
+    result, error = client.structured_call(
+        system_prompt=system_prompt,
+        user_prompt=user_prompt,
+        response_model=NewsDigestSchema,
+        response_format=news_digest_response_format,
+        max_tokens=int(token_budget * 1.2),
+    )
+    if result is None:
+        logger.error(f"News digest call failed: {error}")
+        return None
+    return result["zusammenfassung"]
+
+
+class NewsDigester:
+    # Builds the digest once per news file content and keeps it on disk,
+    # keyed by the hash of the source text and the digest settings
+    def __init__(
+        self,
+        method: str = "extractive",
+        token_budget: int = 2000,
+        max_item_tokens: int = 150,
+        cache_dir: Path = DIGEST_DIR,
+        client: Optional[OpenAIClient] = None,
+    ):
+        if method not in DIGEST_METHODS:
+            raise ValueError(f"Unknown news digest method: {method}")
+        self.method = method
+        self.token_budget = token_budget
+        self.max_item_tokens = max_item_tokens
+        self.cache_dir = Path(cache_dir)
+        self.client = client
+
+    @property
+    def key(self) -> str:
+        return self._key(self.method)
+
+    def _key(self, method: str) -> str:
+        return f"{method}_{self.token_budget}_{self.max_item_tokens}"
+
+    def _path(self, source_hash: str, method: str) -> Path:
+        return self.cache_dir / f"news_digest_{source_hash[:16]}_{self._key(method)}.json"
+
+    def digest(self, news: str) -> str:
+        source_hash = hashlib.sha256(news.encode("utf-8")).hexdigest()
+        path = self._path(source_hash, self.method)
+        if path.exists():
+            stored = json.loads(path.read_text(encoding="utf-8"))
+            if stored.get("source_hash") == source_hash:
+                logger.info(f"Using news digest {path}")
+                return stored["digest"]
+
+        items = parse_news_items(news)
+        self._log_item_sizes(items)
+
+        text, kept = extractive_digest(items, self.token_budget, self.max_item_tokens)
+        method = self.method
+        if self.method == "llm":
+            if self.client is None:
+                raise ValueError("The llm news digest needs a client")
+            summary = llm_digest(items, self.token_budget, self.max_item_tokens, self.client)
+            if summary is not None:
+                text = summary
+                kept = {}
+            else:
+                # Stored as what it is, so the next run tries the model again
+                method = "extractive"
+                path = self._path(source_hash, method)
+                logger.warning(
+                    f"LLM news digest failed, using the extractive digest instead ({path})"
+                )
+
+        stored = {
+            "source_hash": source_hash,
+            "method": method,
+            "token_budget": self.token_budget,
+            "max_item_tokens": self.max_item_tokens,
+            "source_tokens": estimate_tokens(news),
+            "digest_tokens": estimate_tokens(text),
+            "items": [
+                {
+                    "monat": item.month,
+                    "rubrik": item.section,
+                    "titel": item.title,
+                    "tokens": item.tokens,
+                    "saetze": len(item.sentences),
+                    "saetze_im_digest": kept.get(item.position, 0),
+                }
+                for item in items
+            ],
+            "digest": text,
+        }
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(stored, ensure_ascii=False, indent=2), encoding="utf-8")
+        tmp_path.replace(path)
+        logger.info(
+            f"News digest ({method}): {stored['source_tokens']} -> "
+            f"{stored['digest_tokens']} tokens, stored in {path}"
+        )
+        return text
+
+    def _log_item_sizes(self, items: List[NewsItem]) -> None:
+        if not items:
+            logger.warning("No news items found")
+            return
+        sizes = np.array([item.tokens for item in items])
+        oversized = int((sizes > self.max_item_tokens).sum())
+        logger.info(
+            f"News items: {len(items)}, tokens per item median {int(np.median(sizes))}, "
+            f"max {int(sizes.max())}, {oversized} above {self.max_item_tokens}"
+        )
@@ -0,0 +1,110 @@
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional
+
+from step1_persona import WEIGHT_KEY, build_persona_prompts
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+LIBRARY_PATH = Path("Daten/Cache/persona_library.sqlite")
+
+# Keys per SELECT ... IN (...), below SQLite's variable limit
+LOOKUP_BATCH = 500
+
+
+def row_hash(gles_data: Dict) -> str:
+    # Stable over runs and row order: the respondent's answers only, the
+    # survey weight does not change the persona
+    row = {key: value for key, value in gles_data.items() if key != WEIGHT_KEY}
+    payload = json.dumps(row, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def settings_key(layout: str, backend: str, model: str = "gpt-4o", temperature: float = 0.7) -> str:
+    # Everything besides the row that shapes a persona: backend, model,
+    # temperature and the step 1 prompts (template, layout, news), taken
+    # from the prompts of an empty row
+    system_prompt, user_prompt = build_persona_prompts({}, layout=layout)
+    payload = json.dumps(
+        [backend, model, temperature, system_prompt, user_prompt], ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class PersonaLibrary:
+    # Personas from earlier runs in one SQLite file, keyed by (row hash,
+    # settings key). Entries are only ever inserted, the first persona for
+    # a key stays; WAL mode lets several pipeline processes add personas
+    # while others read. Lookups go through the primary key index, the
+    # library is never loaded as a whole.
+    def __init__(self, path: Path, settings: str, timeout: float = 30.0):
+        self.path = Path(path)
+        self.settings = settings
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+        self._lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), timeout=timeout, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS personas ("
+            "row_hash TEXT NOT NULL, settings TEXT NOT NULL, persona TEXT NOT NULL, "
+            "created REAL NOT NULL, PRIMARY KEY (row_hash, settings))"
+        )
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[Dict]:
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Dict]:
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), LOOKUP_BATCH):
+                batch = keys[start : start + LOOKUP_BATCH]
+                placeholders = ",".join("?" * len(batch))
+                for key, persona in self._conn.execute(
+                    f"SELECT row_hash, persona FROM personas "
+                    f"WHERE settings = ? AND row_hash IN ({placeholders})",
+                    [self.settings, *batch],
+                ):
+                    found[key] = json.loads(persona)
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def add(self, key: str, persona: Any) -> None:
+        serialized = json.dumps(persona, ensure_ascii=False)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO personas (row_hash, settings, persona, created) "
+                "VALUES (?, ?, ?, ?)",
+                (key, self.settings, serialized, time.time()),
+            )
+            self._conn.commit()
+            self.writes += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = self._conn.execute(
+                "SELECT COUNT(*) FROM personas WHERE settings = ?", (self.settings,)
+            ).fetchone()[0]
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "entries": entries,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
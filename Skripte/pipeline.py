@@ -1,17 +1,67 @@
+import asyncio
 import json
 import logging
+import os
 from pathlib import Path
-from typing import Dict, List, Optional
-import pandas as pd
+from itertools import islice
+from typing import Dict, Generator, Iterable, Iterator, Optional, Tuple
 from tqdm import tqdm
 import argparse
 
-from llm_client import get_default_client, OpenAIClient
-from step1_persona import step1_create_persona
-from step2_wahlomat import step2_wahlomat
-from step3_judge import step3_judge
-from step4_final_choice import step4_final_choice
+from llm_client import (
+    DEFAULT_MODEL,
+    DEFAULT_TEMPERATURE,
+    get_default_client,
+    get_default_async_client,
+    OpenAIClient,
+    AsyncOpenAIClient,
+)
+from stages import (
+    STAGES,
+    STAGE_DESCRIPTIONS,
+    build_result,
+    run_steps,
+    run_steps_async,
+    stage_steps,
+)
+from checkpoint_store import (
+    CheckpointStore,
+    default_checkpoint_path,
+    load_completed_ids,
+)
 from analysis import run_analysis
+from adaptive_sampling import run_adaptive
+from results_store import BACKENDS, export_results
+from response_cache import ResponseCache
+from context_store import ContextStore, configure_shared_context, get_shared_context
+from rate_limiter import AdaptiveRateLimiter, estimate_tokens
+from prompt_templates import PERSONA_FIRST, PROMPT_LAYOUTS
+from scheduler import StageScheduler, parse_stage_workers
+from call_metrics import MetricsRecorder, call_context, default_metrics_path
+from news_digest import NewsDigester, DIGEST_METHODS
+from batch_runner import OpenAIBatchBackend, LocalBatchBackend, run_batch_pipeline
+from wahlomat_matching import DeterministicJudge
+from stage_store import stage_key
+from persona_library import LOOKUP_BATCH, LIBRARY_PATH, PersonaLibrary, row_hash, settings_key
+from program_index import PROGRAM_TOKEN_BUDGET, PROGRAM_TOP_K
+from gles_reader import CHUNK_SIZE, iter_personas, parse_columns, parse_strata, sample_bounds
+from profiles import build_profiles, default_profiles_path, report_savings
+from work_queue import (
+    CLAIM_SIZE,
+    LEASE_SECONDS,
+    MAX_ATTEMPTS,
+    WorkQueue,
+    default_worker_id,
+    run_from_queue,
+)
+from result_writer import (
+    FLUSH_RECORDS,
+    FSYNC_INTERVAL,
+    ResultWriter,
+    merge_results,
+    result_paths,
+    shard_path,
+)
 
 # Configure logging
 logging.basicConfig(
@@ -20,43 +70,128 @@ logging.basicConfig(
 # Logger for pipeline with name of current file
 logger = logging.getLogger(__name__)
 
-def load_csv_data(csv_path: Path) -> List[Dict]:
+
+def known_length(personas: Iterable) -> Optional[int]:
+    # Progress bars get a total for lists, streamed personas just count up
+    return len(personas) if isinstance(personas, list) else None
+
+
+def persona_steps(
+    gles_data: Dict,
+    id: str,
+    layout: str = PERSONA_FIRST,
+    checkpoints: Optional[CheckpointStore] = None,
+    judge: Optional[DeterministicJudge] = None,
+    votes: int = 1,
+) -> Generator:
+    # All stages of one persona as stage steps (see stages.stage_steps),
+    # shared by the sync and async pipeline
     try:
-        df = pd.read_csv(csv_path)
-        logger.info(f"Loaded {len(df)} rows from {csv_path}")
-        return df.to_dict("records")
+        # Stages finished in an earlier run are taken from the checkpoints
+        outputs = checkpoints.get(id, gles_data) if checkpoints else {}
+
+        for stage in STAGES:
+            if stage in outputs:
+                continue
+
+            logger.info(f"{STAGE_DESCRIPTIONS[stage]} {id}")
+            with call_context(stage, id):
+                output = yield from stage_steps(
+                    stage, gles_data, outputs, layout, judge, votes
+                )
+            if output is None:
+                logger.error(f"{stage} failed for {id}, persona left incomplete")
+                return None
+
+            outputs[stage] = output
+            if checkpoints:
+                checkpoints.save(id, stage, output)
+
+        return build_result(id, outputs, gles_data)
+
     except Exception as e:
-        logger.error(f"Failed to load CSV: {e}")
-        return []
+        logger.error(f"Error processing {id}: {str(e)}", exc_info=True)
 
 
 def process_single_persona(
-    gles_data: Dict, id: str, client: OpenAIClient
+    gles_data: Dict,
+    id: str,
+    client: OpenAIClient,
+    layout: str = PERSONA_FIRST,
+    checkpoints: Optional[CheckpointStore] = None,
+    judge: Optional[DeterministicJudge] = None,
+    votes: int = 1,
 ) -> Optional[Dict]:
-    try:
+    return run_steps(
+        persona_steps(gles_data, id, layout, checkpoints, judge, votes), client
+    )
 
-        logger.info(f"Step 1: Creating persona {id}")
-        persona = step1_create_persona(gles_data, client)
 
-        logger.info(f"Step 2: Generating Wahlomat answers for {id}")
-        answers = step2_wahlomat(persona, client)
+async def process_single_persona_async(
+    gles_data: Dict,
+    id: str,
+    client: AsyncOpenAIClient,
+    layout: str = PERSONA_FIRST,
+    checkpoints: Optional[CheckpointStore] = None,
+    judge: Optional[DeterministicJudge] = None,
+    votes: int = 1,
+) -> Optional[Dict]:
+    return await run_steps_async(
+        persona_steps(gles_data, id, layout, checkpoints, judge, votes), client
+    )
 
-        logger.info(f"Step 3: Generating judge analysis for {id}")
-        analysis = step3_judge(persona, answers, client)
 
-        logger.info(f"Step 4: Generating final choice for {id}")
-        choice = step4_final_choice(persona, answers, analysis, client)
+async def run_concurrent(
+    personas: Iterable[Tuple[str, Dict]],
+    writer: ResultWriter,
+    client: AsyncOpenAIClient,
+    concurrency: int,
+    layout: str = PERSONA_FIRST,
+    checkpoints: Optional[CheckpointStore] = None,
+    judge: Optional[DeterministicJudge] = None,
+    votes: int = 1,
+) -> None:
+    # Keep at most `concurrency` personas in flight; results are written in
+    # completion order, each record still carries its own id. Personas are
+    # pulled from the iterator only when a slot frees up, so a streamed
+    # GLES file is never held in memory as a whole.
+    total = known_length(personas)
+    personas = iter(personas)
+    pending = set()
 
-        return {
-            "id": id,
-            "persona": persona,#.model_dump(),
-            "wahlomat_antworten": answers,#.model_dump(),
-            "judge_distribution": analysis,#.model_dump(),
-            "finale_entscheidung": choice,#.model_dump(),
-        }
+    with tqdm(total=total) as pbar:
+        while True:
+            for id, data in islice(personas, concurrency - len(pending)):
+                pending.add(
+                    asyncio.create_task(
+                        process_single_persona_async(
+                            data, id, client, layout, checkpoints, judge, votes
+                        )
+                    )
+                )
+            if not pending:
+                break
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for finished in done:
+                result = finished.result()
+                if result:
+                    writer.write(result)
+                pbar.update(1)
 
-    except Exception as e:
-        logger.error(f"Error processing {id}: {str(e)}", exc_info=True)
+
+async def run_staged(
+    personas: Iterable[Tuple[str, Dict]],
+    writer: ResultWriter,
+    scheduler: StageScheduler,
+) -> None:
+    # Stage-pipelined counterpart of run_concurrent
+    with tqdm(total=known_length(personas)) as pbar:
+
+        def on_result(result: Dict) -> None:
+            writer.write(result)
+            pbar.update(1)
+
+        await scheduler.run(personas, on_result)
 
 
 def pipeline():
@@ -68,50 +203,675 @@ def pipeline():
     parser.add_argument(
         "--output_path", default="Daten/Ergebnisse/pipeline_results.jsonl"
     )
+    parser.add_argument(
+        "--shard",
+        default=None,
+        help="Name of this worker; results, checkpoints and metrics go to its "
+        "own shard files, combined afterwards with --merge_results",
+    )
+    parser.add_argument(
+        "--work_queue",
+        default=None,
+        help="SQLite work queue on a shared volume; workers lease persona ids "
+        "from it and each writes its own result shard",
+    )
+    parser.add_argument(
+        "--worker_id",
+        default=None,
+        help="Worker name in the queue and shard name (default: host-pid)",
+    )
+    parser.add_argument("--lease_seconds", type=float, default=LEASE_SECONDS)
+    parser.add_argument(
+        "--claim_size", type=int, default=CLAIM_SIZE, help="Persona ids leased at once"
+    )
+    parser.add_argument(
+        "--max_attempts",
+        type=int,
+        default=MAX_ATTEMPTS,
+        help="Leases per persona before it is given up",
+    )
+    parser.add_argument(
+        "--queue_poll_interval",
+        type=float,
+        default=30.0,
+        help="Seconds to wait for leases of other workers to finish or expire",
+    )
+    parser.add_argument(
+        "--merge_results",
+        action="store_true",
+        default=False,
+        help="Merge the result shards into the results file, one record per id",
+    )
+    parser.add_argument(
+        "--write_flush_records",
+        type=int,
+        default=FLUSH_RECORDS,
+        help="Records written per flush at most",
+    )
+    parser.add_argument(
+        "--write_fsync_interval",
+        type=float,
+        default=FSYNC_INTERVAL,
+        help="Seconds between fsyncs of the results file",
+    )
+    parser.add_argument(
+        "--weight_column",
+        default=None,
+        help="GLES survey weight column, stored as gewicht in every result",
+    )
     parser.add_argument("--sample_start", type=int, default=0)
     parser.add_argument("--sample_end", type=int, default=0)
+    parser.add_argument(
+        "--gles_columns",
+        nargs="+",
+        default=None,
+        help="GLES columns passed to the personas (names, or one file with a "
+        "name per line); all other columns are not parsed",
+    )
+    parser.add_argument(
+        "--csv_chunk_size",
+        type=int,
+        default=CHUNK_SIZE,
+        help="GLES rows read per chunk",
+    )
+    parser.add_argument(
+        "--sample_size",
+        type=int,
+        default=None,
+        help="Seeded random sample of this many rows from sample_start..sample_end",
+    )
+    parser.add_argument(
+        "--strata",
+        nargs="+",
+        default=None,
+        help="Stratify the sample proportionally, e.g. bundesland geschlecht "
+        "alter:30,45,60 (numeric columns binned at the given edges)",
+    )
+    parser.add_argument("--sample_seed", type=int, default=None)
+    parser.add_argument(
+        "--dedup_profiles",
+        action="store_true",
+        default=False,
+        help="Run identical GLES rows once and weight the result by their number",
+    )
+    parser.add_argument(
+        "--profile_bins",
+        nargs="+",
+        default=None,
+        help="Group numeric columns into bands before deduplicating, e.g. alter:30,45,60",
+    )
+    parser.add_argument(
+        "--profile_repeats",
+        type=int,
+        default=1,
+        help="Runs per deduplicated profile, for diversity in the sampled personas",
+    )
     parser.add_argument("--run_analysis", action="store_true", default=False)
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="Number of personas processed at the same time (>1 uses asyncio)",
+    )
+    parser.add_argument(
+        "--prompt_layout",
+        choices=PROMPT_LAYOUTS,
+        default=PERSONA_FIRST,
+        help="context_first puts the static context first for prefix caching",
+    )
+    parser.add_argument(
+        "--rpm", type=int, default=None, help="Request budget per minute"
+    )
+    parser.add_argument(
+        "--tpm", type=int, default=None, help="Token budget per minute"
+    )
+    parser.add_argument(
+        "--cache_path", default=None, help="SQLite file for cached LLM responses"
+    )
+    parser.add_argument("--cache_read_only", action="store_true", default=False)
+    parser.add_argument("--cache_max_entries", type=int, default=None)
+    parser.add_argument("--cache_max_age_days", type=float, default=None)
+    parser.add_argument("--cache_max_mb", type=float, default=None)
+    parser.add_argument(
+        "--cache_sample_index",
+        type=int,
+        default=0,
+        help="Cache slot for repeated stochastic draws of the same prompt",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        default=False,
+        help="Skip IDs already in the results file, continue partial personas",
+    )
+    parser.add_argument(
+        "--checkpoint_path",
+        default=None,
+        help="Per-stage checkpoint log (default: next to the results file)",
+    )
+    parser.add_argument(
+        "--reuse_personas",
+        action="store_true",
+        default=False,
+        help="Take step 1 personas from the persona library, generate and add "
+        "only the missing ones",
+    )
+    parser.add_argument("--persona_library_path", default=str(LIBRARY_PATH))
+    parser.add_argument(
+        "--mode",
+        choices=("online", "batch"),
+        default="online",
+        help="batch submits one OpenAI Batch API job per stage",
+    )
+    parser.add_argument(
+        "--batch_dir",
+        default=None,
+        help="Working directory for batch input files (default: next to results)",
+    )
+    parser.add_argument("--batch_poll_interval", type=float, default=60.0)
+    parser.add_argument(
+        "--backend",
+        choices=("openai", "fake"),
+        default=None,
+        help="LLM backend (default: LLM_BACKEND env var or openai); "
+        "fake is configured through FAKE_LLM_* env vars",
+    )
+    parser.add_argument(
+        "--scheduler",
+        choices=("persona", "stage"),
+        default="persona",
+        help="stage runs one worker pool per step so steps overlap across personas",
+    )
+    parser.add_argument(
+        "--stage_workers",
+        default=None,
+        help="Workers per stage, e.g. persona=4,wahlomat=16,judge=8,final_choice=4 "
+        "(unset stages use --concurrency)",
+    )
+    parser.add_argument(
+        "--stage_queue_size",
+        type=int,
+        default=None,
+        help="Bound of each stage queue (default: twice the largest pool)",
+    )
+    parser.add_argument(
+        "--judge",
+        choices=("llm", "deterministic"),
+        default="llm",
+        help="deterministic scores step 3 with the official Wahl-O-Mat weighting "
+        "from the party positions instead of calling the model",
+    )
+    parser.add_argument(
+        "--final_choice_votes",
+        type=int,
+        default=1,
+        help="Decisions sampled per persona in step 4 (n completions of one "
+        "request); >1 stores a party distribution per persona",
+    )
+    parser.add_argument(
+        "--program_top_k",
+        type=int,
+        default=None,
+        help="Only put the top k programme passages per party and thesis "
+        "into the prompts (default: full programmes)",
+    )
+    parser.add_argument(
+        "--program_token_budget",
+        type=int,
+        default=None,
+        help="Token budget of the programme excerpts over all parties "
+        f"(default {PROGRAM_TOKEN_BUDGET}, 0 for none)",
+    )
+    parser.add_argument(
+        "--news_digest",
+        choices=DIGEST_METHODS,
+        default=None,
+        help="Replace the raw news by a digest built once per news file",
+    )
+    parser.add_argument("--news_token_budget", type=int, default=2000)
+    parser.add_argument(
+        "--news_max_item_tokens",
+        type=int,
+        default=150,
+        help="Upper bound per news item inside the digest",
+    )
+    parser.add_argument(
+        "--metrics_path",
+        default=None,
+        help="Per-call token/latency/cost log (default: next to the results file)",
+    )
+    parser.add_argument(
+        "--prometheus_path",
+        default=None,
+        help="Optional Prometheus textfile with the per-stage totals",
+    )
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        default=False,
+        help="Draw personas in random batches until every party's vote share "
+        "CI half-width is below --target_ci_half_width or a budget is used up",
+    )
+    parser.add_argument(
+        "--target_ci_half_width", type=float, default=1.0, help="In percentage points"
+    )
+    parser.add_argument("--adaptive_batch_size", type=int, default=50)
+    parser.add_argument(
+        "--adaptive_min_personas",
+        type=int,
+        default=100,
+        help="No early stop before this many results",
+    )
+    parser.add_argument("--max_personas", type=int, default=None)
+    parser.add_argument("--max_cost_usd", type=float, default=None)
+    parser.add_argument("--adaptive_seed", type=int, default=None)
+    parser.add_argument(
+        "--bootstrap_replicates",
+        type=int,
+        default=2000,
+        help="Bootstrap replicates for the vote share confidence intervals",
+    )
+    parser.add_argument("--bootstrap_seed", type=int, default=None)
+    parser.add_argument(
+        "--export_columns",
+        choices=BACKENDS,
+        default=None,
+        help="Write a columnar copy of the results (Parquet if pyarrow is "
+        "installed, else .npy columns) that the analysis reads instead",
+    )
     args = parser.parse_args()
 
     # Setup variables and paths
     output_path = Path(args.output_path)
     output_dir = output_path.parent
+    if args.work_queue:
+        if args.adaptive:
+            parser.error("--work_queue cannot be combined with --adaptive")
+        # Every node writes its own shard
+        args.worker_id = args.worker_id or args.shard or default_worker_id()
+        args.shard = args.shard or args.worker_id
+
+    # File this process appends to
+    write_path = shard_path(output_path, args.shard) if args.shard else output_path
 
     if args.run_pipeline:
-        # Load data
-        gles_data = load_csv_data(Path(args.csv_path))
+        # GLES rows are streamed in chunks within the sample bounds, only
+        # the configured columns parsed; a sample is drawn in the same pass
+        start, end = sample_bounds(args.sample_start, args.sample_end)
+        if args.strata and args.sample_size is None:
+            parser.error("--strata needs --sample_size")
+        personas: Iterable[Tuple[str, Dict]] = iter_personas(
+            Path(args.csv_path),
+            columns=parse_columns(args.gles_columns),
+            weight_column=args.weight_column,
+            start=start,
+            end=end,
+            sample_size=args.sample_size,
+            strata=parse_strata(args.strata),
+            seed=args.sample_seed,
+            chunk_size=args.csv_chunk_size,
+        )
+        if args.sample_size is not None or args.adaptive or args.mode == "batch" or args.work_queue:
+            # Samples are small, adaptive runs draw from all personas at
+            # random, batch runs write one request file for all of them and
+            # queue workers look up the ids they lease
+            personas = list(personas)
+
+        if args.dedup_profiles:
+            # One run (or --profile_repeats runs) per distinct profile, its
+            # weight standing for all GLES rows with that profile
+            if args.gles_columns is None:
+                logger.warning(
+                    "--dedup_profiles without --gles_columns: profiles are compared on "
+                    "all columns, an id or timestamp column makes every row unique"
+                )
+            personas, profiles = build_profiles(
+                personas, parse_strata(args.profile_bins), args.profile_repeats
+            )
+            calls_per_persona = len(STAGES) - (1 if args.judge == "deterministic" else 0)
+            report_savings(profiles, calls_per_persona, default_profiles_path(write_path))
+
+        # Every finished stage is checkpointed so a crash can be resumed
+        checkpoints = CheckpointStore(
+            Path(args.checkpoint_path)
+            if args.checkpoint_path
+            else default_checkpoint_path(write_path)
+        )
+        completed = set()
+        if args.resume:
+            # Done by any worker, in the results file or one of the shards
+            completed = set().union(
+                *(load_completed_ids(path) for path in result_paths(output_path))
+            )
+            if isinstance(personas, list):
+                personas = [(id, data) for id, data in personas if id not in completed]
+            else:
+                personas = ((id, data) for id, data in personas if id not in completed)
+            checkpoints.load(completed)
+            logger.info(f"Resuming: {len(completed)} personas already done")
+        else:
+            checkpoints.reset()
+
+        # One record per LLM call: stage, persona, tokens, latency, attempts
+        metrics = MetricsRecorder(
+            Path(args.metrics_path) if args.metrics_path else default_metrics_path(write_path),
+            prometheus_path=Path(args.prometheus_path) if args.prometheus_path else None,
+        )
+
+        # Programme retrieval and the news digest are the same for every
+        # persona, so they are built once here as part of the shared context
+        context_settings = {}
+        if args.program_top_k or args.program_token_budget:
+            context_settings["program_top_k"] = args.program_top_k or PROGRAM_TOP_K
+            context_settings["program_token_budget"] = args.program_token_budget
+        if args.news_digest:
+            context_settings["news_digester"] = NewsDigester(
+                method=args.news_digest,
+                token_budget=args.news_token_budget,
+                max_item_tokens=args.news_max_item_tokens,
+                client=(
+                    get_default_client(backend=args.backend, metrics=metrics)
+                    if args.news_digest == "llm"
+                    else None
+                ),
+            )
+        if context_settings:
+            configure_shared_context(**context_settings)
 
-        # Apply sample size if specified
-        if args.sample_start >= 0 and args.sample_end >= 0:
-            end = min(args.sample_end, len(gles_data))
-            gles_data = gles_data[args.sample_start : end]
+        # Load news, party programs and questions once for all personas
+        context = get_shared_context()
+        logger.info(f"Shared context {context.content_hash[:12]}")
+
+        if args.program_top_k or args.program_token_budget:
+            # Steps 2-4 carry the programmes, step 3 only with the LLM judge
+            prompts_per_persona = 3 if args.judge == "llm" else 2
+            before = estimate_tokens(ContextStore().get().party_programs)
+            after = estimate_tokens(context.party_programs)
             logger.info(
-                f"Using {args.sample_start} to {end} ({len(gles_data)}) personas"
+                f"Programme excerpts: {before} -> {after} tokens per prompt, "
+                f"{before * prompts_per_persona} -> {after * prompts_per_persona} per persona"
+            )
+
+        # Step 3 without a model call, scored from the Wahl-O-Mat positions
+        judge = DeterministicJudge(context) if args.judge == "deterministic" else None
+
+        # Checkpoints are only reused while the inputs of their stage (GLES
+        # row, prompts with templates and context, settings) are unchanged
+        checkpoint_settings = {
+            "backend": args.backend or os.getenv("LLM_BACKEND", "openai"),
+            "model": DEFAULT_MODEL,
+            "temperature": DEFAULT_TEMPERATURE,
+        }
+        checkpoints.key_fn = lambda stage, gles_data, outputs: stage_key(
+            stage,
+            gles_data,
+            outputs,
+            (
+                dict(checkpoint_settings, votes=args.final_choice_votes)
+                if stage == "final_choice"
+                else checkpoint_settings
+            ),
+            args.prompt_layout,
+            judge,
+        )
+
+        # Personas of GLES rows seen in earlier runs with the same step 1
+        # settings are reused; new ones are added as soon as they exist
+        library = None
+        if args.reuse_personas:
+            library = PersonaLibrary(
+                Path(args.persona_library_path),
+                settings_key(
+                    args.prompt_layout, args.backend or os.getenv("LLM_BACKEND", "openai")
+                ),
+            )
+            # Row hashes of personas still to be generated, until saved
+            row_hashes: Dict[str, str] = {}
+
+            def with_known_personas(
+                personas: Iterable[Tuple[str, Dict]],
+            ) -> Iterator[Tuple[str, Dict]]:
+                # Looked up in batches as the personas stream past
+                personas = iter(personas)
+                while True:
+                    batch = list(islice(personas, LOOKUP_BATCH))
+                    if not batch:
+                        return
+                    hashes = {id: row_hash(data) for id, data in batch}
+                    known = library.get_many(hashes.values())
+                    for id, key in hashes.items():
+                        if key in known:
+                            checkpoints.preload(id, "persona", known[key])
+                        else:
+                            row_hashes[id] = key
+                    yield from batch
+
+            def add_to_library(id: str, stage: str, output) -> None:
+                if stage == "persona" and id in row_hashes:
+                    library.add(row_hashes.pop(id), output)
+
+            checkpoints.on_save = add_to_library
+            if isinstance(personas, list):
+                personas = list(with_known_personas(personas))
+            else:
+                personas = with_known_personas(personas)
+
+        # Requests in flight: one per persona, or one per stage worker
+        max_in_flight = args.concurrency
+        stage_workers = None
+        if args.scheduler == "stage":
+            stage_workers = parse_stage_workers(args.stage_workers, args.concurrency)
+            max_in_flight = sum(stage_workers.values())
+
+        # Shared rate control, adapts concurrency to the provider's limits
+        rate_limiter = None
+        if max_in_flight > 1 or args.rpm or args.tpm:
+            rate_limiter = AdaptiveRateLimiter(
+                requests_per_minute=args.rpm,
+                tokens_per_minute=args.tpm,
+                max_concurrency=max_in_flight,
+            )
+
+        # Optional persistent response cache
+        cache = None
+        if args.cache_path:
+            cache = ResponseCache(
+                Path(args.cache_path),
+                max_entries=args.cache_max_entries,
+                max_age_seconds=(
+                    args.cache_max_age_days * 86400
+                    if args.cache_max_age_days is not None
+                    else None
+                ),
+                max_bytes=(
+                    int(args.cache_max_mb * 1024 * 1024)
+                    if args.cache_max_mb is not None
+                    else None
+                ),
+                read_only=args.cache_read_only,
+                sample_index=args.cache_sample_index,
             )
+
+        # Client or batch backend for the chosen mode, then one function
+        # that processes a list of personas with it. Async clients are made
+        # per call, their connection pool belongs to that call's event loop.
+        client = None
+        if args.mode == "batch":
+            # Offline run through the Batch API, no interactive client needed
+            batch_dir = Path(args.batch_dir) if args.batch_dir else output_dir / "batch"
+            if (args.backend or os.getenv("LLM_BACKEND", "openai")) == "fake":
+                from fake_llm import FakeLLM, FakeLLMConfig
+                backend = LocalBatchBackend(
+                    batch_dir / "fake_backend", FakeLLM(FakeLLMConfig.from_env()).complete
+                )
+            else:
+                backend = OpenAIBatchBackend()
+        elif args.scheduler == "stage" or args.concurrency > 1:
+            pass
         else:
-            logger.info(f"Using all {len(gles_data)} personas!")
+            # Initialize client
+            client = get_default_client(
+                rate_limiter=rate_limiter,
+                cache=cache,
+                backend=args.backend,
+                metrics=metrics,
+            )
 
-        # Initialize client
-        client = get_default_client()
+        # Shared work queue of a multi-node run
+        queue = None
+        if args.work_queue:
+            queue = WorkQueue(
+                Path(args.work_queue),
+                worker=args.worker_id,
+                lease_seconds=args.lease_seconds,
+                max_attempts=args.max_attempts,
+            )
 
-        # Process each persona individually
-        with tqdm(total=len(gles_data)) as pbar:
-            for i, data in enumerate(gles_data):
-                # Process single persona
-                result = process_single_persona(data, f"{i+1}", client)
+        def record_written(id: str) -> None:
+            # A flushed record frees its checkpoints and finishes its lease
+            checkpoints.complete(id)
+            if queue is not None:
+                queue.complete(id)
 
-                if result:
-                    # Append result to file
-                    with open(output_path, "a", encoding="utf-8") as f:
-                        f.write(json.dumps(result, ensure_ascii=False) + "\n")
+        def run_personas(personas: Iterable[Tuple[str, Dict]]) -> None:
+            client_used = client
+            if args.mode != "batch" and (args.scheduler == "stage" or args.concurrency > 1):
+                client_used = get_default_async_client(
+                    rate_limiter=rate_limiter,
+                    cache=cache,
+                    backend=args.backend,
+                    metrics=metrics,
+                )
+            # One writer thread per run appends to the results file (or this
+            # worker's shard); finished records free their checkpoints
+            with ResultWriter(
+                write_path,
+                on_written=record_written,
+                flush_records=args.write_flush_records,
+                fsync_interval=args.write_fsync_interval,
+            ) as writer:
+                if args.mode == "batch":
+                    run_batch_pipeline(
+                        personas,
+                        writer,
+                        backend,
+                        batch_dir,
+                        layout=args.prompt_layout,
+                        checkpoints=checkpoints,
+                        poll_interval=args.batch_poll_interval,
+                        judge=judge,
+                        metrics=metrics,
+                        votes=args.final_choice_votes,
+                    )
+                elif args.scheduler == "stage":
+                    # One queue and worker pool per step
+                    logger.info(f"Running stage scheduler with workers {stage_workers}")
+                    scheduler = StageScheduler(
+                        client_used,
+                        stage_workers,
+                        queue_size=args.stage_queue_size,
+                        layout=args.prompt_layout,
+                        checkpoints=checkpoints,
+                        judge=judge,
+                        votes=args.final_choice_votes,
+                    )
+                    asyncio.run(run_staged(personas, writer, scheduler))
+                elif args.concurrency > 1:
+                    # Process several personas concurrently
+                    logger.info(f"Running with {args.concurrency} personas in flight")
+                    asyncio.run(
+                        run_concurrent(
+                            personas,
+                            writer,
+                            client_used,
+                            args.concurrency,
+                            args.prompt_layout,
+                            checkpoints,
+                            judge,
+                            args.final_choice_votes,
+                        )
+                    )
+                else:
+                    # Process each persona individually
+                    with tqdm(total=known_length(personas)) as pbar:
+                        for id, data in personas:
+                            # Process single persona
+                            result = process_single_persona(
+                                data, id, client, args.prompt_layout, checkpoints, judge,
+                                args.final_choice_votes,
+                            )
 
-                # Update progress bar
-                pbar.update(1)
+                            if result:
+                                # Hand the result to the writer
+                                writer.write(result)
+
+                            # Update progress bar
+                            pbar.update(1)
+
+            logger.info(f"Result writer: {writer.stats()}")
+            # Flushed personas no longer need their checkpoints
+            checkpoints.compact()
+            if client_used is not None:
+                logger.info(f"Token usage: {client_used.usage_stats()}")
+
+        if args.adaptive:
+            # Random batches until the vote share intervals are narrow enough
+            run_adaptive(
+                personas,
+                run_personas,
+                write_path,
+                target_half_width=args.target_ci_half_width,
+                batch_size=args.adaptive_batch_size,
+                min_personas=args.adaptive_min_personas,
+                max_personas=args.max_personas,
+                max_cost_usd=args.max_cost_usd,
+                metrics=metrics,
+                replicates=args.bootstrap_replicates,
+                seed=args.adaptive_seed,
+                done_ids=completed,
+            )
+        elif queue is not None:
+            # Lease ids until every persona is done or given up
+            run_from_queue(
+                personas,
+                run_personas,
+                queue,
+                claim_size=args.claim_size,
+                poll_interval=args.queue_poll_interval,
+            )
+        else:
+            run_personas(personas)
+
+        if rate_limiter is not None:
+            logger.info(f"Rate limiter: {rate_limiter.stats()}")
+        if cache is not None:
+            logger.info(f"Response cache: {cache.stats()}")
+            cache.close()
+        if library is not None:
+            logger.info(f"Persona library: {library.stats()}")
+            library.close()
+        logger.info(f"Call metrics: {json.dumps(metrics.summary(), ensure_ascii=False)}")
+        metrics.close()
+
+    # Shards of all workers into the results file
+    if args.merge_results:
+        merge_results(output_path)
+    elif (args.run_analysis or args.export_columns) and len(result_paths(output_path)) > 1:
+        logger.warning(f"Unmerged result shards next to {output_path}, see --merge_results")
+
+    # Columnar export for the analysis
+    if args.export_columns:
+        export_results(output_path, backend=args.export_columns)
 
     # Run analysis if requested
     if args.run_analysis:
         logger.info("Running analysis...")
-        run_analysis(results_path=str(output_path), output_dir=str(output_dir))
+        run_analysis(
+            results_path=str(output_path),
+            output_dir=str(output_dir),
+            replicates=args.bootstrap_replicates,
+            seed=args.bootstrap_seed,
+        )
 
 
 if __name__ == "__main__":
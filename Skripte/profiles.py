@@ -0,0 +1,121 @@
+import json
+import math
+import logging
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from step1_persona import REPEAT_KEY, WEIGHT_KEY
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def default_profiles_path(output_path: Path) -> Path:
+    # pipeline_results.jsonl -> pipeline_results.profiles.json
+    return output_path.with_name(f"{output_path.stem}.profiles.json")
+
+
+def band_label(value: Any, edges: List[float]) -> Any:
+    # Numeric value -> its band, e.g. "30 bis unter 45"; missing or
+    # non-numeric values stay as they are
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return value
+    if math.isnan(number):
+        return value
+    if number < edges[0]:
+        return f"unter {edges[0]:g}"
+    for lower, upper in zip(edges, edges[1:]):
+        if number < upper:
+            return f"{lower:g} bis unter {upper:g}"
+    return f"ab {edges[-1]:g}"
+
+
+def canonical_profile(
+    gles_data: Dict, bins: Optional[List[Tuple[str, Optional[List[float]]]]] = None
+) -> Dict:
+    # What the persona prompt sees: the row without its weight, binned
+    # columns replaced by their band
+    profile = {key: value for key, value in gles_data.items() if key != WEIGHT_KEY}
+    for name, edges in bins or ():
+        if edges and name in profile:
+            profile[name] = band_label(profile[name], edges)
+    return profile
+
+
+def build_profiles(
+    personas: Iterable[Tuple[str, Dict]],
+    bins: Optional[List[Tuple[str, Optional[List[float]]]]] = None,
+    repeats: int = 1,
+) -> Tuple[List[Tuple[str, Dict]], Dict[str, Any]]:
+    # Groups identical rows into one profile, run `repeats` times for
+    # diversity. Each run carries the summed survey weight of its rows
+    # divided by the repeats, so the weighted results stand for all rows.
+    groups: Dict[str, Dict[str, Any]] = {}
+    rows = 0
+    for id, data in personas:
+        rows += 1
+        profile = canonical_profile(data, bins)
+        key = json.dumps(profile, ensure_ascii=False, sort_keys=True, default=str)
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = {"profil": profile, "ids": [], "gewicht": 0.0}
+        group["ids"].append(id)
+        weight = data.get(WEIGHT_KEY)
+        group["gewicht"] += 1.0 if weight is None else float(weight)
+
+    runs = []
+    members = {}
+    for number, group in enumerate(groups.values(), start=1):
+        name = f"p{number}"
+        members[name] = group["ids"]
+        for repeat in range(repeats):
+            data = dict(group["profil"])
+            data[WEIGHT_KEY] = group["gewicht"] / repeats
+            if repeat > 0:
+                # The first run shares its cache entries with an undeduplicated run
+                data[REPEAT_KEY] = repeat
+            runs.append((name if repeats == 1 else f"{name}-{repeat + 1}", data))
+
+    if rows > 1 and len(groups) == rows:
+        # Typically a respondent id or timestamp column in the rows
+        logger.warning(
+            f"All {rows} rows are distinct profiles, deduplication saves nothing; "
+            "project the columns the personas need with --gles_columns"
+        )
+
+    summary = {
+        "zeilen": rows,
+        "profile": len(groups),
+        "wiederholungen": repeats,
+        "laeufe": len(runs),
+        "mitglieder": members,
+    }
+    return runs, summary
+
+
+def report_savings(
+    summary: Dict[str, Any], calls_per_persona: int, path: Optional[Path] = None
+) -> Dict[str, Any]:
+    # LLM calls with and without deduplication; written next to the
+    # results with the profile -> GLES row ids mapping
+    before = summary["zeilen"] * calls_per_persona
+    after = summary["laeufe"] * calls_per_persona
+    summary = dict(
+        summary,
+        llm_aufrufe_ohne=before,
+        llm_aufrufe_mit=after,
+        ersparnis_prozent=round(100 * (1 - after / before), 1) if before else 0.0,
+    )
+    logger.info(
+        f"Profiles: {summary['zeilen']} rows -> {summary['profile']} profiles x "
+        f"{summary['wiederholungen']} = {summary['laeufe']} runs, LLM calls "
+        f"{before} -> {after} ({summary['ersparnis_prozent']}% fewer)"
+    )
+    if path is not None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+    return summary
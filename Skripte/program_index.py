@@ -0,0 +1,220 @@
+import re
+import json
+import math
+import logging
+import argparse
+from collections import Counter
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from rate_limiter import estimate_tokens
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Long sections are split at sentence boundaries into passages of about
+# this size, so a single thesis does not pull in a whole policy area
+MAX_PASSAGE_CHARS = 700
+
+# Programme tokens over all parties when no budget is given; top k alone
+# keeps most passages, since every thesis pulls in different ones
+PROGRAM_TOKEN_BUDGET = 3000
+
+# Passages per party and thesis when only a token budget is given
+PROGRAM_TOP_K = 3
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+STOPWORDS = set(
+    "der die das den dem des ein eine einen einem einer eines und oder aber "
+    "nicht kein keine soll sollen sollte will wollen wird werden wurde ist sind "
+    "sein war auch mit von für auf aus bei nach vor zu zum zur im in an am als "
+    "wie so dass es sich sie er wir ihr man mehr noch nur wieder durch über "
+    "unter gegen um alle allen bis ab hat haben dies diese dieser diesem".split()
+)
+SUFFIXES = ("ungen", "ung", "en", "er", "es", "e", "n", "s")
+
+
+@dataclass(frozen=True)
+class Passage:
+    party: str
+    position: int
+    text: str
+
+
+def tokenize(text: str) -> List[str]:
+    # Lowercase words without stopwords and with a light German suffix
+    # stripping, enough to match "Steuer"/"Steuern" or "Energien"/"Energie"
+    tokens = []
+    for word in re.findall(r"\w+", text.lower()):
+        if word in STOPWORDS or len(word) < 3 or word.isdigit():
+            continue
+        for suffix in SUFFIXES:
+            if len(word) - len(suffix) >= 4 and word.endswith(suffix):
+                word = word[: -len(suffix)]
+                break
+        tokens.append(word)
+    return tokens
+
+
+def _split_sentences(paragraph: str, max_chars: int) -> List[str]:
+    # Keeps the bold section label ("**Energie und Klima:**") in front of
+    # every piece so passages stay understandable on their own
+    label = ""
+    match = re.match(r"^(- )?(\*\*[^*]+:\*\*)\s*", paragraph)
+    if match:
+        label = match.group(2) + " "
+        paragraph = paragraph[match.end():]
+    pieces, current = [], ""
+    for sentence in re.split(r"(?<=[.!?“”])\s+(?=[A-ZÄÖÜ„_*])", paragraph):
+        if current and len(current) + len(sentence) > max_chars:
+            pieces.append(current)
+            current = ""
+        current = f"{current} {sentence}".strip()
+    if current:
+        pieces.append(current)
+    return [f"- {label}{piece}" if label else piece for piece in pieces]
+
+
+def chunk_program(party: str, text: str, max_chars: int = MAX_PASSAGE_CHARS) -> List[Passage]:
+    # Sections are the programme's paragraphs and bullet points
+    passages = []
+    for paragraph in text.split("\n"):
+        paragraph = paragraph.strip()
+        if not paragraph or paragraph.startswith("#"):
+            continue
+        for piece in _split_sentences(paragraph, max_chars):
+            passages.append(Passage(party, len(passages), piece))
+    return passages
+
+
+def program_heading(text: str) -> str:
+    for line in text.split("\n"):
+        if line.strip().startswith("#"):
+            return line.strip()
+    return ""
+
+
+class ProgramIndex:
+    # BM25 over the passages of all programmes; document frequencies are
+    # shared across parties, scoring can be restricted to one party
+    def __init__(self, passages: Sequence[Passage]):
+        self.passages = list(passages)
+        self._tokens = [Counter(tokenize(p.text)) for p in self.passages]
+        self._lengths = np.array([sum(c.values()) for c in self._tokens], dtype=float)
+        self._avg_length = float(self._lengths.mean()) if len(self._lengths) else 0.0
+        document_frequency = Counter()
+        for counts in self._tokens:
+            document_frequency.update(counts.keys())
+        n = len(self.passages)
+        self._idf = {
+            term: math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for term, df in document_frequency.items()
+        }
+        self._party = np.array([p.party for p in self.passages])
+
+    def scores(self, query: str) -> np.ndarray:
+        scores = np.zeros(len(self.passages))
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths / max(self._avg_length, 1e-9))
+        for term in set(tokenize(query)):
+            idf = self._idf.get(term)
+            if idf is None:
+                continue
+            tf = np.array([counts.get(term, 0) for counts in self._tokens], dtype=float)
+            scores += idf * tf * (BM25_K1 + 1) / (tf + norm)
+        return scores
+
+    def top_k(self, query: str, party: str, k: int) -> List[int]:
+        scores = self.scores(query)
+        candidates = np.flatnonzero((self._party == party) & (scores > 0))
+        ranked = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return ranked[:k].tolist()
+
+
+def build_program_excerpts(
+    parties: Sequence[str],
+    program_texts: Sequence[str],
+    questions: Sequence[Dict],
+    top_k: int = 3,
+    token_budget: Optional[int] = None,
+) -> str:
+    # Replaces the full programmes in the prompts: per party the passages
+    # that rank in the top k for at least one thesis, in programme order.
+    # Over the budget (PROGRAM_TOKEN_BUDGET unless given, 0 for none),
+    # passages that rank lower are dropped first.
+    passages = []
+    headings = {}
+    for party, text in zip(parties, program_texts):
+        headings[party] = program_heading(text)
+        passages.extend(chunk_program(party, text))
+    index = ProgramIndex(passages)
+
+    # Best rank of every passage over all theses
+    best_rank: Dict[int, int] = {}
+    for question in questions:
+        for party in parties:
+            for rank, passage in enumerate(index.top_k(question["text"], party, top_k)):
+                best_rank[passage] = min(rank, best_rank.get(passage, rank))
+
+    if token_budget is None:
+        token_budget = PROGRAM_TOKEN_BUDGET
+    party_budget = token_budget / max(len(parties), 1) if token_budget else None
+    sections = []
+    for party in parties:
+        selected = sorted(
+            (i for i in best_rank if passages[i].party == party),
+            key=lambda i: (best_rank[i], passages[i].position),
+        )
+        if party_budget is not None:
+            kept, used = [], estimate_tokens(headings[party])
+            for i in selected:
+                cost = estimate_tokens(passages[i].text)
+                if used + cost > party_budget:
+                    continue
+                kept.append(i)
+                used += cost
+            selected = kept
+        lines = [headings[party]] if headings[party] else []
+        lines.extend(passages[i].text for i in sorted(selected, key=lambda i: passages[i].position))
+        sections.append("\n".join(lines))
+    return "\n\n".join(sections)
+
+
+def main():
+    # Offline check of the retrieval: prints the excerpts and the prompt
+    # tokens of the programme section before and after
+    from context_store import ContextStore
+
+    parser = argparse.ArgumentParser(description="Party programme retrieval report")
+    parser.add_argument("--top_k", type=int, default=PROGRAM_TOP_K)
+    parser.add_argument(
+        "--token_budget",
+        type=int,
+        default=None,
+        help=f"Programme tokens over all parties (default {PROGRAM_TOKEN_BUDGET}, 0 for none)",
+    )
+    parser.add_argument("--show", action="store_true", default=False)
+    args = parser.parse_args()
+
+    full = ContextStore().get()
+    retrieved = ContextStore(
+        program_top_k=args.top_k, program_token_budget=args.token_budget
+    ).get()
+    before = estimate_tokens(full.party_programs)
+    after = estimate_tokens(retrieved.party_programs)
+    print(json.dumps({
+        "program_tokens_before": before,
+        "program_tokens_after": after,
+        "reduction": round(1 - after / before, 3) if before else 0.0,
+    }, indent=2))
+    if args.show:
+        print(retrieved.party_programs)
+
+
+if __name__ == "__main__":
+    main()
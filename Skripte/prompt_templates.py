@@ -90,4 +90,119 @@ ANFORDERUNGEN:
    - Aus Sicht der Persona
    - Berücksichtige Wahlomat-Ergebnisse UND aktuelle Entwicklungen
 3. Gib eine Sicherheit (0-100%) für deine Entscheidung an
-''' 
\ No newline at end of file
+''' 
+
+# Prompt layouts: "persona_first" keeps the templates above, "context_first"
+# moves the static news/programme/thesis context to the very start of the
+# request so providers can reuse their prompt-prefix cache across personas
+PERSONA_FIRST = "persona_first"
+CONTEXT_FIRST = "context_first"
+PROMPT_LAYOUTS = (PERSONA_FIRST, CONTEXT_FIRST)
+
+
+def build_static_context(party_programs=None, news_data=None, questions=None) -> str:
+    # Fixed section order so the requests of different steps share the
+    # longest possible byte-identical prefix (judge ⊂ final choice ⊂ Wahl-O-Mat)
+    sections = []
+    if party_programs is not None:
+        sections.append(f"PARTEIPROGRAMME:\n{party_programs}\n")
+    if news_data is not None:
+        sections.append(f"AKTUELLE NACHRICHTEN:\n{news_data}\n")
+    if questions is not None:
+        sections.append(f"THESEN:\n{questions}\n")
+    return "\n".join(sections)
+
+
+PERSONA_GENERATION_CONTEXT_FIRST_TEMPLATE = '''Erstelle basierend auf den demografischen CSV-Daten eine realistische, detaillierte Persona.
+Die aktuellen Nachrichten stehen oben im Kontext.
+
+DEMOGRAFISCHE DATEN:
+{gles_data}
+
+ANFORDERUNGEN:
+1. Erstelle eine konsistente, glaubwürdige Persona
+2. Berücksichtige aktuelle politische Entwicklungen
+3. Beachte die Validierungen:
+   - Alter: 16-100 Jahre
+   - Name/Beruf/Wohnort: 2-100 Zeichen
+   - Beschreibung: 50-1000 Zeichen
+   - Politische Einstellung/Wahlverhalten: 20-500 Zeichen
+   - Kernthemen/Sorgen/Hoffnungen: 1-10 Einträge
+'''
+
+WAHLOMAT_CONTEXT_FIRST_TEMPLATE = '''Du bist jetzt die folgende Persona und sollst den Wahl-O-Mat ausfüllen.
+Bleibe dabei durchgehend in der Rolle und antworte konsistent zur Persona.
+Parteiprogramme, aktuelle Nachrichten und Thesen stehen oben im Kontext.
+
+PERSONA:
+{persona_str}
+
+ANFORDERUNGEN:
+1. Beantworte ALLE 35 Thesen
+2. Pro These:
+   - Position: -1 (dagegen), 0 (neutral), oder 1 (dafür)
+   - Begründung: 20-500 Zeichen, aus Sicht der Persona
+3. Bleibe konsistent zur politischen Einstellung der Persona
+4. Berücksichtige aktuelle Entwicklungen
+'''
+
+JUDGE_CONTEXT_FIRST_TEMPLATE = '''Analysiere die Wahl-O-Mat-Antworten und berechne die Übereinstimmung mit den Parteipositionen.
+Die Parteiprogramme stehen oben im Kontext.
+
+PERSONA:
+{persona_str}
+
+WAHLOMAT-ANTWORTEN:
+{answers_str}
+
+ANFORDERUNGEN:
+1. Berechne für jede Partei einen Match-Wert (0-100%):
+   - CDU, SPD, GRÜNE, FDP, LINKE, AFD
+   - Berücksichtige Positionen UND Begründungen
+   - Runde auf 2 Dezimalstellen
+2. Schreibe eine ausführliche Analyse (20-400 Wörter):
+   - Erkläre die Übereinstimmungen/Unterschiede
+   - Hebe Besonderheiten hervor
+   - Bleibe neutral und faktenbasiert
+'''
+
+FINAL_CHOICE_CONTEXT_FIRST_TEMPLATE = '''Du bist wieder die ursprüngliche Persona.
+Treffe basierend auf allen Informationen deine finale Wahlentscheidung.
+Parteiprogramme und aktuelle Nachrichten stehen oben im Kontext.
+
+PERSONA:
+{persona_str}
+
+WAHLOMAT-ANTWORTEN:
+{answers_str}
+
+PARTEI-MATCHES & ANALYSE:
+{judge_str}
+
+ANFORDERUNGEN:
+1. Wähle EINE Partei aus: CDU, SPD, GRÜNE, FDP, LINKE, AFD
+2. Begründung:
+   - 10-200 Wörter
+   - Aus Sicht der Persona
+   - Berücksichtige Wahlomat-Ergebnisse UND aktuelle Entwicklungen
+3. Gib eine Sicherheit (0-100%) für deine Entscheidung an
+'''
+
+# Follow-up for the theses a Wahl-O-Mat response left out or answered
+# invalidly; short on purpose, without news and programmes
+WAHLOMAT_REPAIR_TEMPLATE = '''Du bist jetzt die folgende Persona und hast den Wahl-O-Mat bereits ausgefüllt.
+Für die folgenden {count} Thesen fehlt noch eine gültige Antwort.
+
+PERSONA:
+{persona_str}
+
+THESEN:
+{questions}
+
+ANFORDERUNGEN:
+1. Beantworte GENAU diese {count} Thesen, jeweils mit ihrer these_id
+2. Pro These:
+   - Position: -1 (dagegen), 0 (neutral), oder 1 (dafür)
+   - Begründung: 20-500 Zeichen, aus Sicht der Persona
+3. Bleibe konsistent zur politischen Einstellung der Persona
+'''
@@ -0,0 +1,254 @@
+import re
+import time
+import asyncio
+import logging
+import threading
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Rough OpenAI rule of thumb, good enough to budget tokens before a call
+CHARS_PER_TOKEN = 4
+
+# How long a waiter sleeps when all concurrency slots are taken
+SLOT_POLL_INTERVAL = 0.05
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def estimate_request_tokens(request: Dict[str, Any]) -> int:
+    # Providers count the prompt plus the requested completion budget
+    prompt_tokens = sum(
+        estimate_tokens(message.get("content") or "")
+        for message in request.get("messages", [])
+    )
+    return prompt_tokens + request.get("max_tokens", 0)
+
+
+def parse_reset_duration(value: Optional[str]) -> Optional[float]:
+    # Parses header values like "1s", "6m0s", "20ms" or "1h2m3.5s"
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+    if not parts:
+        return None
+    factors = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+    return sum(float(amount) * factors[unit] for amount, unit in parts)
+
+
+class _Budget:
+    # Token bucket refilled continuously up to one minute of capacity
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+
+class AdaptiveRateLimiter:
+    # Shared between all requests of a run: spends from request and token
+    # budgets before each call, shrinks the allowed concurrency on 429s or
+    # low x-ratelimit-remaining-* headers and grows it back one slot at a
+    # time once responses come back healthy
+    def __init__(
+        self,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+        max_concurrency: int = 8,
+        min_concurrency: int = 1,
+        recovery_successes: int = 10,
+        low_remaining_ratio: float = 0.1,
+        default_backoff: float = 1.0,
+        max_rate_limit_retries: int = 10,
+    ):
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.recovery_successes = recovery_successes
+        self.low_remaining_ratio = low_remaining_ratio
+        self.default_backoff = default_backoff
+        self.max_rate_limit_retries = max_rate_limit_retries
+
+        self.concurrency_limit = self.max_concurrency
+        self.in_flight = 0
+        self.throttled_seconds = 0.0
+        self.rate_limit_hits = 0
+        self.concurrency_reductions = 0
+
+        self._requests = _Budget(requests_per_minute) if requests_per_minute else None
+        self._tokens = _Budget(tokens_per_minute) if tokens_per_minute else None
+        self._blocked_until = 0.0
+        # End of the current 429 pause; only waits inside it count as throttled
+        self._rate_limited_until = 0.0
+        self._successes = 0
+        self._consecutive_hits = 0
+        self._lock = threading.Lock()
+
+    def _reserve(self, tokens: int) -> Tuple[float, float]:
+        # Returns (0, 0) if a slot and budget were taken, otherwise seconds
+        # to wait and how much of that wait is a 429 pause
+        with self._lock:
+            now = time.monotonic()
+            if now < self._blocked_until:
+                wait = self._blocked_until - now
+                return wait, min(wait, max(self._rate_limited_until - now, 0.0))
+            if self.in_flight >= self.concurrency_limit:
+                return SLOT_POLL_INTERVAL, 0.0
+
+            wait = 0.0
+            for budget, amount in ((self._requests, 1), (self._tokens, tokens)):
+                if budget is not None:
+                    budget.refill(now)
+                    wait = max(wait, budget.wait_time(amount))
+            if wait > 0:
+                return wait, 0.0
+
+            if self._requests is not None:
+                self._requests.level -= 1
+            if self._tokens is not None:
+                self._tokens.level -= min(tokens, self._tokens.capacity)
+            self.in_flight += 1
+            return 0.0, 0.0
+
+    def acquire(self, tokens: int) -> None:
+        while True:
+            wait, throttled = self._reserve(tokens)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+            self._add_throttled(throttled)
+
+    async def acquire_async(self, tokens: int) -> None:
+        while True:
+            wait, throttled = self._reserve(tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+            self._add_throttled(throttled)
+
+    def _add_throttled(self, seconds: float) -> None:
+        # Waiting for a free slot or budget is normal pacing, not throttling
+        if seconds > 0:
+            with self._lock:
+                self.throttled_seconds += seconds
+
+    def release(self, reserved_tokens: int, used_tokens: Optional[int] = None) -> None:
+        with self._lock:
+            self.in_flight = max(0, self.in_flight - 1)
+            # Correct the token budget once the real usage is known
+            if self._tokens is not None and used_tokens is not None:
+                self._tokens.level -= used_tokens - min(reserved_tokens, self._tokens.capacity)
+
+    def record_response(self, headers: Mapping[str, str]) -> None:
+        with self._lock:
+            self._consecutive_hits = 0
+            low_budget = False
+            for kind, budget in (("requests", self._requests), ("tokens", self._tokens)):
+                remaining = _header_number(headers, f"x-ratelimit-remaining-{kind}")
+                limit = _header_number(headers, f"x-ratelimit-limit-{kind}")
+                if remaining is None:
+                    continue
+
+                # The provider knows better than our estimate
+                if budget is not None:
+                    budget.level = min(budget.level, remaining)
+
+                if limit and remaining / limit < self.low_remaining_ratio:
+                    low_budget = True
+                if remaining <= 0:
+                    reset = parse_reset_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+                    self._block_for(reset or self.default_backoff)
+
+            if low_budget:
+                self._shrink(halve=False)
+                return
+
+            self._successes += 1
+            if (
+                self._successes >= self.recovery_successes
+                and self.concurrency_limit < self.max_concurrency
+            ):
+                self.concurrency_limit += 1
+                self._successes = 0
+                logger.info(f"Rate limits clear, concurrency raised to {self.concurrency_limit}")
+
+    def record_rate_limit(self, headers: Optional[Mapping[str, str]] = None) -> float:
+        headers = headers or {}
+        with self._lock:
+            self.rate_limit_hits += 1
+            self._consecutive_hits += 1
+            self._shrink(halve=True)
+
+            pause = _retry_after(headers)
+            if pause is None:
+                pause = max(
+                    parse_reset_duration(headers.get("x-ratelimit-reset-requests")) or 0.0,
+                    parse_reset_duration(headers.get("x-ratelimit-reset-tokens")) or 0.0,
+                )
+            if not pause:
+                # Exponential backoff when the provider gives no hint
+                pause = self.default_backoff * (2 ** min(self._consecutive_hits - 1, 6))
+            self._block_for(pause)
+            self._rate_limited_until = max(self._rate_limited_until, time.monotonic() + pause)
+
+        logger.warning(
+            f"Rate limited, pausing {pause:.2f}s with concurrency {self.concurrency_limit}"
+        )
+        return pause
+
+    def _shrink(self, halve: bool) -> None:
+        # Caller holds the lock; 429s halve, a draining budget steps down by one
+        self._successes = 0
+        reduced = self.concurrency_limit // 2 if halve else self.concurrency_limit - 1
+        reduced = max(self.min_concurrency, reduced)
+        if reduced < self.concurrency_limit:
+            self.concurrency_limit = reduced
+            self.concurrency_reductions += 1
+
+    def _block_for(self, seconds: float) -> None:
+        # Caller holds the lock
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "concurrency_limit": self.concurrency_limit,
+                "max_concurrency": self.max_concurrency,
+                "rate_limit_hits": self.rate_limit_hits,
+                "concurrency_reductions": self.concurrency_reductions,
+                "throttled_seconds": round(self.throttled_seconds, 3),
+            }
+
+
+def _header_number(headers: Mapping[str, str], name: str) -> Optional[float]:
+    value = headers.get(name)
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def _retry_after(headers: Mapping[str, str]) -> Optional[float]:
+    retry_after_ms = _header_number(headers, "retry-after-ms")
+    if retry_after_ms is not None:
+        return retry_after_ms / 1000.0
+    return _header_number(headers, "retry-after")
@@ -0,0 +1,199 @@
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Eviction runs after this many writes instead of on every put
+EVICT_EVERY_WRITES = 100
+
+
+class ResponseCache:
+    # On-disk cache of parsed structured_call responses in a single SQLite
+    # file. The key covers everything that determines the answer plus a
+    # sample index, so N distinct draws of the same prompt can be cached
+    # deliberately by running with sample_index 0..N-1. A sample index
+    # passed per call (profile repeats) counts from the cache's own. A
+    # read-only cache whose file does not exist yet behaves like an empty
+    # one.
+    def __init__(
+        self,
+        path: Path,
+        max_entries: Optional[int] = None,
+        max_age_seconds: Optional[float] = None,
+        max_bytes: Optional[int] = None,
+        read_only: bool = False,
+        sample_index: int = 0,
+    ):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_seconds
+        self.max_bytes = max_bytes
+        self.read_only = read_only
+        self.sample_index = sample_index
+
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        if read_only and self.path.exists():
+            self._conn = sqlite3.connect(
+                f"file:{self.path}?mode=ro", uri=True, check_same_thread=False
+            )
+        else:
+            if read_only:
+                logger.warning(f"Response cache {self.path} does not exist, starting empty")
+                self._conn = sqlite3.connect(":memory:", check_same_thread=False)
+            else:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+                self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+                "created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)"
+            )
+            self._conn.commit()
+
+    def make_key(
+        self,
+        model: str,
+        temperature: float,
+        system_prompt: str,
+        user_prompt: str,
+        response_format: dict,
+        sample_index: Optional[int] = None,
+        n: int = 1,
+        max_tokens: Optional[int] = None,
+    ) -> str:
+        sample_index = self.sample_index + (sample_index or 0)
+        # max_tokens can truncate an answer, so it is part of the key
+        key_parts = [
+            model, temperature, max_tokens, system_prompt, user_prompt, response_format,
+            sample_index,
+        ]
+        # Multi-choice answers get their own keys, single calls keep theirs
+        if n > 1:
+            key_parts.append(n)
+        payload = json.dumps(
+            key_parts,
+            ensure_ascii=False,
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            now = time.time()
+            if row is not None and self.max_age_seconds is not None:
+                if now - row[1] > self.max_age_seconds:
+                    row = None
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            if not self.read_only:
+                self._conn.execute(
+                    "UPDATE responses SET accessed = ? WHERE key = ?", (now, key)
+                )
+                self._conn.commit()
+        return json.loads(row[0])
+
+    def put(self, key: str, value: Any) -> None:
+        if self.read_only:
+            return
+        serialized = json.dumps(value, ensure_ascii=False)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, created, accessed) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, serialized, len(serialized.encode("utf-8")), now, now),
+            )
+            self._conn.commit()
+            self.writes += 1
+            if self.writes % EVICT_EVERY_WRITES == 0:
+                self._evict()
+
+    def evict(self) -> int:
+        if self.read_only:
+            return 0
+        with self._lock:
+            return self._evict()
+
+    def _evict(self) -> int:
+        # Caller holds the lock. Drops expired entries first, then the least
+        # recently used ones until entry count and total size fit.
+        removed = 0
+        if self.max_age_seconds is not None:
+            cursor = self._conn.execute(
+                "DELETE FROM responses WHERE created < ?",
+                (time.time() - self.max_age_seconds,),
+            )
+            removed += cursor.rowcount
+
+        if self.max_entries is not None:
+            cursor = self._conn.execute(
+                "DELETE FROM responses WHERE key IN ("
+                "SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            removed += cursor.rowcount
+
+        if self.max_bytes is not None:
+            total = self._conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()[0]
+            if total > self.max_bytes:
+                to_delete = []
+                for key, size in self._conn.execute(
+                    "SELECT key, size FROM responses ORDER BY accessed ASC"
+                ):
+                    if total <= self.max_bytes:
+                        break
+                    to_delete.append((key,))
+                    total -= size
+                self._conn.executemany("DELETE FROM responses WHERE key = ?", to_delete)
+                removed += len(to_delete)
+
+        self._conn.commit()
+        self.evictions += removed
+        return removed
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "writes": self.writes,
+                "evictions": self.evictions,
+                "entries": entries,
+                "bytes": size,
+            }
+
+    def close(self) -> None:
+        if not self.read_only:
+            self.evict()
+        with self._lock:
+            self._conn.close()
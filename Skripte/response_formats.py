@@ -1,7 +1,9 @@
 import json
+from typing import Dict, List
 
-with open('Daten/Basisdaten/parteien.json', 'r', encoding='utf-8') as f:
-    allowed_parties = json.load(f)
+from context_store import get_shared_context
+
+allowed_parties = list(get_shared_context().parties)
 
 # STEP #1: Persona
 persona_response_format = {
@@ -128,4 +130,45 @@ final_choice_response_format = {
             }
         }
     }
-}
\ No newline at end of file
+}
+# News digest (preprocessing, once per run)
+news_digest_response_format = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "news_digest",
+        "schema": {
+            "type": "object",
+            "properties": {
+                "zusammenfassung": {
+                    "type": "string",
+                    "minLength": 50,
+                    "description": "Kompakte Zusammenfassung der Nachrichten"
+                }
+            },
+            "required": ["zusammenfassung"]
+        }
+    }
+}
+
+# STEP #2 follow-up: only the given theses, see step2_wahlomat.WahlomatRepair
+def wahlomat_repair_response_format(these_ids: List[int]) -> Dict:
+    answers = wahlomat_response_format["json_schema"]["schema"]["properties"]["antworten"]
+    items = json.loads(json.dumps(answers["items"]))
+    items["properties"]["these_id"] = {"type": "integer", "enum": list(these_ids)}
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "wahlomat_repair",
+            "schema": {
+                "type": "object",
+                "properties": {
+                    "antworten": {
+                        "type": "array",
+                        "items": items,
+                        "minItems": len(these_ids),
+                        "maxItems": len(these_ids)
+                    }
+                }
+            }
+        }
+    }
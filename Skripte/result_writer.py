@@ -0,0 +1,232 @@
+import os
+import json
+import time
+import queue
+import logging
+import argparse
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Records written per flush at most, and seconds between fsyncs
+FLUSH_RECORDS = 64
+FSYNC_INTERVAL = 5.0
+# Tail scanned per step when cutting off a torn last line
+TAIL_BLOCK = 65536
+
+_STOP = object()
+
+
+def shard_path(output_path: Path, shard: str) -> Path:
+    # pipeline_results.jsonl -> pipeline_results.shard-<name>.jsonl
+    if "." in shard:
+        raise ValueError(f"Shard names cannot contain dots: {shard}")
+    return output_path.with_name(f"{output_path.stem}.shard-{shard}{output_path.suffix}")
+
+
+def result_paths(output_path: Path) -> List[Path]:
+    # The results file and the shards of all workers writing for it; a
+    # shard's own checkpoints and metrics (shard-<name>.checkpoints.jsonl)
+    # are not results
+    prefix = f"{output_path.stem}.shard-"
+    shards = sorted(
+        path
+        for path in output_path.parent.glob(f"{prefix}*{output_path.suffix}")
+        if "." not in path.name[len(prefix) : len(path.name) - len(output_path.suffix)]
+    )
+    return ([output_path] if output_path.exists() else []) + shards
+
+
+def repair_tail(path: Path) -> int:
+    # A crash during a write can leave a torn last line; it is cut off so
+    # appended records start on a line of their own. Returns bytes removed.
+    if not path.exists():
+        return 0
+    with open(path, "rb+") as f:
+        size = f.seek(0, os.SEEK_END)
+        end = size
+        while end > 0:
+            start = max(end - TAIL_BLOCK, 0)
+            f.seek(start)
+            block = f.read(end - start)
+            newline = block.rfind(b"\n")
+            if newline >= 0:
+                end = start + newline + 1
+                break
+            end = start
+        if end < size:
+            f.truncate(end)
+            logger.warning(f"Removed a torn last line ({size - end} bytes) from {path}")
+    return size - end
+
+
+class ResultWriter:
+    # The only writer of a results file: records are queued from any
+    # thread or the event loop and written by one thread, several lines
+    # per write and flush, with an fsync at most every `fsync_interval`
+    # seconds and on close. `on_written` sees the id of every record once
+    # it is flushed, e.g. to free its checkpoints; its errors are logged
+    # and do not stop the writing. An error of the writer thread itself is
+    # raised again from write() and close().
+    def __init__(
+        self,
+        path: Path,
+        on_written: Optional[Callable[[str], None]] = None,
+        flush_records: int = FLUSH_RECORDS,
+        fsync_interval: float = FSYNC_INTERVAL,
+    ):
+        self.path = Path(path)
+        self.on_written = on_written
+        self.flush_records = flush_records
+        self.fsync_interval = fsync_interval
+        self.records = 0
+        self.flushes = 0
+        self.fsyncs = 0
+        self._error: Optional[BaseException] = None
+
+        repair_tail(self.path)
+        self._queue: "queue.Queue[Any]" = queue.Queue()
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._thread = threading.Thread(target=self._run, name="result-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, result: Dict) -> None:
+        if self._error is not None:
+            raise self._error
+        self._queue.put(result)
+
+    def _run(self) -> None:
+        try:
+            self._write_loop()
+        except Exception as e:
+            # Nobody reads the queue from here on, write() and close() raise
+            logger.error(f"Result writer for {self.path} failed: {str(e)}", exc_info=True)
+            self._error = e
+
+    def _write_loop(self) -> None:
+        last_sync = time.monotonic()
+        unsynced = False
+        stopping = False
+        while not stopping:
+            try:
+                batch = [self._queue.get(timeout=self.fsync_interval)]
+            except queue.Empty:
+                batch = []
+            while len(batch) < self.flush_records:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if batch and batch[-1] is _STOP:
+                stopping = True
+                batch.pop()
+
+            if batch:
+                self._file.write(
+                    "".join(json.dumps(result, ensure_ascii=False) + "\n" for result in batch)
+                )
+                self._file.flush()
+                self.records += len(batch)
+                self.flushes += 1
+                unsynced = True
+            if unsynced and (stopping or time.monotonic() - last_sync >= self.fsync_interval):
+                os.fsync(self._file.fileno())
+                self.fsyncs += 1
+                unsynced = False
+                last_sync = time.monotonic()
+            if self.on_written is not None:
+                for result in batch:
+                    try:
+                        self.on_written(str(result["id"]))
+                    except Exception as e:
+                        logger.error(f"Bookkeeping after writing {result['id']} failed: {str(e)}")
+
+    def close(self) -> None:
+        # Everything queued so far is written and synced before returning
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._file.close()
+        if self._error is not None:
+            raise self._error
+
+    def stats(self) -> Dict[str, int]:
+        return {"records": self.records, "flushes": self.flushes, "fsyncs": self.fsyncs}
+
+    def __enter__(self) -> "ResultWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def merge_results(output_path: Path, remove_shards: bool = False) -> Dict[str, int]:
+    # Compacts the results file and its shards into the results file: one
+    # record per id, the last one written wins, lines that do not parse or
+    # carry no id are dropped and reported. Two passes, so only the ids
+    # and line positions are held in memory, never the records.
+    paths = result_paths(output_path)
+    if not paths:
+        logger.warning(f"No results to merge for {output_path}")
+        return {}
+    winners: Dict[str, tuple] = {}
+    lines = invalid = 0
+    for file_index, path in enumerate(paths):
+        with open(path, "r", encoding="utf-8") as f:
+            for line_number, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                lines += 1
+                try:
+                    id = json.loads(line)["id"]
+                except (ValueError, KeyError, TypeError):
+                    invalid += 1
+                    logger.warning(f"Unreadable record in {path}:{line_number}")
+                    continue
+                winners[str(id)] = (file_index, line_number)
+
+    keep = set(winners.values())
+    temp_path = output_path.with_name(output_path.name + ".tmp")
+    written = 0
+    with open(temp_path, "w", encoding="utf-8") as out:
+        for file_index, path in enumerate(paths):
+            with open(path, "r", encoding="utf-8") as f:
+                for line_number, line in enumerate(f, start=1):
+                    if (file_index, line_number) in keep:
+                        out.write(line if line.endswith("\n") else line + "\n")
+                        written += 1
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(temp_path, output_path)
+
+    if remove_shards:
+        for path in paths:
+            if path != output_path:
+                path.unlink()
+
+    stats = {
+        "files": len(paths),
+        "lines": lines,
+        "invalid": invalid,
+        "duplicates": lines - invalid - written,
+        "written": written,
+    }
+    logger.info(f"Merged results into {output_path}: {stats}")
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Merge the result shards into the results file, one record per id"
+    )
+    parser.add_argument("--output_path", default="Daten/Ergebnisse/pipeline_results.jsonl")
+    parser.add_argument("--remove_shards", action="store_true", default=False)
+    args = parser.parse_args()
+    merge_results(Path(args.output_path), args.remove_shards)
+
+
+if __name__ == "__main__":
+    main()
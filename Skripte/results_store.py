@@ -0,0 +1,314 @@
+import json
+import logging
+import argparse
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from context_store import get_shared_context
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # optional, the NumPy layout is used instead
+    pa = None
+    pq = None
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+BACKENDS = ("auto", "parquet", "numpy")
+CHUNK_SIZE = 50000
+# Fixed width of the id column in the NumPy layout
+ID_WIDTH = 64
+# Bumped when columns change; older stores are rebuilt
+FORMAT_VERSION = 3
+
+# int8 code of a thesis without answer in the answer matrix
+NO_ANSWER = -128
+# int16 code of a missing alter/sicherheit
+MISSING_INT = -1
+
+
+def default_store_dir(results_path: Path) -> Path:
+    # pipeline_results.jsonl -> pipeline_results.columns/
+    return results_path.with_name(f"{results_path.stem}.columns")
+
+
+def _source_fingerprint(results_path: Path) -> Dict:
+    stat = results_path.stat()
+    return {"source": str(results_path), "source_size": stat.st_size, "source_mtime_ns": stat.st_mtime_ns}
+
+
+def read_meta(store_dir: Path) -> Optional[Dict]:
+    try:
+        return json.loads((store_dir / "meta.json").read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+
+
+def is_current(store_dir: Path, results_path: Path) -> bool:
+    # The store is only used while the JSONL it was built from is unchanged
+    meta = read_meta(store_dir)
+    if meta is None or meta.get("format") != FORMAT_VERSION or not results_path.exists():
+        return False
+    fingerprint = _source_fingerprint(results_path)
+    return all(meta.get(key) == value for key, value in fingerprint.items() if key != "source")
+
+
+def _iter_records(results_path: Path, chunk_size: int) -> Iterator[List[Dict]]:
+    chunk = []
+    with open(results_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                chunk.append(json.loads(line))
+            except ValueError:
+                logger.warning(f"Skipping unreadable line in {results_path}")
+                continue
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def _columns(records: List[Dict], parties: Sequence[str], these_ids: Sequence[int], categories: Dict[str, int]) -> Dict[str, np.ndarray]:
+    # Numeric columns of one chunk; party choices become int8 codes
+    n = len(records)
+    these_column = {these_id: i for i, these_id in enumerate(these_ids)}
+    alter = np.full(n, MISSING_INT, dtype=np.int16)
+    sicherheit = np.full(n, MISSING_INT, dtype=np.int16)
+    partei_wahl = np.full(n, -1, dtype=np.int8)
+    matches = np.full((n, len(parties)), np.nan)
+    anteile = np.full((n, len(parties)), np.nan)
+    gewicht = np.full(n, np.nan)
+    antworten = np.full((n, len(these_ids)), NO_ANSWER, dtype=np.int8)
+    ids = []
+    rows, cols, values = [], [], []
+    for row, record in enumerate(records):
+        ids.append(str(record.get("id")))
+        persona = record.get("persona") or {}
+        final = record.get("finale_entscheidung") or {}
+        judge = (record.get("judge_distribution") or {}).get("matches") or {}
+        if isinstance(persona.get("alter"), (int, float)):
+            alter[row] = persona["alter"]
+        if isinstance(final.get("sicherheit"), (int, float)):
+            sicherheit[row] = final["sicherheit"]
+        if isinstance(record.get("gewicht"), (int, float)):
+            gewicht[row] = record["gewicht"]
+        choice = final.get("partei_wahl")
+        if choice is not None:
+            partei_wahl[row] = categories.setdefault(choice, len(categories))
+        matches[row] = [judge.get(party, np.nan) for party in parties]
+        if final.get("verteilung"):
+            anteile[row] = [final["verteilung"].get(party, 0.0) for party in parties]
+        for answer in (record.get("wahlomat_antworten") or {}).get("antworten", []):
+            column = these_column.get(answer.get("these_id"))
+            if column is not None and answer.get("position") in (-1, 0, 1):
+                rows.append(row)
+                cols.append(column)
+                values.append(answer["position"])
+    antworten[rows, cols] = values
+    return {
+        "id": np.array(ids),
+        "alter": alter,
+        "sicherheit": sicherheit,
+        "partei_wahl": partei_wahl,
+        "gewicht": gewicht,
+        "matches": matches,
+        "anteile": anteile,
+        "antworten": antworten,
+    }
+
+
+def _texts(record: Dict) -> Dict:
+    # Everything that is not needed for the numeric analysis
+    return {
+        "id": record.get("id"),
+        "persona": record.get("persona"),
+        "begruendungen": {
+            answer.get("these_id"): answer.get("begruendung")
+            for answer in (record.get("wahlomat_antworten") or {}).get("antworten", [])
+        },
+        "analyse": (record.get("judge_distribution") or {}).get("analyse"),
+        "begruendung": (record.get("finale_entscheidung") or {}).get("begruendung"),
+    }
+
+
+def export_results(
+    results_path: Path,
+    store_dir: Optional[Path] = None,
+    backend: str = "auto",
+    chunk_size: int = CHUNK_SIZE,
+) -> Path:
+    # Writes the numeric columns and the persona x thesis answer matrix in
+    # a columnar layout plus a JSONL text store, chunk by chunk
+    results_path = Path(results_path)
+    store_dir = Path(store_dir) if store_dir else default_store_dir(results_path)
+    if backend == "auto":
+        backend = "parquet" if pq is not None else "numpy"
+    if backend == "parquet" and pq is None:
+        raise ValueError("The parquet backend needs pyarrow")
+    store_dir.mkdir(parents=True, exist_ok=True)
+    # meta.json is written last and marks a complete store
+    (store_dir / "meta.json").unlink(missing_ok=True)
+
+    context = get_shared_context()
+    parties = list(context.parties)
+    these_ids = [question["these_id"] for question in context.questions]
+    categories: Dict[str, int] = {}
+    fingerprint = _source_fingerprint(results_path)
+
+    with open(results_path, "r", encoding="utf-8") as f:
+        rows = sum(1 for line in f if line.strip())
+
+    writer = None
+    arrays: Dict[str, np.ndarray] = {}
+    offset = 0
+    with open(store_dir / "texts.jsonl", "w", encoding="utf-8") as texts:
+        for records in _iter_records(results_path, chunk_size):
+            columns = _columns(records, parties, these_ids, categories)
+            for record in records:
+                texts.write(json.dumps(_texts(record), ensure_ascii=False) + "\n")
+            n = len(records)
+            if backend == "parquet":
+                table = _arrow_table(columns, parties, these_ids)
+                if writer is None:
+                    writer = pq.ParquetWriter(store_dir / "columns.parquet", table.schema)
+                writer.write_table(table)
+            else:
+                if not arrays:
+                    arrays = _open_arrays(store_dir, columns, rows)
+                for name, values in columns.items():
+                    arrays[name][offset : offset + n] = values
+            offset += n
+    if writer is not None:
+        writer.close()
+    for array in arrays.values():
+        if isinstance(array, np.memmap):
+            array.flush()
+
+    meta = {
+        **fingerprint,
+        "format": FORMAT_VERSION,
+        "backend": backend,
+        "rows": offset,
+        "parties": parties,
+        "these_ids": these_ids,
+        "partei_wahl_categories": sorted(categories, key=categories.get),
+        "no_answer": NO_ANSWER,
+        "missing_int": MISSING_INT,
+    }
+    (store_dir / "meta.json").write_text(json.dumps(meta, ensure_ascii=False, indent=2), encoding="utf-8")
+    logger.info(f"Exported {offset} results to {store_dir} ({backend})")
+    return store_dir
+
+
+def _open_arrays(store_dir: Path, columns: Dict[str, np.ndarray], rows: int) -> Dict[str, np.ndarray]:
+    # One .npy per column, preallocated so chunks are written in place
+    arrays = {}
+    for name, values in columns.items():
+        dtype = np.dtype(f"<U{ID_WIDTH}") if name == "id" else values.dtype
+        arrays[name] = np.lib.format.open_memmap(
+            store_dir / f"{name}.npy", mode="w+", dtype=dtype, shape=(rows,) + values.shape[1:]
+        )
+    return arrays
+
+
+def _arrow_table(columns: Dict[str, np.ndarray], parties: Sequence[str], these_ids: Sequence[int]):
+    data = {
+        "id": pa.array(columns["id"]),
+        "alter": pa.array(columns["alter"]),
+        "sicherheit": pa.array(columns["sicherheit"]),
+        "partei_wahl": pa.array(columns["partei_wahl"]),
+        "gewicht": pa.array(columns["gewicht"]),
+    }
+    for i, party in enumerate(parties):
+        data[f"match_{party}"] = pa.array(columns["matches"][:, i])
+    for i, party in enumerate(parties):
+        data[f"anteil_{party}"] = pa.array(columns["anteile"][:, i])
+    for i, these_id in enumerate(these_ids):
+        data[f"these_{these_id}"] = pa.array(columns["antworten"][:, i])
+    return pa.table(data)
+
+
+def read_columns(store_dir: Path, columns: Sequence[str]) -> Dict[str, np.ndarray]:
+    # Only the requested columns are read; .npy files are memory-mapped,
+    # Parquet column chunks are read through a memory map as well
+    store_dir = Path(store_dir)
+    meta = read_meta(store_dir)
+    if meta is None:
+        raise FileNotFoundError(f"No results store in {store_dir}")
+    if meta["backend"] == "numpy":
+        return {name: np.load(store_dir / f"{name}.npy", mmap_mode="r") for name in columns}
+
+    # Matrix columns are stored as one Parquet column per party/thesis
+    groups = {
+        "matches": [f"match_{party}" for party in meta["parties"]],
+        "anteile": [f"anteil_{party}" for party in meta["parties"]],
+        "antworten": [f"these_{these_id}" for these_id in meta["these_ids"]],
+    }
+    names = []
+    for name in columns:
+        names.extend(groups.get(name, [name]))
+    table = pq.read_table(store_dir / "columns.parquet", columns=names, memory_map=True)
+    result = {}
+    for name in columns:
+        if name in groups:
+            result[name] = np.column_stack(
+                [table.column(column).to_numpy() for column in groups[name]]
+            )
+        else:
+            result[name] = table.column(name).to_numpy()
+    return result
+
+
+def iter_analysis_chunks(store_dir: Path, chunk_size: int = CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+    # Same frame layout as analysis.iter_result_chunks, from the columns
+    meta = read_meta(store_dir)
+    columns = read_columns(
+        store_dir, ["partei_wahl", "alter", "sicherheit", "gewicht", "matches", "anteile"]
+    )
+    categories = np.array(meta["partei_wahl_categories"] + [None], dtype=object)
+    for start in range(0, meta["rows"], chunk_size):
+        end = min(start + chunk_size, meta["rows"])
+        frame = pd.DataFrame({
+            "partei_wahl": categories[np.asarray(columns["partei_wahl"][start:end], dtype=int)],
+            "alter": _with_missing(columns["alter"][start:end]),
+            "sicherheit": _with_missing(columns["sicherheit"][start:end]),
+            "gewicht": np.asarray(columns["gewicht"][start:end], dtype=float),
+        })
+        matches = np.asarray(columns["matches"][start:end], dtype=float)
+        anteile = np.asarray(columns["anteile"][start:end], dtype=float)
+        for i, party in enumerate(meta["parties"]):
+            frame[party] = matches[:, i]
+            frame[f"anteil_{party}"] = anteile[:, i]
+        yield frame
+
+
+def _with_missing(values: np.ndarray) -> np.ndarray:
+    values = np.asarray(values, dtype=float)
+    values[values == MISSING_INT] = np.nan
+    return values
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Columnar export of pipeline results")
+    parser.add_argument("--results_path", default="Daten/Ergebnisse/pipeline_results.jsonl")
+    parser.add_argument("--store_dir", default=None)
+    parser.add_argument("--backend", choices=BACKENDS, default="auto")
+    parser.add_argument("--chunk_size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+    export_results(
+        Path(args.results_path),
+        Path(args.store_dir) if args.store_dir else None,
+        backend=args.backend,
+        chunk_size=args.chunk_size,
+    )
+
+
+if __name__ == "__main__":
+    main()
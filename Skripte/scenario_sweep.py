@@ -0,0 +1,191 @@
+import os
+import sys
+import json
+import logging
+import argparse
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from tqdm import tqdm
+
+from llm_client import OpenAIClient, get_default_client
+from stages import STAGES, STAGE_DESCRIPTIONS, run_stage, build_result
+from stage_store import STAGE_STORE_PATH, StageStore, stage_key
+from context_store import DATA_DIR, configure_shared_context, get_shared_context
+from prompt_templates import PERSONA_FIRST, PROMPT_LAYOUTS
+from wahlomat_matching import DeterministicJudge
+from call_metrics import call_context
+from gles_reader import iter_personas, sample_bounds
+from program_index import PROGRAM_TOP_K
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Modules that bind prompt templates at import time
+STEP_MODULES = ("step1_persona", "step2_wahlomat", "step3_judge", "step4_final_choice")
+
+
+@contextmanager
+def override_templates(overrides: Dict[str, str]) -> Iterator[None]:
+    # {"FINAL_CHOICE_TEMPLATE": "path/to/template.txt"}; the step modules
+    # imported the template constants by name, so they are patched there
+    previous: List[Tuple[Any, str, str]] = []
+    try:
+        for name, path in overrides.items():
+            text = Path(path).read_text(encoding="utf-8")
+            patched = False
+            for module_name in STEP_MODULES:
+                module = sys.modules.get(module_name)
+                if module is not None and hasattr(module, name):
+                    previous.append((module, name, getattr(module, name)))
+                    setattr(module, name, text)
+                    patched = True
+            if not patched:
+                raise ValueError(f"Unknown prompt template: {name}")
+        yield
+    finally:
+        for module, name, text in reversed(previous):
+            setattr(module, name, text)
+
+
+def load_variants(path: Path) -> List[Dict[str, Any]]:
+    # A JSON list of variants, e.g.
+    # [{"name": "basis"},
+    #  {"name": "news_januar", "news_path": "Daten/Szenarien/news_januar.txt"},
+    #  {"name": "prompt_v2", "templates": {"FINAL_CHOICE_TEMPLATE": "final_v2.txt"}},
+    #  {"name": "mini", "model": "gpt-4o-mini", "judge": "deterministic"}]
+    variants = json.loads(Path(path).read_text(encoding="utf-8"))
+    names = [variant.get("name") for variant in variants]
+    if not all(names) or len(set(names)) != len(names):
+        raise ValueError("Every variant needs a unique name")
+    return variants
+
+
+def run_persona(
+    id: str,
+    gles_data: Dict,
+    client: OpenAIClient,
+    store: StageStore,
+    settings: Dict[str, Any],
+    layout: str,
+    judge: Optional[DeterministicJudge],
+    votes: int,
+    counts: Dict[str, Dict[str, int]],
+) -> Optional[Dict]:
+    # Walks the stages in order; a stage is only run when no output for
+    # the hash of its current inputs exists
+    outputs: Dict[str, Any] = {}
+    for stage in STAGES:
+        stage_settings = dict(settings, votes=votes) if stage == "final_choice" else settings
+        key = stage_key(stage, gles_data, outputs, stage_settings, layout, judge)
+        output = store.get(key) if key is not None else None
+        if output is not None:
+            counts[stage]["wiederverwendet"] += 1
+        else:
+            logger.info(f"{STAGE_DESCRIPTIONS[stage]} {id}")
+            with call_context(stage, id):
+                output = run_stage(stage, gles_data, outputs, client, layout, judge, votes)
+            if output is None:
+                logger.error(f"{stage} failed for {id}, persona left incomplete")
+                counts[stage]["fehlgeschlagen"] += 1
+                return None
+            counts[stage]["neu"] += 1
+            if key is not None:
+                store.put(key, stage, output)
+        outputs[stage] = output
+    return build_result(id, outputs, gles_data)
+
+
+def run_variant(
+    variant: Dict[str, Any],
+    personas: Callable[[], Iterable[Tuple[str, Dict]]],
+    output_dir: Path,
+    store: StageStore,
+    backend: Optional[str],
+) -> Dict[str, Dict[str, int]]:
+    # Every variant starts from the base data; only what it names differs.
+    # `personas` streams the GLES rows again for every variant. A token
+    # budget alone turns on retrieval, as in the pipeline.
+    news_path = variant.get("news_path")
+    top_k = variant.get("program_top_k")
+    if not top_k and variant.get("program_token_budget"):
+        top_k = PROGRAM_TOP_K
+    configure_shared_context(
+        news_file=str(Path(news_path).resolve()) if news_path else "news.txt",
+        program_top_k=top_k,
+        program_token_budget=variant.get("program_token_budget"),
+    )
+    context = get_shared_context()
+    layout = variant.get("prompt_layout", PERSONA_FIRST)
+    if layout not in PROMPT_LAYOUTS:
+        raise ValueError(f"Unknown prompt layout: {layout}")
+    judge = DeterministicJudge(context) if variant.get("judge") == "deterministic" else None
+    votes = variant.get("final_choice_votes", 1)
+
+    client = get_default_client(backend=backend)
+    client.model = variant.get("model", client.model)
+    client.temperature = variant.get("temperature", client.temperature)
+    settings = {
+        "backend": backend or os.getenv("LLM_BACKEND", "openai"),
+        "model": client.model,
+        "temperature": client.temperature,
+    }
+
+    counts = {
+        stage: {"neu": 0, "wiederverwendet": 0, "fehlgeschlagen": 0} for stage in STAGES
+    }
+    output_path = output_dir / f"{variant['name']}.jsonl"
+    logger.info(f"Variant {variant['name']}: context {context.content_hash[:12]}")
+    with override_templates(variant.get("templates", {})), open(
+        output_path, "w", encoding="utf-8"
+    ) as f:
+        for id, data in tqdm(personas(), desc=variant["name"]):
+            result = run_persona(
+                id, data, client, store, settings, layout, judge, votes, counts
+            )
+            if result:
+                f.write(json.dumps(result, ensure_ascii=False) + "\n")
+    logger.info(f"Variant {variant['name']}: {json.dumps(counts, ensure_ascii=False)}")
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run scenario variants, recomputing only stages whose inputs changed"
+    )
+    parser.add_argument("--variants", required=True, help="JSON list of variants")
+    parser.add_argument("--csv_path", default=str(DATA_DIR / "gles.csv"))
+    parser.add_argument("--weight_column", default=None)
+    parser.add_argument("--sample_start", type=int, default=0)
+    parser.add_argument("--sample_end", type=int, default=0)
+    parser.add_argument("--output_dir", default="Daten/Ergebnisse/szenarien")
+    parser.add_argument("--stage_store_path", default=str(STAGE_STORE_PATH))
+    parser.add_argument("--backend", choices=("openai", "fake"), default=None)
+    args = parser.parse_args()
+
+    start, end = sample_bounds(args.sample_start, args.sample_end)
+
+    def personas() -> Iterable[Tuple[str, Dict]]:
+        return iter_personas(
+            Path(args.csv_path), weight_column=args.weight_column, start=start, end=end
+        )
+
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    store = StageStore(Path(args.stage_store_path))
+    summary = {}
+    for variant in load_variants(Path(args.variants)):
+        summary[variant["name"]] = run_variant(
+            variant, personas, output_dir, store, args.backend
+        )
+    store.close()
+
+    with open(output_dir / "sweep_summary.json", "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    logger.info(f"Sweep summary written to {output_dir / 'sweep_summary.json'}")
+
+
+if __name__ == "__main__":
+    main()
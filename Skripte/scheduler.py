@@ -0,0 +1,182 @@
+import time
+import asyncio
+import logging
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from llm_client import AsyncOpenAIClient
+from stages import STAGES, STAGE_DESCRIPTIONS, run_stage_async, build_result
+from checkpoint_store import CheckpointStore
+from prompt_templates import PERSONA_FIRST
+from wahlomat_matching import DeterministicJudge
+from call_metrics import call_context
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def parse_stage_workers(spec: Optional[str], default: int) -> Dict[str, int]:
+    # "wahlomat=16,final_choice=4" -> workers per stage, others get `default`
+    workers = {stage: default for stage in STAGES}
+    if spec:
+        for part in spec.split(","):
+            stage, _, count = part.partition("=")
+            stage = stage.strip()
+            if stage not in workers:
+                raise ValueError(f"Unknown stage in --stage_workers: {stage}")
+            workers[stage] = max(1, int(count))
+    return workers
+
+
+class _StageStats:
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.busy = 0
+        self.busy_seconds = 0.0
+        self.processed = 0
+        self.failed = 0
+        self.skipped = 0
+
+
+class StageScheduler:
+    # One bounded queue and one worker pool per stage. A persona moves to
+    # the next stage's queue as soon as its current stage is done, so the
+    # stages of different personas overlap. Full queues block the stage in
+    # front of them (backpressure), which keeps memory bounded.
+    def __init__(
+        self,
+        client: AsyncOpenAIClient,
+        workers: Dict[str, int],
+        queue_size: Optional[int] = None,
+        layout: str = PERSONA_FIRST,
+        checkpoints: Optional[CheckpointStore] = None,
+        report_interval: float = 30.0,
+        judge: Optional[DeterministicJudge] = None,
+        votes: int = 1,
+    ):
+        self.client = client
+        self.workers = workers
+        self.queue_size = queue_size or 2 * max(workers.values())
+        self.layout = layout
+        self.checkpoints = checkpoints
+        self.report_interval = report_interval
+        self.judge = judge
+        self.votes = votes
+
+        self.stats_by_stage = {stage: _StageStats(workers[stage]) for stage in STAGES}
+        self._queues: Dict[str, asyncio.Queue] = {}
+        self._started = 0.0
+
+    async def _worker(
+        self, index: int, on_result: Callable[[Dict], None]
+    ) -> None:
+        stage = STAGES[index]
+        queue = self._queues[stage]
+        stats = self.stats_by_stage[stage]
+        while True:
+            id, gles_data, outputs = await queue.get()
+            skipped = stage in outputs
+            try:
+                if skipped:
+                    # Finished in an earlier run, taken from the checkpoints
+                    stats.skipped += 1
+                else:
+                    logger.info(f"{STAGE_DESCRIPTIONS[stage]} {id}")
+                    stats.busy += 1
+                    start = time.monotonic()
+                    try:
+                        with call_context(stage, id):
+                            output = await run_stage_async(
+                                stage, gles_data, outputs, self.client, self.layout, self.judge,
+                                self.votes,
+                            )
+                    except Exception as e:
+                        logger.error(f"Error processing {id}: {str(e)}", exc_info=True)
+                        output = None
+                    finally:
+                        stats.busy -= 1
+                        stats.busy_seconds += time.monotonic() - start
+
+                    if output is None:
+                        logger.error(f"{stage} failed for {id}, persona left incomplete")
+                        stats.failed += 1
+                        continue
+                    outputs[stage] = output
+
+                # A failing checkpoint or result write costs this persona,
+                # not the worker; a dead worker would leave the run hanging
+                try:
+                    if not skipped and self.checkpoints:
+                        self.checkpoints.save(id, stage, output)
+                    if index + 1 < len(STAGES):
+                        await self._queues[STAGES[index + 1]].put((id, gles_data, outputs))
+                    else:
+                        on_result(build_result(id, outputs, gles_data))
+                except Exception as e:
+                    logger.error(f"Handing on {stage} of {id} failed: {str(e)}", exc_info=True)
+                    stats.failed += 1
+                    continue
+                if not skipped:
+                    stats.processed += 1
+            finally:
+                queue.task_done()
+
+    def stats(self) -> Dict[str, Any]:
+        elapsed = max(time.monotonic() - self._started, 1e-9) if self._started else 0.0
+        report = {}
+        for stage in STAGES:
+            stats = self.stats_by_stage[stage]
+            queue = self._queues.get(stage)
+            report[stage] = {
+                "workers": stats.workers,
+                "queue_depth": queue.qsize() if queue else 0,
+                "busy": stats.busy,
+                "utilization": (
+                    round(stats.busy_seconds / (stats.workers * elapsed), 3) if elapsed else 0.0
+                ),
+                "processed": stats.processed,
+                "failed": stats.failed,
+                "skipped": stats.skipped,
+            }
+        return report
+
+    async def _report(self) -> None:
+        while True:
+            await asyncio.sleep(self.report_interval)
+            logger.info(f"Stage scheduler: {self.stats()}")
+
+    async def run(
+        self, personas: Iterable[Tuple[str, Dict]], on_result: Callable[[Dict], None]
+    ) -> None:
+        self._started = time.monotonic()
+        self._queues = {stage: asyncio.Queue(maxsize=self.queue_size) for stage in STAGES}
+
+        pools = [
+            [
+                asyncio.create_task(self._worker(index, on_result))
+                for _ in range(self.workers[stage])
+            ]
+            for index, stage in enumerate(STAGES)
+        ]
+        reporter = asyncio.create_task(self._report())
+
+        try:
+            first = self._queues[STAGES[0]]
+            for id, gles_data in personas:
+                outputs = self.checkpoints.get(id, gles_data) if self.checkpoints else {}
+                await first.put((id, gles_data, outputs))
+
+            # Drain the stages front to back; a stage's workers hand items on
+            # before marking them done, so each join sees all its input
+            for stage, pool in zip(STAGES, pools):
+                await self._queues[stage].join()
+                for task in pool:
+                    task.cancel()
+        finally:
+            reporter.cancel()
+            for pool in pools:
+                for task in pool:
+                    task.cancel()
+            await asyncio.gather(reporter, *[t for pool in pools for t in pool], return_exceptions=True)
+
+        logger.info(f"Stage scheduler: {self.stats()}")
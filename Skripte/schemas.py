@@ -1,5 +1,5 @@
-from pydantic import BaseModel, Field, field_validator
-from typing import List
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError, field_validator
+from typing import Any, Dict, List, Tuple
 from enum import Enum
 
 class Party(str, Enum):
@@ -102,4 +102,38 @@ class FinalChoiceSchema(BaseModel):
     def validate_sicherheit(cls, v):
         if not (0 <= v <= 100):
             raise ValueError("Sicherheit muss zwischen 0 und 100 Prozent liegen")
-        return v 
\ No newline at end of file
+        return v 
+
+# News digest (preprocessing, once per run)
+class NewsDigestSchema(BaseModel):
+    zusammenfassung: str = Field(..., min_length=50)
+
+
+# Validators built once at import instead of per call; results are dumped
+# back to plain JSON, so callers keep working with dicts
+RESPONSE_VALIDATORS: Dict[Any, TypeAdapter] = {
+    model: TypeAdapter(model)
+    for model in (PersonaSchema, WahlomatSchema, JudgeSchema, FinalChoiceSchema, NewsDigestSchema)
+}
+ANSWER_VALIDATOR = TypeAdapter(WahlomatAnswer)
+THESE_IDS = range(1, 36)
+
+def validate_response(model: Any, data: Any) -> Any:
+    # Raises pydantic's ValidationError (a ValueError) on invalid data
+    adapter = RESPONSE_VALIDATORS.get(model)
+    if adapter is None:
+        adapter = RESPONSE_VALIDATORS[model] = TypeAdapter(model)
+    return adapter.dump_python(adapter.validate_python(data), mode="json")
+
+def wahlomat_gaps(data: Any) -> Tuple[List[Dict], List[int]]:
+    # Valid answers of a Wahl-O-Mat response (the first one per these_id)
+    # and the these_ids without a valid answer
+    answers = data.get("antworten") if isinstance(data, dict) else None
+    valid = {}
+    for answer in answers if isinstance(answers, list) else []:
+        try:
+            parsed = ANSWER_VALIDATOR.validate_python(answer)
+        except ValidationError:
+            continue
+        valid.setdefault(parsed.these_id, ANSWER_VALIDATOR.dump_python(parsed, mode="json"))
+    return [valid[i] for i in sorted(valid)], [i for i in THESE_IDS if i not in valid]
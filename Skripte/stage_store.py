@@ -0,0 +1,93 @@
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+from stages import STAGE_RESPONSE_FORMATS, build_stage_prompts
+from prompt_templates import PERSONA_FIRST
+from wahlomat_matching import DeterministicJudge
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+STAGE_STORE_PATH = Path("Daten/Cache/stage_outputs.sqlite")
+
+
+def stage_key(
+    stage: str,
+    gles_data: Dict,
+    outputs: Dict[str, Any],
+    settings: Dict[str, Any],
+    layout: str = PERSONA_FIRST,
+    judge: Optional[DeterministicJudge] = None,
+) -> Optional[str]:
+    # Content hash of everything a stage reads. The rendered prompts are
+    # the canonical form of its inputs: GLES row, template text, news,
+    # programmes, theses and the upstream outputs it embeds, so a change
+    # only reaches the stages whose prompts actually contain it.
+    if stage == "judge" and judge is not None:
+        # Scored locally from the answers and the party positions
+        parts = [
+            stage,
+            "deterministic",
+            outputs["wahlomat"],
+            hashlib.sha256(np.nan_to_num(judge.positions, nan=9.0).tobytes()).hexdigest(),
+        ]
+    else:
+        prompts = build_stage_prompts(stage, gles_data, outputs, layout)
+        if prompts is None:
+            return None
+        parts = [stage, settings, STAGE_RESPONSE_FORMATS[stage], *prompts]
+    payload = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class StageStore:
+    # Stage outputs by input hash in one SQLite file. Unlike the response
+    # cache it holds final stage outputs (aggregated votes, deterministic
+    # judge scores) and never evicts, so every variant of a sweep can
+    # build on the stages an earlier variant already computed.
+    def __init__(self, path: Path = STAGE_STORE_PATH, timeout: float = 30.0):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), timeout=timeout, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS outputs ("
+            "key TEXT PRIMARY KEY, stage TEXT NOT NULL, output TEXT NOT NULL, "
+            "created REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT output FROM outputs WHERE key = ?", (key,)
+            ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def put(self, key: str, stage: str, output: Any) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO outputs (key, stage, output, created) VALUES (?, ?, ?, ?)",
+                (key, stage, json.dumps(output, ensure_ascii=False), time.time()),
+            )
+            self._conn.commit()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(
+                self._conn.execute("SELECT stage, COUNT(*) FROM outputs GROUP BY stage").fetchall()
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,208 @@
+from functools import partial
+from typing import Any, Dict, Generator, Optional, Tuple
+
+from llm_client import OpenAIClient, AsyncOpenAIClient
+from step1_persona import (
+    WEIGHT_KEY,
+    build_persona_prompts,
+    finish_persona,
+    persona_request,
+)
+from step2_wahlomat import (
+    WahlomatRepair,
+    build_wahlomat_prompts,
+    finish_wahlomat,
+    wahlomat_request,
+)
+from step3_judge import build_judge_prompts, finish_judge, judge_request
+from step4_final_choice import (
+    build_final_choice_prompts,
+    final_choice_request,
+    finish_final_choice,
+)
+from response_formats import (
+    persona_response_format,
+    wahlomat_response_format,
+    judge_response_format,
+    final_choice_response_format,
+)
+from schemas import PersonaSchema, WahlomatSchema, JudgeSchema, FinalChoiceSchema
+from prompt_templates import PERSONA_FIRST
+from wahlomat_matching import DeterministicJudge
+
+# Per-persona stages in execution order
+STAGES = ("persona", "wahlomat", "judge", "final_choice")
+
+# Key of each stage's output in a pipeline_results.jsonl record
+RESULT_KEYS = {
+    "persona": "persona",
+    "wahlomat": "wahlomat_antworten",
+    "judge": "judge_distribution",
+    "final_choice": "finale_entscheidung",
+}
+
+# Log messages, same wording as the original sequential loop
+STAGE_DESCRIPTIONS = {
+    "persona": "Step 1: Creating persona",
+    "wahlomat": "Step 2: Generating Wahlomat answers for",
+    "judge": "Step 3: Generating judge analysis for",
+    "final_choice": "Step 4: Generating final choice for",
+}
+
+# Structured output format requested by each stage
+STAGE_RESPONSE_FORMATS = {
+    "persona": persona_response_format,
+    "wahlomat": wahlomat_response_format,
+    "judge": judge_response_format,
+    "final_choice": final_choice_response_format,
+}
+
+# Pydantic model each stage's output is validated against
+STAGE_RESPONSE_MODELS = {
+    "persona": PersonaSchema,
+    "wahlomat": WahlomatSchema,
+    "judge": JudgeSchema,
+    "final_choice": FinalChoiceSchema,
+}
+
+
+def build_stage_repair(stage: str, outputs: Dict[str, Any]) -> Optional[Any]:
+    # Partial repair for stages whose invalid responses can be fixed
+    # piecewise (request/merge, see step2_wahlomat.WahlomatRepair)
+    if stage == "wahlomat":
+        return WahlomatRepair(outputs["persona"])
+    return None
+
+
+def build_stage_prompts(
+    stage: str,
+    gles_data: Dict,
+    outputs: Dict[str, Any],
+    layout: str = PERSONA_FIRST,
+) -> Optional[Tuple[str, str]]:
+    # (system_prompt, user_prompt) of a stage without calling the model,
+    # used where requests are sent in bulk instead of one by one
+    if stage == "persona":
+        return build_persona_prompts(gles_data, layout=layout)
+    if stage == "wahlomat":
+        return build_wahlomat_prompts(outputs["persona"], layout=layout)
+    if stage == "judge":
+        return build_judge_prompts(
+            outputs["persona"], outputs["wahlomat"], layout=layout
+        )
+    if stage == "final_choice":
+        return build_final_choice_prompts(
+            outputs["persona"], outputs["wahlomat"], outputs["judge"], layout=layout
+        )
+    raise ValueError(f"Unknown stage: {stage}")
+
+
+def stage_steps(
+    stage: str,
+    gles_data: Dict,
+    outputs: Dict[str, Any],
+    layout: str = PERSONA_FIRST,
+    judge: Optional[DeterministicJudge] = None,
+    votes: int = 1,
+) -> Generator:
+    # A stage as a generator: it yields the structured_call arguments of
+    # its model call and is sent the (result, error) back, so the sync and
+    # async runners share it and only differ in how they call the client.
+    # `outputs` holds the results of the earlier stages of the same persona;
+    # with a deterministic judge step 3 needs no model call, with votes > 1
+    # step 4 samples a party distribution instead of a single choice
+    if stage == "judge" and judge is not None:
+        return judge.score(outputs["wahlomat"])
+    if stage == "persona":
+        request, finish = persona_request(gles_data, layout), finish_persona
+    elif stage == "wahlomat":
+        request, finish = wahlomat_request(outputs["persona"], layout), finish_wahlomat
+        if request is None:
+            return None
+    elif stage == "judge":
+        request = judge_request(outputs["persona"], outputs["wahlomat"], layout)
+        finish = finish_judge
+    elif stage == "final_choice":
+        request = final_choice_request(
+            outputs["persona"], outputs["wahlomat"], outputs["judge"], layout, votes
+        )
+        finish = partial(finish_final_choice, votes=votes)
+    else:
+        raise ValueError(f"Unknown stage: {stage}")
+    result, error = yield request
+    return finish(result, error)
+
+
+def run_steps(steps: Generator, client: OpenAIClient) -> Any:
+    # Drives stage steps with blocking calls; an error of a call is raised
+    # inside the generator where the request was yielded
+    value, error = None, None
+    try:
+        while True:
+            try:
+                request = steps.throw(error) if error is not None else steps.send(value)
+            except StopIteration as stop:
+                return stop.value
+            value, error = None, None
+            try:
+                value = client.structured_call(**request)
+            except Exception as e:
+                error = e
+    finally:
+        steps.close()
+
+
+async def run_steps_async(steps: Generator, client: AsyncOpenAIClient) -> Any:
+    # Same as run_steps, the calls are awaited
+    value, error = None, None
+    try:
+        while True:
+            try:
+                request = steps.throw(error) if error is not None else steps.send(value)
+            except StopIteration as stop:
+                return stop.value
+            value, error = None, None
+            try:
+                value = await client.structured_call(**request)
+            except Exception as e:
+                error = e
+    finally:
+        steps.close()
+
+
+def run_stage(
+    stage: str,
+    gles_data: Dict,
+    outputs: Dict[str, Any],
+    client: OpenAIClient,
+    layout: str = PERSONA_FIRST,
+    judge: Optional[DeterministicJudge] = None,
+    votes: int = 1,
+) -> Optional[Any]:
+    return run_steps(stage_steps(stage, gles_data, outputs, layout, judge, votes), client)
+
+
+async def run_stage_async(
+    stage: str,
+    gles_data: Dict,
+    outputs: Dict[str, Any],
+    client: AsyncOpenAIClient,
+    layout: str = PERSONA_FIRST,
+    judge: Optional[DeterministicJudge] = None,
+    votes: int = 1,
+) -> Optional[Any]:
+    return await run_steps_async(
+        stage_steps(stage, gles_data, outputs, layout, judge, votes), client
+    )
+
+
+def build_result(
+    id: str, outputs: Dict[str, Any], gles_data: Optional[Dict] = None
+) -> Dict:
+    result = {"id": id}
+    for stage in STAGES:
+        result[RESULT_KEYS[stage]] = outputs.get(stage)
+    # The survey weight travels with the record for weighted shares
+    if gles_data and gles_data.get(WEIGHT_KEY) is not None:
+        result[WEIGHT_KEY] = float(gles_data[WEIGHT_KEY])
+    return result
@@ -1,26 +1,39 @@
 import json
-from pathlib import Path
-from typing import Dict, Optional
+import logging
+from typing import Any, Dict, Optional, Tuple
 
-from llm_client import OpenAIClient
+from llm_client import OpenAIClient, AsyncOpenAIClient
 from schemas import PersonaSchema
 from response_formats import persona_response_format
-from prompt_templates import PERSONA_GENERATION_TEMPLATE
+from prompt_templates import (
+    PERSONA_GENERATION_TEMPLATE,
+    PERSONA_GENERATION_CONTEXT_FIRST_TEMPLATE,
+    PERSONA_FIRST,
+    CONTEXT_FIRST,
+    build_static_context,
+)
+from context_store import SharedContext, get_shared_context
 
-def step1_create_persona(
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Survey weight of a GLES row; carried to the results, not into the prompt
+WEIGHT_KEY = "gewicht"
+# Repeat number of a deduplicated profile; not in the prompt either, it
+# is the cache sample index, so every repeat gets its own persona
+REPEAT_KEY = "wiederholung"
+HIDDEN_KEYS = (WEIGHT_KEY, REPEAT_KEY)
+
+def build_persona_prompts(
     gles_data: Dict,
-    client: OpenAIClient
-) -> Optional[PersonaSchema]:
-    
-    # Load news for context
-    news_path = Path("Daten/Basisdaten/news.txt")
-    news_data = news_path.read_text(encoding="utf-8")
-    
-    # Format the prompt
-    user_prompt = PERSONA_GENERATION_TEMPLATE.format(
-        gles_data=json.dumps(gles_data, ensure_ascii=False),
-        news_data=news_data
-    )
+    context: Optional[SharedContext] = None,
+    layout: str = PERSONA_FIRST
+) -> Tuple[str, str]:
+
+    # News for context, loaded once per process
+    context = context or get_shared_context()
+    gles_data = {key: value for key, value in gles_data.items() if key not in HIDDEN_KEYS}
     
     # Create system prompt for generation of persona
     system_prompt = (
@@ -28,11 +41,52 @@ def step1_create_persona(
         "Erstelle eine realistische, detaillierte Persona basierend auf den Daten."
     )
 
-    result, error = client.structured_call(
+    if layout == CONTEXT_FIRST:
+        # Static news first, persona data last
+        system_prompt = (
+            build_static_context(news_data=context.news) + "\n" + system_prompt
+        )
+        user_prompt = PERSONA_GENERATION_CONTEXT_FIRST_TEMPLATE.format(
+            gles_data=json.dumps(gles_data, ensure_ascii=False)
+        )
+        return system_prompt, user_prompt
+
+    # Format the prompt
+    user_prompt = PERSONA_GENERATION_TEMPLATE.format(
+        gles_data=json.dumps(gles_data, ensure_ascii=False),
+        news_data=context.news
+    )
+
+    return system_prompt, user_prompt
+
+def persona_request(gles_data: Dict, layout: str = PERSONA_FIRST) -> Dict[str, Any]:
+    # structured_call arguments, the same for the sync and async step
+    system_prompt, user_prompt = build_persona_prompts(gles_data, layout=layout)
+    return dict(
         system_prompt=system_prompt,
         user_prompt=user_prompt,
         response_format=persona_response_format,
-        response_model=PersonaSchema
+        response_model=PersonaSchema,
+        sample_index=gles_data.get(REPEAT_KEY)
     )
 
+def finish_persona(
+    result: Optional[PersonaSchema], error: Optional[str]
+) -> Optional[PersonaSchema]:
+    if error:
+        logger.error(f"Persona generation failed: {error}")
     return result
+
+def step1_create_persona(
+    gles_data: Dict,
+    client: OpenAIClient,
+    layout: str = PERSONA_FIRST
+) -> Optional[PersonaSchema]:
+    return finish_persona(*client.structured_call(**persona_request(gles_data, layout)))
+
+async def step1_create_persona_async(
+    gles_data: Dict,
+    client: AsyncOpenAIClient,
+    layout: str = PERSONA_FIRST
+) -> Optional[PersonaSchema]:
+    return finish_persona(*await client.structured_call(**persona_request(gles_data, layout)))
@@ -1,89 +1,139 @@
 import json
 import logging
-from pathlib import Path
-from typing import Dict, List, Optional
-
-from llm_client import OpenAIClient
-from schemas import PersonaSchema, WahlomatSchema
-from response_formats import wahlomat_response_format
-from prompt_templates import WAHLOMAT_TEMPLATE
+from typing import Any, Dict, Optional, Tuple
+
+from llm_client import OpenAIClient, AsyncOpenAIClient
+from schemas import PersonaSchema, WahlomatSchema, wahlomat_gaps
+from response_formats import wahlomat_response_format, wahlomat_repair_response_format
+from prompt_templates import (
+    WAHLOMAT_TEMPLATE,
+    WAHLOMAT_CONTEXT_FIRST_TEMPLATE,
+    WAHLOMAT_REPAIR_TEMPLATE,
+    PERSONA_FIRST,
+    CONTEXT_FIRST,
+    build_static_context,
+)
+from context_store import SharedContext, get_shared_context
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Above this many missing or invalid theses the full request is repeated
+REPAIR_MAX_THESES = 17
 
-def load_party_programs() -> str:
-    program_dir = Path("Daten/Basisdaten/wahlprogramme")
-    programs = []
-
-    for party_file in [
-        "CDU.txt",
-        "SPD.txt",
-        "GRÜNE.txt",
-        "FDP.txt",
-        "LINKE.txt",
-        "AFD.txt",
-    ]:
-        try:
-            content = (program_dir / party_file).read_text(encoding="utf-8")
-            programs.append(content)
-        except Exception as e:
-            logger.warning(f"Could not load {party_file}: {e}")
-
-    return "\n\n".join(programs)
-
-
-def load_news() -> str:
-    news_path = Path("Daten/Basisdaten/news.txt")
-    try:
-        return news_path.read_text(encoding="utf-8")
-    except Exception as e:
-        logger.warning(f"Could not load news: {e}")
-        return ""
-
+SYSTEM_PROMPT = (
+    "Du bist jetzt die beschriebene Persona."
+    "Beantworte die Wahl-O-Mat-Fragen aus ihrer Perspektive."
+)
 
-def load_wahlomat_questions() -> List[Dict]:
-    questions_path = Path("Daten/Basisdaten/wahlomat_fragen.json")
-    try:
-        return json.loads(questions_path.read_text(encoding="utf-8"))
-    except Exception as e:
-        logger.error(f"Could not load wahlomat questions: {e}")
-        return []
 
-
-def step2_wahlomat(
-    persona: PersonaSchema, client: OpenAIClient
-):
-    # Load required data
-    questions = load_wahlomat_questions()
-    if not questions:
+def build_wahlomat_prompts(
+    persona: PersonaSchema,
+    context: Optional[SharedContext] = None,
+    layout: str = PERSONA_FIRST,
+) -> Optional[Tuple[str, str]]:
+    # Shared data, loaded once per process
+    context = context or get_shared_context()
+    if not context.questions:
         logger.error("No wahlomat questions available")
         return None
 
-    news_data = load_news()
-    party_programs = load_party_programs()
+    system_prompt = SYSTEM_PROMPT
+
+    if layout == CONTEXT_FIRST:
+        # Static programmes, news and theses first, persona last
+        static_context = build_static_context(
+            party_programs=context.party_programs,
+            news_data=context.news,
+            questions=context.questions_json,
+        )
+        system_prompt = static_context + "\n" + system_prompt
+        user_prompt = WAHLOMAT_CONTEXT_FIRST_TEMPLATE.format(
+            persona_str=json.dumps(persona, ensure_ascii=False)
+        )
+        return system_prompt, user_prompt
 
     # Format the prompt
     user_prompt = WAHLOMAT_TEMPLATE.format(
         #persona_str=json.dumps(persona.model_dump(), ensure_ascii=False),
         persona_str=json.dumps(persona, ensure_ascii=False),
-        news_data=news_data,
-        party_programs=party_programs,
-        questions=json.dumps(questions, ensure_ascii=False),
+        news_data=context.news,
+        party_programs=context.party_programs,
+        questions=context.questions_json,
     )
 
-    # Make the API call
-    system_prompt = (
-        "Du bist jetzt die beschriebene Persona."
-        "Beantworte die Wahl-O-Mat-Fragen aus ihrer Perspektive."
-    )
-
-    result, error = client.structured_call(
+    return system_prompt, user_prompt
+
+
+class WahlomatRepair:
+    # Partial repair for structured_call: a response that fails
+    # WahlomatSchema keeps its valid answers, only the missing or invalid
+    # theses are asked again in a small follow-up and merged in
+    def __init__(self, persona: PersonaSchema, context: Optional[SharedContext] = None):
+        self.persona = persona
+        self.context = context or get_shared_context()
+
+    def request(self, data: Any) -> Optional[Tuple[str, str, Dict]]:
+        # (system prompt, user prompt, response format), or None when a
+        # full retry is the better option
+        _, missing = wahlomat_gaps(data)
+        if not missing or len(missing) > REPAIR_MAX_THESES:
+            return None
+        questions = [q for q in self.context.questions if q.get("these_id") in missing]
+        user_prompt = WAHLOMAT_REPAIR_TEMPLATE.format(
+            count=len(missing),
+            persona_str=json.dumps(self.persona, ensure_ascii=False),
+            questions=json.dumps(questions, ensure_ascii=False, indent=2),
+        )
+        return SYSTEM_PROMPT, user_prompt, wahlomat_repair_response_format(missing)
+
+    def merge(self, data: Any, repair: Any) -> Dict:
+        # Answers of the first response win, the follow-up only fills gaps
+        answers = {answer["these_id"]: answer for answer in wahlomat_gaps(data)[0]}
+        for answer in wahlomat_gaps(repair)[0]:
+            answers.setdefault(answer["these_id"], answer)
+        return {"antworten": [answers[these_id] for these_id in sorted(answers)]}
+
+
+def wahlomat_request(
+    persona: PersonaSchema, layout: str = PERSONA_FIRST
+) -> Optional[Dict[str, Any]]:
+    # structured_call arguments, the same for the sync and async step
+    prompts = build_wahlomat_prompts(persona, layout=layout)
+    if prompts is None:
+        return None
+    system_prompt, user_prompt = prompts
+    return dict(
         system_prompt=system_prompt,
         user_prompt=user_prompt,
         response_format=wahlomat_response_format,
         response_model=WahlomatSchema,
+        repair=WahlomatRepair(persona),
     )
-    
-    return result
\ No newline at end of file
+
+
+def finish_wahlomat(
+    result: Optional[WahlomatSchema], error: Optional[str]
+) -> Optional[WahlomatSchema]:
+    if error:
+        logger.error(f"Wahlomat answers failed: {error}")
+    return result
+
+
+def step2_wahlomat(
+    persona: PersonaSchema, client: OpenAIClient, layout: str = PERSONA_FIRST
+):
+    request = wahlomat_request(persona, layout)
+    if request is None:
+        return None
+    return finish_wahlomat(*client.structured_call(**request))
+
+
+async def step2_wahlomat_async(
+    persona: PersonaSchema, client: AsyncOpenAIClient, layout: str = PERSONA_FIRST
+):
+    request = wahlomat_request(persona, layout)
+    if request is None:
+        return None
+    return finish_wahlomat(*await client.structured_call(**request))
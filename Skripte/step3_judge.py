@@ -1,38 +1,48 @@
 import json
 import logging
-from pathlib import Path
-from typing import Optional
+from typing import Any, Dict, Optional, Tuple
 
-from llm_client import OpenAIClient
+from llm_client import OpenAIClient, AsyncOpenAIClient
 from schemas import PersonaSchema, WahlomatSchema, JudgeSchema
 from response_formats import judge_response_format
-from prompt_templates import JUDGE_TEMPLATE
+from prompt_templates import (
+    JUDGE_TEMPLATE,
+    JUDGE_CONTEXT_FIRST_TEMPLATE,
+    PERSONA_FIRST,
+    CONTEXT_FIRST,
+    build_static_context,
+)
+from context_store import SharedContext, get_shared_context
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def load_party_programs() -> str:
-    program_dir = Path("Daten/Basisdaten/wahlprogramme")
-    programs = []
-    
-    for party_file in ["CDU.txt", "SPD.txt", "GRÜNE.txt", "FDP.txt", "LINKE.txt", "AFD.txt"]:
-        try:
-            content = (program_dir / party_file).read_text(encoding="utf-8")
-            programs.append(content)
-        except Exception as e:
-            logger.warning(f"Could not load {party_file}: {e}")
-    
-    return "\n\n".join(programs)
-
-def step3_judge(
+def build_judge_prompts(
     persona: PersonaSchema,
     wahlomat_answers: WahlomatSchema,
-    client: OpenAIClient
-) -> Optional[JudgeSchema]:
+    context: Optional[SharedContext] = None,
+    layout: str = PERSONA_FIRST
+) -> Tuple[str, str]:
     
-    # Load party programs for context
-    party_programs = load_party_programs()
+    # Party programs for context, loaded once per process
+    party_programs = (context or get_shared_context()).party_programs
+
+    system_prompt = (
+        "Du bist ein neutraler Wahlexperte und Politikwissenschaftler."
+        "Analysiere die Übereinstimmungen zwischen den Antworten und den Parteipositionen."
+    )
+
+    if layout == CONTEXT_FIRST:
+        # Static programmes first, persona and answers last
+        system_prompt = (
+            build_static_context(party_programs=party_programs) + "\n" + system_prompt
+        )
+        user_prompt = JUDGE_CONTEXT_FIRST_TEMPLATE.format(
+            persona_str=json.dumps(persona, ensure_ascii=False),
+            answers_str=json.dumps(wahlomat_answers, ensure_ascii=False)
+        )
+        return system_prompt, user_prompt
     
     # Format the prompt
     # user_prompt = JUDGE_TEMPLATE.format(
@@ -46,18 +56,44 @@ def step3_judge(
         answers_str=json.dumps(wahlomat_answers, ensure_ascii=False),
         party_programs=party_programs
     )
-    
-    # Make the API call
-    system_prompt = (
-        "Du bist ein neutraler Wahlexperte und Politikwissenschaftler."
-        "Analysiere die Übereinstimmungen zwischen den Antworten und den Parteipositionen."
+
+    return system_prompt, user_prompt
+
+def judge_request(
+    persona: PersonaSchema,
+    wahlomat_answers: WahlomatSchema,
+    layout: str = PERSONA_FIRST
+) -> Dict[str, Any]:
+    # structured_call arguments, the same for the sync and async step
+    system_prompt, user_prompt = build_judge_prompts(
+        persona, wahlomat_answers, layout=layout
     )
-    
-    result, error = client.structured_call(
+    return dict(
         system_prompt=system_prompt,
         user_prompt=user_prompt,
         response_model=JudgeSchema,
         response_format=judge_response_format
     )
-    
-    return result
\ No newline at end of file
+
+def finish_judge(result: Optional[JudgeSchema], error: Optional[str]) -> Optional[JudgeSchema]:
+    if error:
+        logger.error(f"Judge analysis failed: {error}")
+    return result
+
+def step3_judge(
+    persona: PersonaSchema,
+    wahlomat_answers: WahlomatSchema,
+    client: OpenAIClient,
+    layout: str = PERSONA_FIRST
+) -> Optional[JudgeSchema]:
+    return finish_judge(*client.structured_call(**judge_request(persona, wahlomat_answers, layout)))
+
+async def step3_judge_async(
+    persona: PersonaSchema,
+    wahlomat_answers: WahlomatSchema,
+    client: AsyncOpenAIClient,
+    layout: str = PERSONA_FIRST
+) -> Optional[JudgeSchema]:
+    return finish_judge(
+        *await client.structured_call(**judge_request(persona, wahlomat_answers, layout))
+    )
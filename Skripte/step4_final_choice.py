@@ -1,34 +1,53 @@
 import json
 import logging
-from pathlib import Path
-from typing import Optional
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
 
-from llm_client import OpenAIClient
+from llm_client import OpenAIClient, AsyncOpenAIClient
 from schemas import PersonaSchema, WahlomatSchema, JudgeSchema, FinalChoiceSchema
 from response_formats import final_choice_response_format
-from prompt_templates import FINAL_CHOICE_TEMPLATE
+from prompt_templates import (
+    FINAL_CHOICE_TEMPLATE,
+    FINAL_CHOICE_CONTEXT_FIRST_TEMPLATE,
+    PERSONA_FIRST,
+    CONTEXT_FIRST,
+    build_static_context,
+)
+from context_store import SharedContext, get_shared_context
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def step4_final_choice(
+def build_final_choice_prompts(
     persona: PersonaSchema,
     wahlomat_answers: WahlomatSchema,
     judge_result: JudgeSchema,
-    client: OpenAIClient
-) -> Optional[FinalChoiceSchema]:
+    context: Optional[SharedContext] = None,
+    layout: str = PERSONA_FIRST
+) -> Tuple[str, str]:
  
-    # Load required data
-    news_path = Path("Daten/Basisdaten/news.txt")
-    news_data = news_path.read_text(encoding="utf-8")
-
-    # Load party programs
-    program_dir = Path("Daten/Basisdaten/wahlprogramme")
-    party_programs = []
-    for party_file in ["CDU.txt", "SPD.txt", "GRÜNE.txt", "FDP.txt", "LINKE.txt", "AFD.txt"]:
-        content = (program_dir / party_file).read_text(encoding="utf-8")
-        party_programs.append(content)
+    # News and party programs, loaded once per process
+    context = context or get_shared_context()
+
+    system_prompt = (
+        "Du bist wieder die ursprüngliche Persona. "
+        "Treffe deine finale Wahlentscheidung basierend auf allen verfügbaren Informationen."
+    )
+
+    if layout == CONTEXT_FIRST:
+        # Static programmes and news first, persona data last
+        static_context = build_static_context(
+            party_programs=context.party_programs,
+            news_data=context.news
+        )
+        system_prompt = static_context + "\n" + system_prompt
+        user_prompt = FINAL_CHOICE_CONTEXT_FIRST_TEMPLATE.format(
+            persona_str=json.dumps(persona, ensure_ascii=False),
+            answers_str=json.dumps(wahlomat_answers, ensure_ascii=False),
+            judge_str=json.dumps(judge_result, ensure_ascii=False)
+        )
+        return system_prompt, user_prompt
     
     # Format the prompt
     # user_prompt = FINAL_CHOICE_TEMPLATE.format(
@@ -43,21 +62,85 @@ def step4_final_choice(
         persona_str=json.dumps(persona, ensure_ascii=False),
         answers_str=json.dumps(wahlomat_answers, ensure_ascii=False),
         judge_str=json.dumps(judge_result, ensure_ascii=False),
-        news_data=news_data,
-        party_programs=party_programs
+        news_data=context.news,
+        party_programs=context.party_programs
     )
-    
-    # Make the API call
-    system_prompt = (
-        "Du bist wieder die ursprüngliche Persona. "
-        "Treffe deine finale Wahlentscheidung basierend auf allen verfügbaren Informationen."
+
+    return system_prompt, user_prompt
+
+def aggregate_votes(choices: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    # K sampled decisions of one persona -> party distribution. partei_wahl
+    # stays the most frequent party (first drawn on ties) so consumers of
+    # a single choice keep working; sicherheit is the mean over the votes.
+    votes = [choice for choice in choices if choice.get("partei_wahl")]
+    if not votes:
+        return None
+    counts = Counter(choice["partei_wahl"] for choice in votes)
+    partei_wahl = counts.most_common(1)[0][0]
+    certainties = [
+        choice["sicherheit"]
+        for choice in votes
+        if isinstance(choice.get("sicherheit"), (int, float))
+    ]
+    return {
+        "partei_wahl": partei_wahl,
+        "begruendung": next(
+            choice.get("begruendung") for choice in votes
+            if choice["partei_wahl"] == partei_wahl
+        ),
+        "sicherheit": round(sum(certainties) / len(certainties)) if certainties else None,
+        "stimmen": len(votes),
+        "verteilung": {party: count / len(votes) for party, count in counts.items()},
+    }
+
+
+def final_choice_request(
+    persona: PersonaSchema,
+    wahlomat_answers: WahlomatSchema,
+    judge_result: JudgeSchema,
+    layout: str = PERSONA_FIRST,
+    votes: int = 1
+) -> Dict[str, Any]:
+    # structured_call arguments, the same for the sync and async step;
+    # votes > 1 draws that many decisions in one request
+    system_prompt, user_prompt = build_final_choice_prompts(
+        persona, wahlomat_answers, judge_result, layout=layout
     )
-    
-    result, error = client.structured_call(
+    return dict(
         system_prompt=system_prompt,
         user_prompt=user_prompt,
         response_model=FinalChoiceSchema,
-        response_format=final_choice_response_format
+        response_format=final_choice_response_format,
+        n=votes
     )
-        
-    return result
\ No newline at end of file
+
+def finish_final_choice(
+    result: Any, error: Optional[str], votes: int = 1
+) -> Optional[FinalChoiceSchema]:
+    if error:
+        logger.error(f"Final choice failed: {error}")
+    if result is not None and votes > 1:
+        return aggregate_votes(result)
+    return result
+
+def step4_final_choice(
+    persona: PersonaSchema,
+    wahlomat_answers: WahlomatSchema,
+    judge_result: JudgeSchema,
+    client: OpenAIClient,
+    layout: str = PERSONA_FIRST,
+    votes: int = 1
+) -> Optional[FinalChoiceSchema]:
+    request = final_choice_request(persona, wahlomat_answers, judge_result, layout, votes)
+    return finish_final_choice(*client.structured_call(**request), votes)
+
+async def step4_final_choice_async(
+    persona: PersonaSchema,
+    wahlomat_answers: WahlomatSchema,
+    judge_result: JudgeSchema,
+    client: AsyncOpenAIClient,
+    layout: str = PERSONA_FIRST,
+    votes: int = 1
+) -> Optional[FinalChoiceSchema]:
+    request = final_choice_request(persona, wahlomat_answers, judge_result, layout, votes)
+    return finish_final_choice(*await client.structured_call(**request), votes)
@@ -0,0 +1,158 @@
+import json
+import time
+import logging
+import argparse
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+REPLICATES = 2000
+CONFIDENCE = 0.95
+# Replicates drawn at once; the count matrix has block x personas bytes
+BLOCK_SIZE = 256
+
+# Poisson(1) counts drawn from single random bytes: P(0..5) quantized to
+# 1/256 (mean and variance 1.004). The shares are ratios, so the scale of
+# the counts cancels and only their spread matters.
+POISSON_LEVELS = np.cumsum([94, 94, 47, 16, 4]).astype(np.uint8)
+
+
+def weighted_vote_shares(votes: np.ndarray, weights: Optional[np.ndarray] = None) -> np.ndarray:
+    # votes: personas x parties, one-hot choices or sampled distributions
+    weights = np.ones(len(votes)) if weights is None else weights
+    totals = weights @ votes
+    return totals / max(totals.sum(), 1e-12)
+
+
+def _poisson_counts(rng: np.random.Generator, shape) -> np.ndarray:
+    # Threshold sums on uint8 avoid fancy indexing, which would widen the
+    # random bytes to 8-byte indices first
+    u = rng.integers(0, 256, size=shape, dtype=np.uint8)
+    counts = (u >= POISSON_LEVELS[0]).view(np.uint8)
+    for level in POISSON_LEVELS[1:]:
+        counts += (u >= level).view(np.uint8)
+    return counts
+
+
+class StreamingBootstrap:
+    # Poisson bootstrap over personas: every replicate re-weights each
+    # persona by an independent Poisson(1) count, which is the multinomial
+    # resample without its fixed total. Since the counts are independent,
+    # personas can be added chunk by chunk: each chunk adds counts (block x
+    # personas) @ weighted votes to the replicates' party totals, so memory
+    # is one chunk plus a replicates x parties array.
+    def __init__(
+        self,
+        parties: int,
+        replicates: int = REPLICATES,
+        seed: Optional[int] = None,
+        block_size: int = BLOCK_SIZE,
+    ):
+        self.replicates = replicates
+        self.block_size = block_size
+        self.rows = 0
+        self._rng = np.random.default_rng(seed)
+        # Party totals and total weight, of the sample and of each replicate
+        self._totals = np.zeros(parties + 1)
+        self._replicate_totals = np.zeros((replicates, parties + 1))
+
+    def add(self, votes: np.ndarray, weights: Optional[np.ndarray] = None) -> None:
+        n = len(votes)
+        if n == 0:
+            return
+        weights = np.ones(n) if weights is None else weights
+        weighted = np.ascontiguousarray(
+            np.column_stack([votes * weights[:, None], weights]), dtype=np.float32
+        )
+        self.rows += n
+        self._totals += weighted.sum(axis=0, dtype=np.float64)
+        for start in range(0, self.replicates, self.block_size):
+            end = min(start + self.block_size, self.replicates)
+            counts = _poisson_counts(self._rng, (end - start, n))
+            self._replicate_totals[start:end] += counts.astype(np.float32) @ weighted
+
+    def shares(self) -> np.ndarray:
+        return self._totals[:-1] / max(self._totals[-1], 1e-12)
+
+    def samples(self) -> np.ndarray:
+        # Party totals over the replicate's total weight
+        totals = self._replicate_totals
+        return totals[:, :-1] / np.maximum(totals[:, -1:], 1e-12)
+
+    def intervals(
+        self, parties: Sequence[str], confidence: float = CONFIDENCE
+    ) -> Dict[str, Dict[str, float]]:
+        # Point estimate and percentile interval per party, in percent
+        shares = self.shares()
+        alpha = (1 - confidence) / 2
+        lower, upper = np.quantile(self.samples(), [alpha, 1 - alpha], axis=0)
+        return {
+            party: {
+                "anteil": float(shares[i] * 100),
+                "ci_unten": float(lower[i] * 100),
+                "ci_oben": float(upper[i] * 100),
+            }
+            for i, party in enumerate(parties)
+        }
+
+
+def bootstrap_vote_shares(
+    votes: np.ndarray,
+    weights: Optional[np.ndarray] = None,
+    replicates: int = REPLICATES,
+    seed: Optional[int] = None,
+    block_size: int = BLOCK_SIZE,
+) -> np.ndarray:
+    # All personas at once, replicates x parties shares
+    bootstrap = StreamingBootstrap(votes.shape[1], replicates, seed, block_size)
+    bootstrap.add(votes, weights)
+    return bootstrap.samples()
+
+
+def vote_share_intervals(
+    parties: Sequence[str],
+    votes: np.ndarray,
+    weights: Optional[np.ndarray] = None,
+    replicates: int = REPLICATES,
+    confidence: float = CONFIDENCE,
+    seed: Optional[int] = None,
+) -> Dict[str, Dict[str, float]]:
+    # Point estimate and percentile interval per party, in percent
+    bootstrap = StreamingBootstrap(len(parties), replicates, seed)
+    bootstrap.add(votes, weights)
+    return bootstrap.intervals(parties, confidence)
+
+
+def main():
+    # Timing on synthetic one-hot votes with random weights
+    parser = argparse.ArgumentParser(description="Bootstrap timing for vote shares")
+    parser.add_argument("--personas", type=int, default=100000)
+    parser.add_argument("--parties", type=int, default=6)
+    parser.add_argument("--replicates", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    votes = np.zeros((args.personas, args.parties))
+    votes[np.arange(args.personas), rng.integers(0, args.parties, args.personas)] = 1.0
+    weights = rng.lognormal(0.0, 0.5, args.personas)
+
+    start = time.perf_counter()
+    intervals = vote_share_intervals(
+        [f"P{i}" for i in range(args.parties)], votes, weights, args.replicates, seed=args.seed
+    )
+    elapsed = time.perf_counter() - start
+    print(json.dumps({
+        "personas": args.personas,
+        "replicates": args.replicates,
+        "seconds": round(elapsed, 2),
+        "intervals": intervals,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import json
+import logging
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from context_store import SharedContext, get_shared_context
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Party positions extracted from the Wahl-O-Mat (wahlomatDatenExtrahieren.js)
+POSITIONS_PATH = Path("Sonstiges/wahlomat_fragen.json")
+# Questionnaire these_id -> official thesis number (1-based) and polarity,
+# polung -1 means the official thesis is phrased the other way round
+ALIGNMENT_PATH = Path("Daten/Basisdaten/wahlomat_zuordnung.json")
+
+ENTSCHEIDUNGEN = {"stimme zu": 1.0, "neutral": 0.0, "stimme nicht zu": -1.0}
+
+# Wahl-O-Mat party names that differ from our party codes
+PARTY_ALIASES = {
+    "CDU / CSU": "CDU",
+    "AfD": "AFD",
+    "Die Linke": "LINKE",
+}
+
+
+def _normalize(text: str) -> str:
+    return " ".join(text.lower().split()).rstrip(".")
+
+
+def load_position_matrix(
+    questions: Sequence[Dict],
+    parties: Sequence[str],
+    positions_path: Path = POSITIONS_PATH,
+    alignment_path: Optional[Path] = ALIGNMENT_PATH,
+) -> np.ndarray:
+    # party x thesis matrix in questionnaire order with -1/0/1 and NaN
+    # where the party position of a thesis is unknown. Theses are aligned
+    # by identical text first, then through the alignment file.
+    official = json.loads(Path(positions_path).read_text(encoding="utf-8"))
+    by_text = {_normalize(these["frage"]): index for index, these in enumerate(official)}
+
+    alignment = {}
+    if alignment_path is not None and Path(alignment_path).exists():
+        for entry in json.loads(Path(alignment_path).read_text(encoding="utf-8")):
+            alignment[entry["these_id"]] = (entry["wahlomat_these"] - 1, entry.get("polung", 1))
+
+    party_index = {party: row for row, party in enumerate(parties)}
+    matrix = np.full((len(parties), len(questions)), np.nan)
+    for column, question in enumerate(questions):
+        index = by_text.get(_normalize(question["text"]))
+        polarity = 1
+        if index is None and question["these_id"] in alignment:
+            index, polarity = alignment[question["these_id"]]
+        if index is None:
+            continue
+        for statement in official[index]["statements"]:
+            party = PARTY_ALIASES.get(statement["partei"], statement["partei"])
+            if party in party_index and statement["entscheidung"] in ENTSCHEIDUNGEN:
+                matrix[party_index[party], column] = (
+                    polarity * ENTSCHEIDUNGEN[statement["entscheidung"]] + 0.0
+                )
+    return matrix
+
+
+def score_matrix(
+    answers: np.ndarray, positions: np.ndarray, weights: Optional[np.ndarray] = None
+) -> np.ndarray:
+    # Official Wahl-O-Mat scoring: 2 points for the same position, 1 point
+    # if one side is neutral, 0 points for opposite positions. Theses that
+    # either side left open do not count; weights of 2 double a thesis.
+    # answers: personas x theses, positions: parties x theses, both NaN
+    # for unknown. Returns personas x parties in percent.
+    if weights is None:
+        weights = np.ones(answers.shape[1])
+    valid_answers = ~np.isnan(answers)
+    valid_positions = ~np.isnan(positions)
+    a = np.where(valid_answers, answers, 0.0) * weights
+    p = np.where(valid_positions, positions, 0.0)
+    wa = valid_answers * weights
+
+    # For -1/0/1, |a - p| = |a| + |p| - a*p - |a*p|, so the points of the
+    # whole batch are a few matrix products instead of a
+    # personas x parties x theses tensor
+    abs_a = np.abs(a)
+    abs_p = np.abs(p)
+    counted = wa @ valid_positions.T
+    distance = abs_a @ valid_positions.T + wa @ abs_p.T - a @ p.T - abs_a @ abs_p.T
+    points = 2.0 * counted - distance
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counted > 0, 50.0 * points / counted, 0.0)
+
+
+class DeterministicJudge:
+    # Drop-in replacement for step3_judge: computes JudgeSchema-shaped
+    # output from the Wahl-O-Mat answers instead of calling the model
+    def __init__(
+        self,
+        context: Optional[SharedContext] = None,
+        positions_path: Path = POSITIONS_PATH,
+        alignment_path: Optional[Path] = ALIGNMENT_PATH,
+    ):
+        context = context or get_shared_context()
+        self.parties = list(context.parties)
+        self.these_ids = [question["these_id"] for question in context.questions]
+        self._column = {these_id: column for column, these_id in enumerate(self.these_ids)}
+        self.positions = load_position_matrix(
+            context.questions, self.parties, positions_path, alignment_path
+        )
+
+        covered = int((~np.isnan(self.positions)).any(axis=0).sum())
+        if covered == 0:
+            raise ValueError(
+                f"None of the {len(self.these_ids)} theses has known party positions in "
+                f"{positions_path}; add them to {alignment_path}"
+            )
+        logger.info(
+            f"Deterministic judge: {covered} of {len(self.these_ids)} theses "
+            f"have Wahl-O-Mat party positions"
+        )
+
+    def answer_matrix(self, answers: Sequence[Dict]) -> np.ndarray:
+        matrix = np.full((len(answers), len(self.these_ids)), np.nan)
+        rows, columns, values = [], [], []
+        for row, result in enumerate(answers):
+            for answer in (result or {}).get("antworten", []):
+                column = self._column.get(answer.get("these_id"))
+                if column is not None and answer.get("position") in (-1, 0, 1):
+                    rows.append(row)
+                    columns.append(column)
+                    values.append(answer["position"])
+        matrix[rows, columns] = values
+        return matrix
+
+    def score_batch(self, answers: Sequence[Dict]) -> List[Dict]:
+        answer_matrix = self.answer_matrix(answers)
+        scores = score_matrix(answer_matrix, self.positions)
+        covered = (~np.isnan(self.positions)).any(axis=0)
+        counted = (~np.isnan(answer_matrix)).astype(int) @ covered.astype(int)
+        return [
+            self._result(scores[row], int(counted[row])) for row in range(len(answers))
+        ]
+
+    def score(self, answers: Dict) -> Dict:
+        return self.score_batch([answers])[0]
+
+    def _result(self, scores: np.ndarray, counted: int) -> Dict:
+        matches = {party: round(float(score), 2) for party, score in zip(self.parties, scores)}
+        ranking = sorted(matches, key=matches.get, reverse=True)
+        best, second, worst = ranking[0], ranking[1], ranking[-1]
+        analyse = (
+            f"Deterministischer Wahl-O-Mat-Abgleich über {counted} Thesen mit bekannten "
+            f"Parteipositionen: 2 Punkte bei gleicher Position, 1 Punkt wenn eine Seite "
+            f"neutral ist, 0 Punkte bei entgegengesetzter Position. Die höchste "
+            f"Übereinstimmung besteht mit {best} ({matches[best]:.2f} %), gefolgt von "
+            f"{second} ({matches[second]:.2f} %). Die geringste Übereinstimmung besteht "
+            f"mit {worst} ({matches[worst]:.2f} %)."
+        )
+        return {"matches": matches, "analyse": analyse}
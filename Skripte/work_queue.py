@@ -0,0 +1,276 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import logging
+import argparse
+import threading
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+LEASE_SECONDS = 600.0
+CLAIM_SIZE = 20
+# Attempts per persona before it is given up as failed
+MAX_ATTEMPTS = 3
+# Ids per INSERT when the queue is filled
+SEED_BATCH = 500
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+
+def default_worker_id() -> str:
+    # Host and process; dots are replaced since the id names a shard
+    return f"{socket.gethostname()}-{os.getpid()}".replace(".", "_")
+
+
+class WorkQueue:
+    # Persona ids shared by several pipeline workers through one SQLite
+    # file on a shared volume. A worker leases a few ids at a time and
+    # renews the lease from a heartbeat thread while it works on them; an
+    # id whose lease ran out (crashed or stalled worker) is handed out
+    # again. The rollback journal is used instead of WAL, which needs
+    # shared memory and does not work across hosts on network file
+    # systems; every claim is one BEGIN IMMEDIATE transaction.
+    def __init__(
+        self,
+        path: Path,
+        worker: Optional[str] = None,
+        lease_seconds: float = LEASE_SECONDS,
+        max_attempts: int = MAX_ATTEMPTS,
+        timeout: float = 60.0,
+    ):
+        self.path = Path(path)
+        self.worker = worker or default_worker_id()
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.held: Set[str] = set()
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat: Optional[threading.Thread] = None
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(
+            str(self.path), timeout=timeout, isolation_level=None, check_same_thread=False
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS items ("
+            "id TEXT PRIMARY KEY, position INTEGER NOT NULL, status TEXT NOT NULL, "
+            "worker TEXT, lease_until REAL, attempts INTEGER NOT NULL DEFAULT 0, "
+            "updated REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS items_status ON items (status, position)"
+        )
+
+    def _transaction(self, statements) -> List:
+        # Runs (sql, params) pairs in one write transaction, returns the
+        # rows of every statement
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = [self._conn.execute(sql, params).fetchall() for sql, params in statements]
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return rows
+
+    def seed(self, ids: Iterable[str]) -> int:
+        # Every worker seeds the same ids; existing ones are left alone,
+        # so the queue is filled once whoever starts first
+        ids = list(ids)
+        now = time.time()
+        added = 0
+        for start in range(0, len(ids), SEED_BATCH):
+            batch = [
+                (id, start + offset, PENDING, now)
+                for offset, id in enumerate(ids[start : start + SEED_BATCH])
+            ]
+            with self._lock:
+                self._conn.execute("BEGIN IMMEDIATE")
+                try:
+                    before = self._conn.total_changes
+                    self._conn.executemany(
+                        "INSERT OR IGNORE INTO items (id, position, status, updated) "
+                        "VALUES (?, ?, ?, ?)",
+                        batch,
+                    )
+                    added += self._conn.total_changes - before
+                    self._conn.execute("COMMIT")
+                except BaseException:
+                    self._conn.execute("ROLLBACK")
+                    raise
+        logger.info(f"Work queue {self.path}: {added} of {len(ids)} ids added")
+        return added
+
+    def claim(self, count: int = CLAIM_SIZE) -> List[str]:
+        # Pending ids first, then ids of expired leases, in seeding order
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Expired leases that used up their attempts are given up
+                self._conn.execute(
+                    "UPDATE items SET status = ?, updated = ? "
+                    "WHERE status = ? AND lease_until < ? AND attempts >= ?",
+                    (FAILED, now, LEASED, now, self.max_attempts),
+                )
+                ids = [
+                    row[0]
+                    for row in self._conn.execute(
+                        "SELECT id FROM items WHERE status = ? "
+                        "OR (status = ? AND lease_until < ?) ORDER BY position LIMIT ?",
+                        (PENDING, LEASED, now, count),
+                    )
+                ]
+                self._conn.executemany(
+                    "UPDATE items SET status = ?, worker = ?, lease_until = ?, "
+                    "attempts = attempts + 1, updated = ? WHERE id = ?",
+                    [(LEASED, self.worker, now + self.lease_seconds, now, id) for id in ids],
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self.held.update(ids)
+        return ids
+
+    def renew(self) -> int:
+        # Extends the leases of all ids this worker holds
+        with self._lock:
+            held = list(self.held)
+        if not held:
+            return 0
+        now = time.time()
+        self._transaction(
+            [
+                (
+                    "UPDATE items SET lease_until = ?, updated = ? "
+                    "WHERE id = ? AND worker = ? AND status = ?",
+                    (now + self.lease_seconds, now, id, self.worker, LEASED),
+                )
+                for id in held
+            ]
+        )
+        return len(held)
+
+    def complete(self, id: str) -> None:
+        # Done even if the lease ran out meanwhile: the record is written
+        self._transaction(
+            [("UPDATE items SET status = ?, updated = ? WHERE id = ?", (DONE, time.time(), id))]
+        )
+        with self._lock:
+            self.held.discard(id)
+
+    def release(self, ids: Iterable[str]) -> None:
+        # Ids this worker could not finish go back to the queue, or are
+        # given up once they used all their attempts
+        ids = [id for id in ids if id in self.held]
+        now = time.time()
+        self._transaction(
+            [
+                (
+                    "UPDATE items SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, "
+                    "worker = NULL, lease_until = NULL, updated = ? "
+                    "WHERE id = ? AND worker = ? AND status = ?",
+                    (self.max_attempts, FAILED, PENDING, now, id, self.worker, LEASED),
+                )
+                for id in ids
+            ]
+        )
+        with self._lock:
+            self.held.difference_update(ids)
+
+    def open_items(self) -> int:
+        # Pending or leased by anyone, i.e. not finished yet
+        return self._transaction(
+            [("SELECT COUNT(*) FROM items WHERE status IN (?, ?)", (PENDING, LEASED))]
+        )[0][0][0]
+
+    def stats(self) -> Dict[str, int]:
+        rows = self._transaction(
+            [("SELECT status, COUNT(*) FROM items GROUP BY status", ())]
+        )[0]
+        return {**{status: 0 for status in (PENDING, LEASED, DONE, FAILED)}, **dict(rows)}
+
+    def start_heartbeat(self, interval: Optional[float] = None) -> None:
+        # Renews the held leases every third of the lease time
+        interval = interval or self.lease_seconds / 3
+
+        def beat() -> None:
+            while not self._stop.wait(interval):
+                try:
+                    self.renew()
+                except sqlite3.Error as e:
+                    logger.warning(f"Lease renewal failed: {e}")
+
+        self._heartbeat = threading.Thread(target=beat, name="lease-heartbeat", daemon=True)
+        self._heartbeat.start()
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+        if self.held:
+            self.release(list(self.held))
+        with self._lock:
+            self._conn.close()
+
+
+def run_from_queue(
+    personas: List[Tuple[str, Dict]],
+    run_batch: Callable[[List[Tuple[str, Dict]]], None],
+    queue: WorkQueue,
+    claim_size: int = CLAIM_SIZE,
+    poll_interval: float = 30.0,
+) -> Dict[str, int]:
+    # Worker loop: lease ids, process them, repeat. Ids leased by other
+    # workers may still come back when their lease runs out, so a worker
+    # only stops once nothing is pending or leased anymore.
+    by_id = dict(personas)
+    queue.seed(by_id)
+    queue.start_heartbeat()
+    processed = 0
+    try:
+        while True:
+            ids = queue.claim(claim_size)
+            if not ids:
+                if queue.open_items() == 0:
+                    break
+                time.sleep(poll_interval)
+                continue
+            unknown = [id for id in ids if id not in by_id]
+            if unknown:
+                # Seeded by a worker with other input or sample settings
+                logger.error(f"Ids not in this worker's personas: {unknown[:10]}")
+            run_batch([(id, by_id[id]) for id in ids if id in by_id])
+            processed += len(ids) - len(unknown)
+            # Whatever was not written goes back to the queue
+            queue.release(ids)
+    finally:
+        stats = queue.stats()
+        queue.close()
+    logger.info(f"Worker {queue.worker} processed {processed} personas, queue: {stats}")
+    return stats
+
+
+def main():
+    # State of a queue, e.g. while several workers are running
+    parser = argparse.ArgumentParser(description="Show the state of a persona work queue")
+    parser.add_argument("--queue_path", required=True)
+    args = parser.parse_args()
+    queue = WorkQueue(Path(args.queue_path), worker="status")
+    print(json.dumps(queue.stats(), indent=2))
+    queue.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import asyncio
+
+import httpx
+
+from fake_llm import FAKE_BASE_URL, FakeLLM, FakeLLMConfig, FakeLLMTransport
+from llm_client import AsyncOpenAIClient, OpenAIClient
+from rate_limiter import AdaptiveRateLimiter
+from response_formats import persona_response_format
+from schemas import PersonaSchema
+
+CALLS = 40
+
+
+def fake_client(client_class, http_client_class, limiter, rate_limit_rate):
+    fake = FakeLLM(FakeLLMConfig(latency_ms=5, rate_limit_rate=rate_limit_rate, retry_after_ms=20))
+    client = client_class(
+        api_key="fake",
+        rate_limiter=limiter,
+        base_url=FAKE_BASE_URL,
+        http_client=http_client_class(transport=FakeLLMTransport(fake)),
+        retry_delay=0.0,
+    )
+    return client, fake
+
+
+def test_async_calls_back_off_on_429s_and_complete():
+    limiter = AdaptiveRateLimiter(max_concurrency=8, recovery_successes=1000)
+    client, fake = fake_client(AsyncOpenAIClient, httpx.AsyncClient, limiter, 0.3)
+
+    async def run():
+        return await asyncio.gather(*(
+            client.structured_call(
+                "System", f"Persona {i}", PersonaSchema, persona_response_format
+            )
+            for i in range(CALLS)
+        ))
+
+    results = asyncio.run(run())
+    stats = limiter.stats()
+
+    assert all(result is not None and error is None for result, error in results)
+    assert fake.counts["rate_limits"] > 0
+    assert stats["rate_limit_hits"] == fake.counts["rate_limits"]
+    # Concurrency is halved on 429s and not raised again during the run
+    assert stats["concurrency_reductions"] > 0
+    assert stats["concurrency_limit"] < stats["max_concurrency"]
+    assert stats["throttled_seconds"] > 0
+
+
+def test_sync_calls_complete_despite_429s():
+    limiter = AdaptiveRateLimiter(max_concurrency=2)
+    client, fake = fake_client(OpenAIClient, httpx.Client, limiter, 0.3)
+
+    results = [
+        client.structured_call("System", f"Persona {i}", PersonaSchema, persona_response_format)
+        for i in range(CALLS // 4)
+    ]
+
+    assert all(result is not None and error is None for result, error in results)
+    assert fake.counts["rate_limits"] > 0
+    assert limiter.stats()["throttled_seconds"] > 0
+
+
+def test_slot_waits_are_not_throttling():
+    # Without 429s, waiting for one of the few slots is not throttled time
+    limiter = AdaptiveRateLimiter(max_concurrency=1)
+    client, fake = fake_client(AsyncOpenAIClient, httpx.AsyncClient, limiter, 0.0)
+
+    async def run():
+        return await asyncio.gather(*(
+            client.structured_call(
+                "System", f"Persona {i}", PersonaSchema, persona_response_format
+            )
+            for i in range(CALLS // 4)
+        ))
+
+    results = asyncio.run(run())
+
+    assert all(error is None for _, error in results)
+    assert fake.counts["rate_limits"] == 0
+    assert limiter.stats()["throttled_seconds"] == 0
@@ -0,0 +1,35 @@
+import time
+
+import pytest
+
+from result_writer import ResultWriter
+
+
+def test_on_written_error_does_not_stop_writing(tmp_path):
+    path = tmp_path / "results.jsonl"
+    seen = []
+
+    def on_written(id):
+        seen.append(id)
+        if id == "1":
+            raise RuntimeError("database is locked")
+
+    with ResultWriter(path, on_written=on_written, flush_records=1) as writer:
+        for i in range(1, 6):
+            writer.write({"id": str(i)})
+
+    assert path.read_text(encoding="utf-8").count("\n") == 5
+    assert seen == ["1", "2", "3", "4", "5"]
+
+
+def test_writer_error_is_raised_from_write_and_close(tmp_path):
+    writer = ResultWriter(tmp_path / "results.jsonl", flush_records=1)
+    writer.write({"id": "1", "value": object()})
+    deadline = time.monotonic() + 5
+    while writer._thread.is_alive() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    with pytest.raises(TypeError):
+        writer.write({"id": "2"})
+    with pytest.raises(TypeError):
+        writer.close()
@@ -0,0 +1,33 @@
+import asyncio
+
+import scheduler
+from scheduler import StageScheduler
+from stages import STAGES
+
+
+class FailingCheckpoints:
+    def get(self, id, gles_data=None):
+        return {}
+
+    def save(self, id, stage, output):
+        raise OSError("disk full")
+
+
+def test_failing_checkpoint_save_does_not_hang_the_run(monkeypatch):
+    async def run_stage_async(stage, *args):
+        return {"stage": stage}
+
+    monkeypatch.setattr(scheduler, "run_stage_async", run_stage_async)
+    workers = {stage: 1 for stage in STAGES}
+    stage_scheduler = StageScheduler(
+        None, workers, queue_size=1, checkpoints=FailingCheckpoints()
+    )
+    results = []
+    personas = [(str(i), {}) for i in range(10)]
+
+    asyncio.run(asyncio.wait_for(stage_scheduler.run(personas, results.append), timeout=5))
+
+    stats = stage_scheduler.stats()
+    assert results == []
+    assert stats[STAGES[0]]["failed"] == 10
+    assert stats[STAGES[0]]["processed"] == 0
@@ -0,0 +1,93 @@
+import json
+import multiprocessing
+import sqlite3
+import time
+from contextlib import closing
+
+from result_writer import ResultWriter, merge_results, result_paths, shard_path
+from work_queue import DONE, FAILED, LEASED, WorkQueue, run_from_queue
+
+PERSONAS = [(str(i), {"alter": 20 + i % 60}) for i in range(1, 201)]
+LEASE_SECONDS = 1.0
+
+
+def worker(queue_path, output_path, name):
+    # A pipeline worker without the LLM: leases ids and writes one record
+    # per id to its own shard
+    queue = WorkQueue(queue_path, worker=name, lease_seconds=LEASE_SECONDS)
+
+    def run_batch(batch):
+        with ResultWriter(shard_path(output_path, name), on_written=queue.complete) as writer:
+            for id, data in batch:
+                time.sleep(0.005)
+                writer.write({"id": id, "alter": data["alter"], "worker": name})
+
+    run_from_queue(PERSONAS, run_batch, queue, claim_size=5, poll_interval=0.05)
+
+
+def stuck_worker(queue_path, output_path, name):
+    # Leases a batch and hangs until it is killed
+    queue = WorkQueue(queue_path, worker=name, lease_seconds=LEASE_SECONDS)
+    run_from_queue(PERSONAS, lambda batch: time.sleep(3600), queue, claim_size=5)
+
+
+def leased_by(queue_path, name):
+    with closing(sqlite3.connect(f"file:{queue_path}?mode=ro", uri=True, timeout=30)) as conn:
+        return [
+            row[0]
+            for row in conn.execute(
+                "SELECT id FROM items WHERE worker = ? AND status = ?", (name, LEASED)
+            )
+        ]
+
+
+def test_killed_worker_leases_are_reclaimed(tmp_path):
+    queue_path = tmp_path / "queue.sqlite"
+    output_path = tmp_path / "results.jsonl"
+    context = multiprocessing.get_context("fork")
+
+    stuck = context.Process(target=stuck_worker, args=(queue_path, output_path, "stuck"))
+    stuck.start()
+    deadline = time.monotonic() + 30
+    held = []
+    while not held and time.monotonic() < deadline:
+        time.sleep(0.05)
+        try:
+            held = leased_by(queue_path, "stuck")
+        except sqlite3.OperationalError:
+            # Queue file or table not created yet
+            held = []
+    assert held, "stuck worker never leased anything"
+
+    workers = [
+        context.Process(target=worker, args=(queue_path, output_path, f"w{i}"))
+        for i in range(3)
+    ]
+    for process in workers:
+        process.start()
+    # Killed mid-lease: no release, no further heartbeats
+    stuck.kill()
+    stuck.join()
+    for process in workers:
+        process.join(timeout=120)
+        assert process.exitcode == 0
+
+    queue = WorkQueue(queue_path, worker="test")
+    stats = queue.stats()
+    queue.close()
+    assert stats[DONE] == len(PERSONAS)
+    assert stats[FAILED] == 0 and stats[LEASED] == 0
+
+    # The stuck worker's ids were written by the others
+    written_by = {}
+    for path in result_paths(output_path):
+        for line in path.read_text(encoding="utf-8").splitlines():
+            record = json.loads(line)
+            written_by.setdefault(record["id"], []).append(record["worker"])
+    assert all(written_by[id] and "stuck" not in written_by[id] for id in held)
+
+    merged = merge_results(output_path, remove_shards=True)
+    ids = [json.loads(line)["id"] for line in output_path.read_text(encoding="utf-8").splitlines()]
+    assert merged["invalid"] == 0 and merged["duplicates"] == 0
+    assert sorted(ids, key=int) == [id for id, _ in PERSONAS]
+    assert result_paths(output_path) == [output_path]